@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import peewee
+
+from s3rsync.history import NodeHistory, NodeHistoryEntry
+from s3rsync.local_db import DatabaseWriter, open_database
+from s3rsync.models import RootFolder, StoredNodeHistory
+from s3rsync.util.misc import all_subclasses
+
+
+PROFILES = {
+    # What the local DB was opened with before the tuning profile.
+    "plain": {},
+    # `LOCAL_DB_PRAGMAS`
+    "tuned": None,
+}
+
+
+def create_history(i: int) -> NodeHistory:
+    entry = NodeHistoryEntry.create_base_only(
+        NodeHistoryEntry.generate_key(), "%032x" % i, "%064x" % i, 1 << 20
+    )
+    return NodeHistory.create(f"some/folder/file{i}.vwx", [entry])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--rows", default=2000, help="StoredNodeHistory rows to insert")
+@click.option("--threads", default=8, help="Threads inserting concurrently")
+@click.option("--folder", default=None, help="Where to create the DB, on the disk the local DB lives on")
+def insert(rows, threads, folder):
+    """
+    StoredNodeHistory rows inserted per second by concurrent threads, each
+    committing its own rows or all of them going through the DB writer.
+    """
+    histories = [create_history(i) for i in range(rows)]
+    print(f"{'profile':<8} {'mode':<8} {'rows/s':>10} {'commits':>8}")
+    for profile, pragmas in PROFILES.items():
+        for mode in ("direct", "writer"):
+            with tempfile.TemporaryDirectory(dir=folder) as db_folder:
+                path = os.path.join(db_folder, "history.db")
+                with open_database(path, pragmas=pragmas) as db:
+                    db.create_tables(all_subclasses(peewee.Model))
+                    root_folder = RootFolder.create(path=db_folder)
+                    writer = DatabaseWriter(db)
+
+                    def upsert(history):
+                        StoredNodeHistory.upsert(root_folder, history, "etag", 0, 0)
+
+                    def run(history):
+                        if mode == "writer":
+                            writer.write(upsert, history)
+                        else:
+                            with db.atomic():
+                                upsert(history)
+
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=threads) as executor:
+                        list(executor.map(run, histories))
+                    elapsed = time.perf_counter() - start
+                    writer.stop()
+                    commits = writer.stats["commits"] if mode == "writer" else rows
+                    print(f"{profile:<8} {mode:<8} {rows / elapsed:>10.0f} {commits:>8}")
+
+
+if __name__ == "__main__":
+    cli()
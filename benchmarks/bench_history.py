@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import json
+import random
+import time
+
+import click
+
+from s3rsync import history_codec
+from s3rsync.history import NodeHistory, NodeHistoryEntry
+from s3rsync.util.timeutil import now_as_iso
+
+
+def create_history(count: int) -> NodeHistory:
+    entries = []
+    for i in range(count):
+        base = i % 50 == 0
+        entries.append(NodeHistoryEntry(
+            key=NodeHistoryEntry.generate_key(),
+            deleted=False,
+            etag="%032x" % random.getrandbits(128),
+            base_version="%064x" % random.getrandbits(256) if base else None,
+            base_size=random.randint(1, 1 << 30) if base else 0,
+            has_delta=not base,
+            delta_size=0 if base else random.randint(1, 1 << 20),
+            timestamp=now_as_iso(),
+        ))
+    return NodeHistory.create("some/folder/file.vwx", entries)
+
+
+def measure(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--entries", default=1000, help="Entries per history")
+@click.option("--repeat", default=5)
+def codec(entries, repeat):
+    """
+    Size, encode and decode time per history entry, JSON against the binary
+    codec. Decode includes building the pydantic models.
+    """
+    history = create_history(entries)
+    data = history.dict()
+    formats = {
+        "json": (lambda d: json.dumps(d).encode("utf-8"), lambda b: json.loads(b)),
+        "binary": (history_codec.encode, history_codec.decode),
+    }
+    print(f"{'format':<8} {'bytes/entry':>12} {'encode':>10} {'decode':>10} {'decode+model':>13}")
+    for name, (encode, decode) in formats.items():
+        encoded = encode(data)
+        encode_time = measure(lambda: encode(data), repeat)
+        decode_time = measure(lambda: decode(encoded), repeat)
+        model_time = measure(lambda: NodeHistory.parse_obj(decode(encoded)), repeat)
+        print(
+            f"{name:<8} {len(encoded) / entries:>12.1f} {encode_time / entries * 1e6:>8.2f}us "
+            f"{decode_time / entries * 1e6:>8.2f}us {model_time / entries * 1e6:>11.2f}us"
+        )
+
+
+@cli.command()
+@click.option("--rows", default=100000, help="Stored histories")
+@click.option("--entries", default=20, help="Entries per history")
+@click.option("--repeat", default=3)
+def load(rows, entries, repeat):
+    """
+    Time to build the histories of all stored rows, as a sync cycle does,
+    with and without validation.
+    """
+    template = history_codec.encode(create_history(entries).dict())
+    stored = [history_codec.decode(template) for _ in range(rows)]
+    validated = measure(lambda: [NodeHistory.parse_obj(d) for d in stored], repeat)
+    trusted = measure(lambda: [NodeHistory.parse_trusted(d) for d in stored], repeat)
+    print(f"{'parse_obj':<14} {validated:8.3f}s per cycle {validated / rows / entries * 1e6:8.2f}us per entry")
+    print(f"{'parse_trusted':<14} {trusted:8.3f}s per cycle {trusted / rows / entries * 1e6:8.2f}us per entry")
+    print(f"saved {validated - trusted:.3f}s per cycle, {validated / trusted:.1f}x")
+
+
+if __name__ == "__main__":
+    cli()
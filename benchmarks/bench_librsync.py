@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+import ctypes
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+
+import librsync
+from librsync import (
+    RS_BLOCKED,
+    RS_DONE,
+    RS_JOB_BLOCKSIZE,
+    Buffer,
+    CharPtr,
+    LibrsyncError,
+    _librsync,
+    char_ptr_from_bytes,
+)
+
+
+MB = 1024 ** 2
+
+
+def _execute_seek(job, f, o=None):
+    """
+    The job driver librsync used before the carry-over buffer: a new input
+    block and Buffer per iteration, output copied through `out.raw` and
+    unconsumed input re-read by seeking back.
+    """
+    out = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+    while True:
+        block = f.read(RS_JOB_BLOCKSIZE)
+        buff = Buffer()
+        buff.next_in = char_ptr_from_bytes(block)
+        buff.avail_in = ctypes.c_size_t(len(block))
+        buff.eof_in = ctypes.c_int(not block)
+        buff.next_out = ctypes.cast(out, CharPtr)
+        buff.avail_out = ctypes.c_size_t(RS_JOB_BLOCKSIZE)
+        result = _librsync.rs_job_iter(job, ctypes.byref(buff))
+        if o:
+            o.write(out.raw[: RS_JOB_BLOCKSIZE - buff.avail_out])
+        if result == RS_DONE:
+            break
+        elif result != RS_BLOCKED:
+            raise LibrsyncError(result)
+        if buff.avail_in > 0:
+            f.seek(f.tell() - buff.avail_in)
+    return o
+
+
+class NullWriter:
+    def write(self, data):
+        return len(data)
+
+
+def create_files(folder: Path, size: int):
+    base = os.urandom(size)
+    chunk = size // 100
+    new = b"".join(
+        base[i:i + chunk] if i % (chunk * 10) else os.urandom(chunk)
+        for i in range(0, size, chunk)
+    )
+    paths = {name: folder / name for name in ("base", "new", "sig", "delta")}
+    paths["base"].write_bytes(base)
+    paths["new"].write_bytes(new)
+    librsync.signature_from_paths(str(paths["base"]), str(paths["sig"]))
+    librsync.delta_from_paths(str(paths["sig"]), str(paths["new"]), str(paths["delta"]))
+    return {name: os.fspath(path) for name, path in paths.items()}
+
+
+@contextmanager
+def timer(label: str, size: int):
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed:8.3f}s {size / MB / elapsed:10.1f} MB/s")
+
+
+def run_delta(driver, paths):
+    with librsync.loadsignature_from_paths(paths["sig"]) as sig:
+        job = _librsync.rs_delta_begin(sig)
+        try:
+            with open(paths["new"], "rb") as f:
+                driver(job, f, NullWriter())
+        finally:
+            _librsync.rs_job_free(job)
+
+
+def run_patch(driver, paths):
+    with open(paths["base"], "rb") as base:
+        @librsync.patch_callback
+        def read_cb(_, pos, length, buff):
+            base.seek(pos)
+            block = base.read(length.contents.value)
+            ctypes.memmove(buff.contents, block, len(block))
+            length.contents.value = len(block)
+            return RS_DONE
+
+        job = _librsync.rs_patch_begin(read_cb, None)
+        try:
+            with open(paths["delta"], "rb") as d:
+                driver(job, d, NullWriter())
+        finally:
+            _librsync.rs_job_free(job)
+
+
+SIGNATURE_PARAMS = {
+    "md4 2048": dict(
+        block_len=librsync.RS_DEFAULT_BLOCK_LEN,
+        strong_len=librsync.RS_DEFAULT_STRONG_LEN,
+        magic=librsync.RS_MD4_SIG_MAGIC,
+    ),
+    "rk-md4": dict(magic=librsync.RS_RK_MD4_SIG_MAGIC),
+    "rk-blake2": dict(magic=librsync.RS_RK_BLAKE2_SIG_MAGIC),
+}
+
+
+def peak_rss() -> int:
+    # ru_maxrss survives exec, so a spawned child would report its parent's
+    # peak. VmHWM belongs to the current address space.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_signature(paths, kwargs):
+    """
+    Runs in a fresh process, so the peak RSS belongs to this measurement only.
+    """
+    start = time.perf_counter()
+    librsync.signature_from_paths(paths["base"], paths["sig"], **kwargs)
+    sig_time = time.perf_counter() - start
+    start = time.perf_counter()
+    librsync.delta_from_paths(paths["sig"], paths["new"], paths["delta"])
+    delta_time = time.perf_counter() - start
+    return {
+        "args": librsync.read_signature_args(paths["sig"]),
+        "sig_size": Path(paths["sig"]).stat().st_size,
+        "delta_size": Path(paths["delta"]).stat().st_size,
+        "sig_time": sig_time,
+        "delta_time": delta_time,
+        "rss": peak_rss(),
+    }
+
+
+class Unmapped:
+    """
+    Seekable stream without a file descriptor, so patch falls back to reading.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.f.seek(offset, whence)
+
+
+class Pipe:
+    """
+    Non seekable, in memory stream.
+    """
+
+    def __init__(self, path):
+        self.data = BytesIO(Path(path).read_bytes())
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+    def seekable(self):
+        return False
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--size", default=64, help="File size in MB")
+@click.option("--repeat", default=3)
+def job_driver(size, repeat):
+    """
+    Compare the carry-over job driver with the seek based one.
+    """
+    with TemporaryDirectory() as folder:
+        paths = create_files(Path(folder), size * MB)
+        for _ in range(repeat):
+            with timer("delta, seek driver", size * MB):
+                run_delta(_execute_seek, paths)
+            with timer("delta, carry-over driver", size * MB):
+                run_delta(librsync._execute, paths)
+            with timer("patch, seek driver", size * MB):
+                run_patch(_execute_seek, paths)
+            with timer("patch, carry-over driver", size * MB):
+                run_patch(librsync._execute, paths)
+            with timer("patch, carry-over driver, pipe", size * MB):
+                run_patch(lambda job, _, o: librsync._execute(job, Pipe(paths["delta"]), o), paths)
+
+
+@cli.command()
+@click.option("--size", default=256, help="File size in MB")
+@click.option("--repeat", default=3)
+def patch(size, repeat):
+    """
+    Patch throughput with the basis read through read_cb and through mmap.
+    """
+    with TemporaryDirectory() as folder:
+        paths = create_files(Path(folder), size * MB)
+        for _ in range(repeat):
+            with open(paths["base"], "rb") as base, open(paths["delta"], "rb") as d:
+                with timer("patch, read callback", size * MB):
+                    librsync.patch(Unmapped(base), d, NullWriter())
+            with open(paths["base"], "rb") as base, open(paths["delta"], "rb") as d:
+                with timer("patch, mmap", size * MB):
+                    librsync.patch(base, d, NullWriter())
+
+
+@cli.command()
+@click.option("--sizes", default="16,128,1024", help="Comma separated file sizes in MB")
+def signature_args(sizes):
+    """
+    Signature size, delta size and peak RSS for the fixed MD4 parameters and
+    the size based ones.
+    """
+    context = multiprocessing.get_context("spawn")
+    print(
+        f"{'size':>8} {'params':<10} {'block':>8} {'strong':>6} {'sig':>10} {'delta':>10} "
+        f"{'sig time':>9} {'delta time':>10} {'peak RSS':>10}"
+    )
+    for size in map(int, sizes.split(",")):
+        with TemporaryDirectory() as folder:
+            paths = create_files(Path(folder), size * MB)
+            for name, kwargs in SIGNATURE_PARAMS.items():
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    r = pool.submit(measure_signature, paths, kwargs).result()
+                print(
+                    f"{size:>6}MB {name:<10} {r['args'].block_len:>8} "
+                    f"{r['args'].strong_len:>6} {r['sig_size'] / MB:>8.2f}MB {r['delta_size'] / MB:>8.2f}MB "
+                    f"{r['sig_time']:>8.2f}s {r['delta_time']:>9.2f}s {r['rss'] / MB:>8.1f}MB"
+                )
+
+
+if __name__ == "__main__":
+    cli()
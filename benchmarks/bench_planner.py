@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import hashlib
+import random
+import time
+from array import array
+from itertools import chain, groupby
+from pathlib import Path
+from types import SimpleNamespace
+
+import click
+
+from s3rsync.history import RemoteNodeHistory
+from s3rsync.models import RootFolder, StoredNodeHistory
+from s3rsync.node import LocalNode
+from s3rsync.planner import plan_actions
+from s3rsync.sync_logic import handle_node
+from s3rsync.tree_snapshot import TreeSnapshot
+from s3rsync.util.row import Row
+
+
+ROOT = Path("/local")
+
+
+class NodeRow(Row):
+    value_types = [RemoteNodeHistory, LocalNode, StoredNodeHistory]
+
+
+def create_nodes(count: int, changed: float):
+    """
+    A tree of `count` files, all synced before, with a `changed` fraction
+    of them edited locally, as many edited remotely and as many new ones on
+    each side.
+    """
+    paths = [f"folder{i % 1000}/file{i}.vwx" for i in range(count)]
+    entries = sorted((hashlib.md5(p.encode("utf-8")).digest(), p) for p in paths)
+    keys = bytearray()
+    sizes, modified_times, created_times, inodes = array("q"), array("q"), array("q"), array("q")
+    path_offsets = array("Q", [0])
+    blob = bytearray()
+    root_folder = RootFolder(id=1, path=str(ROOT))
+    remote_history, stored_history = [], []
+    for digest, path in entries:
+        key = digest.hex()
+        kind = int(random.random() / changed)
+        local_edit, remote_edit, local_new, remote_new = (kind == k for k in range(4))
+        if not remote_new:
+            keys += digest
+            sizes.append(1024)
+            modified_times.append(1001 if local_edit else 1000)
+            created_times.append(1000)
+            inodes.append(len(inodes) + 1)
+            blob += path.encode("utf-8")
+            path_offsets.append(len(blob))
+        if not local_new:
+            history = SimpleNamespace(deleted=False, etag="etag")
+            remote_history.append(RemoteNodeHistory(key=key, etag="new" if remote_edit else "old", history=history))
+        if not local_new and not remote_new:
+            stored_history.append(StoredNodeHistory(
+                key=key, root_folder=root_folder, remote_history_etag="old",
+                local_modified_time=1000, local_created_time=1000,
+            ))
+    snapshot = TreeSnapshot(
+        bytes(keys), sizes, modified_times, created_times, inodes, path_offsets, bytes(blob)
+    )
+    return snapshot, remote_history, stored_history
+
+
+def plan_rows(snapshot, remote_history, stored_history):
+    # Planning as it was done before the snapshot and the planner.
+    local_nodes = [snapshot.node(i, ROOT) for i in range(len(snapshot))]
+    all_nodes = list(chain(remote_history, local_nodes, stored_history))
+    all_nodes.sort(key=lambda n: n.key)
+    rows = [NodeRow.create(key, nodes) for key, nodes in groupby(all_nodes, key=lambda n: n.key)]
+    actions = [handle_node(remote, local, stored) for _, remote, local, stored in rows]
+    return [a for a in actions if a.name != "nop"]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--nodes", default=1000000)
+@click.option("--changed", default=0.01, help="Fraction of nodes changed on each side")
+def plan(nodes, changed):
+    """
+    Time to plan a sync cycle, per-row `handle_node` against the vectorized
+    planner.
+    """
+    snapshot, remote_history, stored_history = create_nodes(nodes, changed)
+    results = {}
+    for name, planner in (("per-row", plan_rows), ("vectorized", plan_actions)):
+        start = time.perf_counter()
+        if name == "per-row":
+            actions = planner(snapshot, remote_history, stored_history)
+        else:
+            actions = planner(ROOT, snapshot, remote_history, stored_history)
+        results[name] = time.perf_counter() - start
+        print(f"{name:<11} {results[name]:8.3f}s {len(actions):>8} actions")
+    print(f"{results['per-row'] / results['vectorized']:.1f}x")
+
+
+if __name__ == "__main__":
+    cli()
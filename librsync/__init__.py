@@ -1,11 +1,16 @@
 import ctypes
 import ctypes.util
 from contextlib import contextmanager
+import io
+import math
+import mmap
 import os
+import struct
 import sys
 import tempfile
 from functools import wraps
 from pathlib import Path
+from typing import NamedTuple, Optional
 
 from librsync.util import force_bytes, resource_manager
 
@@ -61,7 +66,16 @@ RS_BLOCKED = 1
 RS_JOB_BLOCKSIZE = 65536
 RS_DEFAULT_STRONG_LEN = 8
 RS_DEFAULT_BLOCK_LEN = 2048
+RS_MAX_BLOCK_LEN = 1024 ** 2
+RS_MD4_SUM_LENGTH = 16
+RS_BLAKE2_SUM_LENGTH = 32
+
 RS_MD4_SIG_MAGIC = 0x72730136
+RS_BLAKE2_SIG_MAGIC = 0x72730137
+RS_RK_MD4_SIG_MAGIC = 0x72730146
+RS_RK_BLAKE2_SIG_MAGIC = 0x72730147
+# BLAKE2 strong sums are several times slower than MD4 with the bundled builds.
+RS_DEFAULT_SIG_MAGIC = RS_RK_MD4_SIG_MAGIC
 
 
 CharPtr = ctypes.POINTER(ctypes.c_char)
@@ -89,11 +103,13 @@ class Buffer(ctypes.Structure):
 _librsync.rs_strerror.restype = ctypes.c_char_p
 _librsync.rs_strerror.argtypes = (ctypes.c_int,)
 
-# rs_job_t *rs_sig_begin(size_t new_block_len, size_t strong_sum_len);
+# rs_job_t *rs_sig_begin(size_t new_block_len, size_t strong_sum_len,
+#                        rs_magic_number sig_magic);
 _librsync.rs_sig_begin.restype = ctypes.c_void_p
 _librsync.rs_sig_begin.argtypes = (
     ctypes.c_size_t,
     ctypes.c_size_t,
+    ctypes.c_int,
 )
 
 # rs_job_t *rs_loadsig_begin(rs_signature_t **);
@@ -138,8 +154,8 @@ _librsync.rs_job_free.argtypes = (ctypes.c_void_p,)
 patch_callback = ctypes.CFUNCTYPE(
     ctypes.c_int,
     ctypes.c_void_p,
-    # TODO: we need platform independant intmax_t
-    ctypes.c_longlong if sys.platform == "win32" else ctypes.c_int,
+    # rs_long_t is intmax_t, which is 64 bits wide on all supported platforms.
+    ctypes.c_longlong,
     ctypes.POINTER(ctypes.c_size_t),
     ctypes.POINTER(ctypes.c_void_p),
 )
@@ -269,37 +285,60 @@ def seekable(f):
     return wrapper
 
 
+def _read_into(f, view) -> int:
+    readinto = getattr(f, "readinto", None)
+    if callable(readinto):
+        return readinto(view) or 0
+    block = f.read(len(view))
+    view[:len(block)] = block
+    return len(block)
+
+
 def _execute(job, f, o=None):
     """
     Executes a librsync "job" by reading bytes from `f` and writing results to
     `o` if provided. If `o` is omitted, the output is ignored.
+
+    Input librsync did not consume is carried over to the next iteration, so
+    `f` does not have to be seekable. `o.write` receives a view of the reused
+    output buffer and must not keep a reference to it after returning.
     """
-    # Re-use the same buffer for output, we will read from it after each
-    # iteration.
-    out = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+    # Both buffers, and the rs_buffers_t pointing into them, are allocated once
+    # and re-used for every iteration.
+    in_buffer = bytearray(RS_JOB_BLOCKSIZE)
+    in_view = memoryview(in_buffer)
+    in_address = ctypes.addressof(ctypes.c_char.from_buffer(in_buffer))
+    out_buffer = bytearray(RS_JOB_BLOCKSIZE)
+    out_view = memoryview(out_buffer)
+    out_address = ctypes.addressof(ctypes.c_char.from_buffer(out_buffer))
+
+    buff = Buffer()
+    pending = 0
+    eof = False
     while True:
-        block = f.read(RS_JOB_BLOCKSIZE)
-        buff = Buffer()
+        if not eof and pending < RS_JOB_BLOCKSIZE:
+            read = _read_into(f, in_view[pending:])
+            eof = read == 0
+            pending += read
         # provide the data block via input buffer.
-        buff.next_in = char_ptr_from_bytes(block)
-        buff.avail_in = ctypes.c_size_t(len(block))
-        buff.eof_in = ctypes.c_int(not block)
+        buff.next_in = ctypes.cast(in_address, CharPtr)
+        buff.avail_in = pending
+        buff.eof_in = eof
         # Set up our buffer for output.
-        buff.next_out = ctypes.cast(out, CharPtr)
-        buff.avail_out = ctypes.c_size_t(RS_JOB_BLOCKSIZE)
+        buff.next_out = ctypes.cast(out_address, CharPtr)
+        buff.avail_out = RS_JOB_BLOCKSIZE
         result = _librsync.rs_job_iter(job, ctypes.byref(buff))
         if o:
-            o.write(out.raw[: RS_JOB_BLOCKSIZE - buff.avail_out])
+            o.write(out_view[: RS_JOB_BLOCKSIZE - buff.avail_out])
         if result == RS_DONE:
             break
         elif result != RS_BLOCKED:
             raise LibrsyncError(result)
-        if buff.avail_in > 0:
-            # There is data left in the input buffer, librsync did not consume
-            # all of it. Rewind the file a bit so we include that data in our
-            # next read. It would be better to simply tack data to the end of
-            # this buffer, but that is very difficult in Python.
-            f.seek(f.tell() - buff.avail_in)
+        if 0 < buff.avail_in < pending:
+            # librsync did not consume all the input, move the leftover to the
+            # front of the buffer and append the next read to it.
+            ctypes.memmove(in_address, in_address + pending - buff.avail_in, buff.avail_in)
+        pending = buff.avail_in
     if o and callable(getattr(o, "seek", None)):
         # As a matter of convenience, rewind the output file.
         o.seek(0)
@@ -311,17 +350,66 @@ def debug(level=syslog.LOG_DEBUG):
     _librsync.rs_trace_set_level(level)
 
 
+class SignatureArgs(NamedTuple):
+    magic: int
+    block_len: int
+    strong_len: int
+
+
+def signature_args(file_size: int, magic: int = RS_DEFAULT_SIG_MAGIC) -> SignatureArgs:
+    """
+    Signature parameters for a basis of `file_size` bytes. The block length
+    grows with the square root of the size, so the number of blocks, and with
+    it the memory and time needed to load the signature, grows only with the
+    square root as well. The strong sum is made long enough to keep the chance
+    of a false block match negligible for that many blocks.
+    """
+    block_len = int(math.sqrt(file_size))
+    block_len = (block_len + 127) // 128 * 128
+    block_len = min(max(block_len, RS_DEFAULT_BLOCK_LEN), RS_MAX_BLOCK_LEN)
+
+    blocks = file_size // block_len + 1
+    bits = math.log2(file_size + (1 << 24)) + math.log2(blocks) + 24
+    max_strong_len = RS_BLAKE2_SUM_LENGTH if magic & 0x0f == 0x07 else RS_MD4_SUM_LENGTH
+    strong_len = min(max(math.ceil(bits / 8), RS_DEFAULT_STRONG_LEN), max_strong_len)
+    return SignatureArgs(magic=magic, block_len=block_len, strong_len=strong_len)
+
+
+SIG_MAGICS = (RS_MD4_SIG_MAGIC, RS_BLAKE2_SIG_MAGIC, RS_RK_MD4_SIG_MAGIC, RS_RK_BLAKE2_SIG_MAGIC)
+
+
+def read_signature_args(sig_path: str) -> Optional[SignatureArgs]:
+    """
+    Every signature starts with its magic, block length and strong sum length,
+    so signatures made with any parameters can be loaded for a delta. None if
+    the header is not one librsync can load.
+    """
+    with open(sig_path, "rb") as f:
+        header = f.read(12)
+    if len(header) < 12:
+        return None
+    args = SignatureArgs(*struct.unpack(">III", header))
+    max_strong_len = RS_BLAKE2_SUM_LENGTH if args.magic & 0x0f == 0x07 else RS_MD4_SUM_LENGTH
+    if (
+        args.magic not in SIG_MAGICS
+        or not 0 < args.block_len <= RS_MAX_BLOCK_LEN
+        or not 0 < args.strong_len <= max_strong_len
+    ):
+        return None
+    return args
+
+
 @seekable
-def signature(f, s=None, block_size=RS_DEFAULT_BLOCK_LEN):
+def signature(f, s=None, block_size=RS_DEFAULT_BLOCK_LEN, magic=RS_DEFAULT_SIG_MAGIC):
     """
     Generate a signature for the file `f`. The signature will be written to `s`.
     If `s` is omitted, a temporary file will be used. This function returns the
     signature file `s`. You can specify the size of the blocks using the
-    optional `block_size` parameter.
+    optional `block_size` parameter and the format using `magic`.
     """
     if s is None:
         s = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOL, mode="wb")
-    job = _librsync.rs_sig_begin(block_size, RS_DEFAULT_STRONG_LEN)
+    job = _librsync.rs_sig_begin(block_size, RS_DEFAULT_STRONG_LEN, magic)
     try:
         _execute(job, f, s)
     finally:
@@ -368,65 +456,143 @@ def patch(f, d, o=None):
     if o is None:
         o = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOL, mode="wb")
 
+    with _basis_callback(f) as read_cb:
+        job = _librsync.rs_patch_begin(read_cb, None)
+        try:
+            _execute(job, d, o)
+        finally:
+            _librsync.rs_job_free(job)
+    return o
+
+
+def _map_file(f):
+    """
+    Map the file behind `f` in memory. Returns None for streams which are not
+    backed by a real file or can not be mapped.
+    """
+    if isinstance(f, tempfile.SpooledTemporaryFile):
+        # fileno() would roll it over to disk.
+        return None
+    try:
+        fileno = f.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    try:
+        # ACCESS_COPY gives a writable buffer, which ctypes requires, without
+        # ever touching the file.
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_COPY)
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def _basis_callback(f):
+    """
+    Yields the copy callback librsync uses to read the basis `f`. If `f` is a
+    real file it is mapped in memory and librsync gets pointers into the
+    mapping, other streams are read into librsync's buffer.
+    """
+    mapping = _map_file(f)
+    if mapping is None:
+
+        @patch_callback
+        def read_cb(_, pos, length, buff):
+            f.seek(pos)
+            block = f.read(length.contents.value)
+            if block:
+                ctypes.memmove(buff.contents, block, len(block))
+                length.contents.value = len(block)
+            else:
+                length.contents.value = 0
+            return RS_DONE
+
+        yield read_cb
+        return
+
+    size = len(mapping)
+    anchor = ctypes.c_char.from_buffer(mapping)
+    address = ctypes.addressof(anchor)
+
     @patch_callback
-    def read_cb(_, pos, length, buff):
-        f.seek(pos)
-        block = f.read(length.contents.value)
-        if block:
-            ctypes.memmove(buff.contents, block, len(block))
-            length.contents.value = len(block)
-        else:
-            length.contents.value = 0
+    def mmap_cb(_, pos, length, buff):
+        length.contents.value = max(min(length.contents.value, size - pos), 0)
+        buff[0] = address + min(pos, size)
         return RS_DONE
 
-    job = _librsync.rs_patch_begin(read_cb, None)
     try:
-        _execute(job, d, o)
+        yield mmap_cb
     finally:
-        _librsync.rs_job_free(job)
-    return o
+        del anchor
+        mapping.close()
 
 
 def signature_from_paths(
     base_path: str, sig_path: str,
-    block_len: int = RS_DEFAULT_BLOCK_LEN,
-    strong_len: int = RS_DEFAULT_STRONG_LEN
+    block_len: Optional[int] = None,
+    strong_len: Optional[int] = None,
+    magic: int = RS_DEFAULT_SIG_MAGIC
 ) -> bool:
+    """
+    Block and strong sum lengths which are not given are chosen from the size
+    of the basis, see `signature_args`.
+    """
+    try:
+        args = signature_args(os.path.getsize(base_path), magic)
+    except OSError:
+        return False
     with resource_manager() as rm:
         base_fp = rm.add(fopen(base_path, "rb"), fclose)
         sig_fp = rm.add(fopen(sig_path, "wb"), fclose)
         return rm.ok() and _librsync.rs_sig_file(
-            base_fp, sig_fp, block_len, strong_len, RS_MD4_SIG_MAGIC, None
+            base_fp, sig_fp, block_len or args.block_len, strong_len or args.strong_len, magic, None
         ) == 0
 
 
-@contextmanager
-def loadsignature_from_paths(sig_path: str) -> ctypes.c_void_p:
+def load_signature(sig_path: str) -> Optional[ctypes.c_void_p]:
+    """
+    Load the signature and build its hash table. The result is ready for
+    `delta_from_signature` and must be released with `free_signature`.
+    None if it cannot be loaded, like a signature of an unknown format.
+    """
+    try:
+        if read_signature_args(sig_path) is None:
+            return None
+    except OSError:
+        return None
     with resource_manager() as rm:
         sig_fp = rm.add(fopen(sig_path, "rb"), fclose)
         if rm.ok():
             sig = ctypes.c_void_p()
             if _librsync.rs_loadsig_file(sig_fp, ctypes.byref(sig), None) == 0:
-                try:
-                    _librsync.rs_build_hash_table(sig)
-                    yield sig
-                finally:
-                    _librsync.rs_free_sumset(sig)
-            else:
-                yield None
-        else:
-            yield None
+                _librsync.rs_build_hash_table(sig)
+                return sig
+        return None
 
 
-def delta_from_paths(sig_path: str, new_path: str, delta_path: str) -> bool:
+def free_signature(sig: ctypes.c_void_p) -> None:
+    _librsync.rs_free_sumset(sig)
+
+
+@contextmanager
+def loadsignature_from_paths(sig_path: str) -> ctypes.c_void_p:
+    sig = load_signature(sig_path)
+    try:
+        yield sig
+    finally:
+        if sig is not None:
+            free_signature(sig)
+
+
+def delta_from_signature(sig: ctypes.c_void_p, new_path: str, delta_path: str) -> bool:
     with resource_manager() as rm:
         new_fp = rm.add(fopen(new_path, "rb"), fclose)
         delta_fp = rm.add(fopen(delta_path, "wb"), fclose)
-        if rm.ok():
-            with loadsignature_from_paths(sig_path) as sig:
-                return sig and _librsync.rs_delta_file(sig, new_fp, delta_fp, None) == 0
+        return rm.ok() and _librsync.rs_delta_file(sig, new_fp, delta_fp, None) == 0
 
-        return False
+
+def delta_from_paths(sig_path: str, new_path: str, delta_path: str) -> bool:
+    with loadsignature_from_paths(sig_path) as sig:
+        return sig is not None and delta_from_signature(sig, new_path, delta_path)
 
 
 def patch_from_paths(base_path: str, delta_path: str, result_path: str) -> bool:
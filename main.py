@@ -1,6 +1,5 @@
 import logging
 
-from pathlib import Path
 import click
 from dynaconf import settings  # type: ignore
 import peewee
@@ -9,7 +8,7 @@ from s3rsync.session import Session
 from s3rsync.sync import SyncWorker
 from s3rsync.local_db import open_database
 from s3rsync.util.misc import all_subclasses
-from s3rsync import models  # NOQA
+from s3rsync.models import migrate_schema
 
 
 logging.basicConfig(level=logging.INFO)
@@ -20,15 +19,19 @@ logging.basicConfig(level=logging.INFO)
 @click.argument("root_folder")
 @click.option("--once/--no-once", default=False)
 def main(s3_prefix, root_folder, once):
-    db_exists = Path(settings.LOCAL_DB).exists()
     with open_database(settings.LOCAL_DB) as db:
-        if not db_exists:
-            db.create_tables(all_subclasses(peewee.Model))
-        worker = SyncWorker(Session.create(s3_prefix, root_folder))
-        if once:
-            worker.run_once()
-        else:
-            worker.run()
+        # Only creates the tables which are missing.
+        migrate_schema(db)
+        db.create_tables(all_subclasses(peewee.Model))
+        session = Session.create(s3_prefix, root_folder)
+        worker = SyncWorker(session)
+        try:
+            if once:
+                worker.run_once()
+            else:
+                worker.run()
+        finally:
+            session.cpu_pool.shutdown()
 
 
 if __name__ == "__main__":
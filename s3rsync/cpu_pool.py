@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import itertools
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock
+from typing import Dict, List, Optional
+
+from librsync import delta_from_signature, patch_from_paths, signature_from_paths
+
+from s3rsync.signature_store import LoadedSignatureCache
+
+
+# Loaded signatures of the worker process, see `_init_worker`.
+_loaded_signatures: Optional[LoadedSignatureCache] = None
+
+
+def _init_worker(cache_count: int, cache_size: int) -> None:
+    global _loaded_signatures
+    _loaded_signatures = LoadedSignatureCache(max_count=cache_count, max_size=cache_size)
+
+
+def _delta(sig_path: str, sig_key: str, new_path: str, delta_path: str) -> bool:
+    with _loaded_signatures.use(sig_key, sig_path) as sig:  # type: ignore
+        return sig is not None and delta_from_signature(sig, new_path, delta_path)
+
+
+def _cache_stats() -> Dict[str, int]:
+    return _loaded_signatures.stats  # type: ignore
+
+
+class CPUPool:
+    """
+    Runs librsync signature, delta and patch jobs in worker processes, one per
+    core by default, so they neither hold the GIL of the sync process nor
+    queue behind each other. Only paths go to the workers and only the success
+    flag comes back, the data stays on disk.
+
+    Every worker keeps its own cache of loaded signatures, keyed by the entry
+    key of the signature, and deltas go to the worker picked by their key, so
+    repeated deltas against the same basis find it loaded and each signature
+    is loaded by one worker only. Other jobs go to the workers in turn.
+    """
+
+    def __init__(self, workers: int = 0, cache_count: int = 16, cache_size: int = 256 * 1024 ** 2):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_count = cache_count
+        self.cache_size = cache_size
+        self.executors: List[ProcessPoolExecutor] = []
+        self.turn = itertools.count()
+        self.lock = Lock()
+
+    def submit_signature(self, base_path: str, sig_path: str) -> Future:
+        return self._submit(next(self.turn), signature_from_paths, base_path, sig_path)
+
+    def submit_delta(self, sig_path: str, sig_key: str, new_path: str, delta_path: str) -> Future:
+        return self._submit(zlib.crc32(sig_key.encode("utf-8")), _delta, sig_path, sig_key, new_path, delta_path)
+
+    def submit_patch(self, base_path: str, delta_path: str, result_path: str) -> Future:
+        return self._submit(next(self.turn), patch_from_paths, base_path, delta_path, result_path)
+
+    def signature(self, base_path: str, sig_path: str) -> bool:
+        return self.submit_signature(base_path, sig_path).result()
+
+    def delta(self, sig_path: str, sig_key: str, new_path: str, delta_path: str) -> bool:
+        return self.submit_delta(sig_path, sig_key, new_path, delta_path).result()
+
+    def patch(self, base_path: str, delta_path: str, result_path: str) -> bool:
+        return self.submit_patch(base_path, delta_path, result_path).result()
+
+    @property
+    def cache_stats(self) -> Dict[str, int]:
+        """
+        The loaded signature caches of all workers, summed.
+        """
+        total: Dict[str, int] = {}
+        for shard in range(self.workers):
+            for name, value in self._submit(shard, _cache_stats).result().items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+    def shutdown(self) -> None:
+        with self.lock:
+            executors, self.executors = self.executors, []
+        for executor in executors:
+            executor.shutdown()
+
+    def _submit(self, shard: int, fn, *args) -> Future:
+        with self.lock:
+            if not self.executors:
+                # Started on first use, so sessions which never run a job do
+                # not spawn processes. That is once the pipeline threads run,
+                # which forking would copy mid-flight along with their locks.
+                context = _mp_context()
+                self.executors = [
+                    ProcessPoolExecutor(
+                        max_workers=1,
+                        mp_context=context,
+                        initializer=_init_worker,
+                        initargs=(self.cache_count, self.cache_size),
+                    )
+                    for _ in range(self.workers)
+                ]
+            return self.executors[shard % self.workers].submit(fn, *args)
+
+
+def _mp_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
@@ -1,2 +1,14 @@
 class MissingNodeHistoryEntryError(Exception):
     pass
+
+
+class SourceChangedError(Exception):
+    pass
+
+
+class ChecksumMismatchError(Exception):
+    pass
+
+
+class RsyncError(Exception):
+    pass
@@ -1,21 +1,52 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+import hashlib
+import logging
+import os
 from pathlib import Path
 import shutil
+import time
+from typing import Dict, List
 
+from botocore.exceptions import ClientError  # type: ignore
+from dynaconf import settings  # type: ignore
+
+from s3rsync.exceptions import ChecksumMismatchError, SourceChangedError
+from s3rsync.models import MultipartUpload, RootFolder
 from s3rsync.session import Session
 from s3rsync.node import LocalNode
-from s3rsync.util.file import create_temp_file
-from s3rsync import s3util
+from s3rsync.util.file import FileSlice, create_temp_file
+from s3rsync.stream.http import StreamingBodySource
+from s3rsync import local_db, s3util
+
+
+# S3 allows at most this many parts in one upload.
+MAX_PARTS = 10000
+# Seconds the clock of S3 may be behind ours.
+CLOCK_SKEW = 300
 
 
-def download_to_root(session: Session, path: str, version: str = None) -> Path:
+def download_to_root(
+    session: Session, path: str, version: str = None, size: int = None, etag: str = None, source_path: str = None
+) -> Path:
+    """
+    Download `path`, or the object of another node at `source_path`, to
+    `path` under the root folder.
+    """
     with create_temp_file() as tmp_path:
-        s3util.download_file(
-            session.s3_client,
-            session.storage_bucket,
-            f"{session.s3_prefix}/{path}",
-            tmp_path,
-            version=version
-        )
+        s3_path = f"{session.s3_prefix}/{source_path or path}"
+        if version and size is not None and size >= settings.RANGED_DOWNLOAD_MIN_SIZE:
+            download_ranges(
+                session, session.storage_bucket, s3_path, version, size, tmp_path, etag=etag
+            )
+        else:
+            s3util.download_file(
+                session.s3_client,
+                session.storage_bucket,
+                s3_path,
+                tmp_path,
+                version=version,
+                size=size
+            )
         local_path = session.root_folder.path / path
         if not local_path.parent.exists():
             local_path.parent.mkdir(parents=True)
@@ -23,6 +54,72 @@ def download_to_root(session: Session, path: str, version: str = None) -> Path:
         return local_path
 
 
+def download_ranges(
+    session: Session,
+    bucket: str,
+    s3_path: str,
+    version: str,
+    size: int,
+    local_path: str,
+    etag: str = None,
+) -> None:
+    """
+    Download `size` bytes of a version in parallel ranges into `local_path`,
+    allocated up front. The MD5 of the content is computed from the ranges
+    as they are received, in offset order, and compared with `etag` if
+    given, so the file is never read back. Ranges which arrive ahead of the
+    next one to hash are held in memory, no new range is started while
+    `max_concurrency` of them are.
+    """
+    profile = s3util.transfer_profile(size)
+    chunk_size = profile.multipart_chunksize
+    with open(local_path, "wb") as f:
+        if hasattr(os, "posix_fallocate") and size:
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+    def download_range(start: int) -> bytes:
+        end = min(start + chunk_size, size) - 1
+        data = s3util.download_range(session.s3_client, bucket, s3_path, start, end, version=version)
+        if len(data) != end - start + 1:
+            raise ChecksumMismatchError(f"{s3_path}: got {len(data)} bytes of range {start}-{end}")
+        with open(local_path, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+        return data
+
+    checksum = hashlib.md5()
+    starts = iter(range(0, size, chunk_size))
+    next_start = 0
+    received: Dict[int, bytes] = {}
+    in_flight: Dict[Future, int] = {}
+    with ThreadPoolExecutor(max_workers=profile.max_concurrency) as executor:
+        try:
+            while True:
+                while len(in_flight) < profile.max_concurrency and len(received) < profile.max_concurrency:
+                    start = next(starts, None)
+                    if start is None:
+                        break
+                    in_flight[executor.submit(download_range, start)] = start
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    received[in_flight.pop(future)] = future.result()
+                while next_start in received:
+                    data = received.pop(next_start)
+                    checksum.update(data)
+                    next_start += len(data)
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    if etag and checksum.hexdigest() != etag:
+        raise ChecksumMismatchError(f"{s3_path}: {checksum.hexdigest()} != {etag}")
+    logging.info("⬇ %s [%.3fMB]", s3_path, size / s3util.MB)
+
+
 def download_metadata(session: Session, key: str, name: str, local_path: str):
     s3util.download_file(
         session.s3_client,
@@ -32,10 +129,32 @@ def download_metadata(session: Session, key: str, name: str, local_path: str):
     )
 
 
+def open_metadata(session: Session, key: str, name: str) -> StreamingBodySource:
+    body = s3util.open_stream(
+        session.s3_client,
+        session.internal_bucket,
+        f"{session.s3_prefix}/{session.sync_metadata_prefix}/entries/{key}/{name}"
+    )
+    return StreamingBodySource(body)
+
+
+def copy_in_root(session: Session, source_path: str, source_version: str, path: str, size: int) -> str:
+    return s3util.copy_file(
+        session.s3_client,
+        session.storage_bucket,
+        f"{session.s3_prefix}/{source_path}",
+        source_version,
+        f"{session.s3_prefix}/{path}",
+        size,
+    )
+
+
 def upload_to_root(session: Session, node: LocalNode):
+    s3_path = f"{session.s3_prefix}/{node.path}"
+    if node.size >= settings.RESUMABLE_UPLOAD_MIN_SIZE:
+        return upload_resumable(session, node.local_fspath, session.storage_bucket, s3_path)
     with create_temp_file() as tmp_path:
         shutil.copyfile(node.local_path, tmp_path)
-        s3_path = f"{session.s3_prefix}/{node.path}"
         s3util.upload_file(
             session.s3_client, tmp_path, session.storage_bucket, s3_path
         )
@@ -43,6 +162,129 @@ def upload_to_root(session: Session, node: LocalNode):
         return obj["VersionId"]
 
 
+def upload_resumable(session: Session, local_path: str, bucket: str, s3_path: str) -> str:
+    """
+    Multipart upload whose progress is kept in `MultipartUpload`, so an
+    interrupted upload of the same unchanged file continues with the missing
+    parts. Uploads straight from `local_path` instead of a copy, and fails
+    with `SourceChangedError` if the file changes before it completes.
+
+    Returns the version id of the uploaded object.
+    """
+    root_folder = RootFolder.for_session(session)
+    stat = os.stat(local_path)
+    upload = MultipartUpload.get_or_none(
+        MultipartUpload.root_folder == root_folder,
+        MultipartUpload.bucket == bucket,
+        MultipartUpload.s3_path == s3_path,
+    )
+    if upload is not None and not (upload.upload_id and upload.matches(stat)):
+        logging.info("[UPLOAD] %s changed or was never started, restarting its upload", s3_path)
+        abort_upload(session, upload)
+        upload = None
+    profile = s3util.transfer_profile(stat.st_size)
+    if upload is None:
+        # Recorded before it is created, so an upload is never left on S3
+        # without a row, see `abort_upload`.
+        upload = local_db.writer.write(
+            MultipartUpload.create,
+            root_folder=root_folder,
+            bucket=bucket,
+            s3_path=s3_path,
+            upload_id="",
+            part_size=max(profile.multipart_chunksize, -(-stat.st_size // MAX_PARTS)),
+            parts={},
+            source_size=stat.st_size,
+            source_modified_time=stat.st_mtime_ns,
+            source_inode=stat.st_ino,
+            initiated=int(time.time()),
+        )
+        upload.upload_id = s3util.create_multipart_upload(session.s3_client, bucket, s3_path)
+        local_db.writer.write(upload.save)
+    else:
+        logging.info("[UPLOAD] Resuming %s, %d parts done", s3_path, len(upload.parts))
+
+    parts = {int(n): etag for n, etag in upload.parts.items()}
+    count = max(-(-stat.st_size // upload.part_size), 1)
+    missing = [n for n in range(1, count + 1) if n not in parts]
+    try:
+        _upload_parts(session, local_path, upload, missing, parts, profile.max_concurrency)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "NoSuchUpload":
+            # Aborted by someone else, the next attempt starts over.
+            local_db.writer.write(upload.delete_instance)
+        raise
+
+    if not upload.matches(os.stat(local_path)):
+        abort_upload(session, upload)
+        raise SourceChangedError(local_path)
+    response = s3util.complete_multipart_upload(
+        session.s3_client, bucket, s3_path, upload.upload_id, parts
+    )
+    local_db.writer.write(upload.delete_instance)
+    return response["VersionId"]
+
+
+def _upload_parts(
+    session: Session,
+    local_path: str,
+    upload: MultipartUpload,
+    part_numbers: List[int],
+    parts: Dict[int, str],
+    concurrency: int,
+) -> None:
+    def upload_part(part_number: int) -> str:
+        offset = (part_number - 1) * upload.part_size
+        size = max(min(upload.part_size, upload.source_size - offset), 0)
+        with FileSlice(local_path, offset, size) as body:
+            return s3util.upload_part(
+                session.s3_client, upload.bucket, upload.s3_path, upload.upload_id, part_number, body
+            )
+
+    error = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(upload_part, n): n for n in part_numbers}
+        for future in as_completed(futures):
+            try:
+                parts[futures[future]] = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            # Saved after every part, so a restart loses the parts in flight
+            # only.
+            upload.parts = {str(n): etag for n, etag in parts.items()}
+            upload.progressed = int(time.time())
+            local_db.writer.write(upload.save)
+    if error is not None:
+        raise error
+
+
+def abort_upload(session: Session, upload: MultipartUpload) -> None:
+    if upload.upload_id:
+        s3util.abort_multipart_upload(session.s3_client, upload.bucket, upload.s3_path, upload.upload_id)
+    else:
+        # Stopped between creating the upload and recording its id: the
+        # uploads of the same key since the row was written are ours.
+        for other in s3util.list_multipart_uploads(session.s3_client, upload.bucket, upload.s3_path):
+            if other["Key"] == upload.s3_path and other["Initiated"].timestamp() >= upload.initiated - CLOCK_SKEW:
+                s3util.abort_multipart_upload(session.s3_client, upload.bucket, other["Key"], other["UploadId"])
+    local_db.writer.write(upload.delete_instance)
+
+
+def cleanup_uploads(session: Session, max_age: int) -> None:
+    """
+    Abort our uploads which uploaded no part for `max_age` seconds, so their
+    parts stop taking space. Uploads we have no record of may be another
+    client's in progress and are left alone.
+    """
+    root_folder = RootFolder.for_session(session)
+    threshold = time.time() - max_age
+    for upload in MultipartUpload.select().where(MultipartUpload.root_folder == root_folder):
+        if (upload.progressed or upload.initiated) < threshold:
+            logging.info("[UPLOAD] Aborting stale upload of %s", upload.s3_path)
+            abort_upload(session, upload)
+
+
 def upload_metadata(session: Session, local_path: str, key: str, name: str):
     with create_temp_file() as tmp_path:
         shutil.copyfile(local_path, tmp_path)
@@ -0,0 +1,210 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Set, Tuple, cast
+
+from botocore.exceptions import ClientError  # type: ignore
+from dynaconf import settings  # type: ignore
+
+from s3rsync import s3util
+from s3rsync.history import NodeHistory, NodeHistoryEntry, RemoteNodeHistory
+from s3rsync.session import Session
+from s3rsync.util.timeutil import iso_to_timestamp
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    Entries younger than `max_age` seconds and the last `min_entries` entries
+    of every node are kept, along with the entries needed to rebuild its
+    latest version. Deleted nodes are dropped entirely `max_age` after the
+    delete.
+    """
+
+    max_age: float
+    min_entries: int
+
+
+@dataclass
+class GarbageReport:
+    objects: int = 0
+    bytes: int = 0
+    failed: int = 0
+    by_kind: Dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class Garbage:
+    bucket: str
+    key: str
+    version: str
+    size: int
+    kind: str
+
+
+def retained_entries(
+    history: NodeHistory, policy: RetentionPolicy, now: float
+) -> List[NodeHistoryEntry]:
+    entries = history.entries
+    if not entries:
+        return []
+    if entries[-1].deleted and now - iso_to_timestamp(entries[-1].timestamp) > policy.max_age:
+        return []
+    retained = set(range(max(len(entries) - policy.min_entries, 0), len(entries)))
+    retained.update(
+        i for i, e in enumerate(entries) if now - iso_to_timestamp(e.timestamp) <= policy.max_age
+    )
+    # The latest base and the deltas on top of it, of the version before the
+    # delete for a recently deleted node.
+    for i in range(len(entries) - 1, -1, -1):
+        retained.add(i)
+        if entries[i].has_base:
+            break
+    return [entries[i] for i in sorted(retained)]
+
+
+def find_garbage(
+    session: Session, policy: RetentionPolicy, grace: float, workers: int = 16, dry_run: bool = False
+) -> Iterable[Garbage]:
+    """
+    Objects no longer reachable from any node history under `policy`:
+
+    - entry deltas and signatures of entries which are not retained, or of
+      no history at all
+    - base versions of entries which are not retained, unless a retained
+      entry of another node is a delta against them
+    - old versions of the histories themselves
+    - archive segments no history refers to
+
+    Unless `dry_run`, the entries which are not retained are first removed
+    from the histories and their archives, a history which changed since it
+    was loaded keeps them until the next run. Nothing modified in the last
+    `grace` seconds is garbage, an upload writes its entry and base before
+    the history which refers to them.
+    """
+    client = session.s3_client
+    meta_prefix = f"{session.s3_prefix}/{session.sync_metadata_prefix}"
+    now = time.time()
+
+    history_versions = list(
+        s3util.list_versions(client, session.internal_bucket, f"{meta_prefix}/history/", latest_only=False)
+    )
+    for v in history_versions:
+        if not v["IsLatest"] and now - v["LastModified"].timestamp() > grace:
+            yield Garbage(session.internal_bucket, v["Key"], v["VersionId"], v["Size"], "history")
+
+    def load(version) -> Tuple[RemoteNodeHistory, NodeHistory]:
+        remote_history = RemoteNodeHistory.from_s3_object(version)
+        remote_history.load(session)
+        history = cast(NodeHistory, remote_history.history)
+        archived = remote_history.load_archive(session)
+        return remote_history, history.copy(update={"entries": archived + history.entries})
+
+    def prune(remote_history: RemoteNodeHistory, history: NodeHistory, kept: List[NodeHistoryEntry]) -> bool:
+        if dry_run:
+            return True
+        head = cast(NodeHistory, remote_history.history)
+        archived = history.entries[:len(history.entries) - len(head.entries)]
+        kept_ids = {id(e) for e in kept}
+        # The delete marker of a node dropped entirely stays.
+        head.entries = [e for e in head.entries if id(e) in kept_ids] or head.entries[-1:]
+        head.segments = []
+        archived = [e for e in archived if id(e) in kept_ids]
+        if archived:
+            remote_history.save_segment(session, archived)
+        try:
+            remote_history.save(session, if_unchanged=True)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "PreconditionFailed":
+                raise
+            logging.info("[GC] %s changed, pruned on the next run", history.path)
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = list(executor.map(load, (v for v in history_versions if v["IsLatest"])))
+
+    retained_keys: Set[str] = set()
+    retained_by_history = [retained_entries(history, policy, now) for _, history in loaded]
+    # Bases which retained entries of other nodes are deltas against.
+    bases = {(e.basis_path, e.basis_version) for r in retained_by_history for e in r if e.basis_version}
+    for (remote_history, history), retained in zip(loaded, retained_by_history):
+        # Entries with such a base stay as well, so that it stays listed.
+        retained_ids = {id(e) for e in retained}
+        kept = [
+            e for e in history.entries
+            if id(e) in retained_ids or (e.base_version and (history.path, e.base_version) in bases)
+        ]
+        if len(kept) < len(history.entries) and not prune(remote_history, history, kept):
+            kept = history.entries
+        retained_keys.update(e.key for e in kept)
+        retained_versions = {e.base_version for e in kept}
+        for entry in history.entries:
+            if (
+                entry.base_version
+                and entry.base_version not in retained_versions
+                and now - iso_to_timestamp(entry.timestamp) > grace
+            ):
+                yield Garbage(
+                    session.storage_bucket,
+                    f"{session.s3_prefix}/{history.path}",
+                    entry.base_version,
+                    entry.base_size,
+                    "base",
+                )
+
+    segments = {
+        (r.key, segment) for r, _ in loaded for segment in cast(NodeHistory, r.history).segments
+    }
+    for v in s3util.list_versions(client, session.internal_bucket, f"{meta_prefix}/archive/", latest_only=False):
+        node_key, _, segment = v["Key"][len(meta_prefix) + len("/archive/"):].partition("/")
+        if (node_key, segment) not in segments and now - v["LastModified"].timestamp() > grace:
+            yield Garbage(session.internal_bucket, v["Key"], v["VersionId"], v["Size"], "archive")
+
+    for v in s3util.list_versions(client, session.internal_bucket, f"{meta_prefix}/entries/", latest_only=False):
+        entry_key = v["Key"][len(meta_prefix) + len("/entries/"):].partition("/")[0]
+        if entry_key not in retained_keys and now - v["LastModified"].timestamp() > grace:
+            yield Garbage(session.internal_bucket, v["Key"], v["VersionId"], v["Size"], "entry")
+
+
+def collect_garbage(
+    session: Session,
+    policy: RetentionPolicy,
+    grace: float,
+    dry_run: bool = False,
+    workers: int = 16,
+) -> GarbageReport:
+    """
+    Delete the garbage `find_garbage` finds in parallel batches, throttled
+    keys are retried by `BatchDeleter`. Reachability is computed from scratch
+    on every run, so an interrupted run is finished by running it again.
+    """
+    report = GarbageReport()
+    batches: Dict[str, List[Garbage]] = {}
+    deleter = s3util.BatchDeleter(session.s3_client, max_attempts=settings.S3_MAX_ATTEMPTS)
+
+    def delete(batch: List[Garbage]) -> Tuple[List[Garbage], Set[Tuple[str, str]]]:
+        if dry_run:
+            return batch, set()
+        errors = deleter.send(batch[0].bucket, [{"Key": g.key, "VersionId": g.version} for g in batch])
+        return batch, {(e["Key"], e.get("VersionId")) for e in errors}
+
+    def iter_batches() -> Iterable[List[Garbage]]:
+        for garbage in find_garbage(session, policy, grace, workers=workers, dry_run=dry_run):
+            batch = batches.setdefault(garbage.bucket, [])
+            batch.append(garbage)
+            if len(batch) == s3util.DELETE_BATCH_SIZE:
+                yield batches.pop(garbage.bucket)
+        yield from batches.values()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch, failed in executor.map(delete, iter_batches()):
+            for garbage in batch:
+                if (garbage.key, garbage.version) in failed:
+                    report.failed += 1
+                    continue
+                report.objects += 1
+                report.bytes += garbage.size
+                report.by_kind[garbage.kind] = report.by_kind.get(garbage.kind, 0) + 1
+    return report
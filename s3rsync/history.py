@@ -1,21 +1,33 @@
 from __future__ import annotations
 
-import json
-import os
 from dataclasses import dataclass
 from io import BytesIO
-from typing import List, Tuple, Optional, cast
+from typing import Any, Dict, List, Tuple, Optional, cast
 from uuid import uuid4
 
 from pydantic import BaseModel
 
+from s3rsync import history_codec
 from s3rsync.exceptions import MissingNodeHistoryEntryError
-from s3rsync.s3util import download_to_fd, get_file_metadata, upload_from_fd
+from s3rsync.s3util import download_to_fd, get_file_metadata, put_if_match, upload_from_fd
 from s3rsync.session import Session
 from s3rsync.util.file import hash_path
 from s3rsync.util.timeutil import now_as_iso
 
 
+def _construct(cls, values: Dict[str, Any]) -> Any:
+    """
+    `cls.construct(**values)` without its per field work, for values which
+    have every field.
+    """
+    if values.keys() != cls.__fields__.keys():
+        return cls.construct(**values)
+    model = cls.__new__(cls)
+    object.__setattr__(model, "__dict__", values)
+    object.__setattr__(model, "__fields_set__", set(values))
+    return model
+
+
 class NodeHistoryEntry(BaseModel):
     key: str
     deleted: bool
@@ -25,6 +37,9 @@ class NodeHistoryEntry(BaseModel):
     has_delta: bool
     delta_size: int
     timestamp: str
+    # A delta against the base of another node, see `create_basis_delta`.
+    basis_path: Optional[str] = None
+    basis_version: Optional[str] = None
 
     @classmethod
     def generate_key(cls) -> str:
@@ -69,11 +84,61 @@ class NodeHistoryEntry(BaseModel):
             timestamp=now_as_iso()
         )
 
+    @classmethod
+    def create_basis_delta(
+        cls, key: str, etag: str, delta_size: int, basis_path: str, basis_version: str, basis_size: int
+    ) -> NodeHistoryEntry:
+        """
+        The first entry of a node stored as a delta against the base
+        `basis_version` of the node at `basis_path`, `base_size` is the size
+        of that base.
+        """
+        return cls(
+            key=key,
+            deleted=False,
+            etag=etag,
+            base_version=None,
+            base_size=basis_size,
+            has_delta=True,
+            delta_size=delta_size,
+            timestamp=now_as_iso(),
+            basis_path=basis_path,
+            basis_version=basis_version,
+        )
+
+    @property
+    def has_base(self) -> bool:
+        """
+        Whether the content of the entry is had without the entries before
+        it, from its own base or from the base of another node.
+        """
+        return bool(self.base_version or self.basis_version)
+
 
 class NodeHistory(BaseModel):
+    """
+    The head of a node's history: the entries since the latest base. Older
+    entries are moved by `compact` into immutable archive segments, listed
+    in `segments` oldest first, which only restores need.
+    """
+
     path: str
     key: str
     entries: List[NodeHistoryEntry]
+    segments: List[str] = []
+
+    @classmethod
+    def parse_trusted(cls, data: Dict[str, Any]) -> NodeHistory:
+        """
+        Build a history from a dict we wrote ourselves, like the local DB
+        rows, without validating it. Data from S3 goes through `parse_obj`.
+        """
+        return _construct(cls, {
+            "path": data["path"],
+            "key": data["key"],
+            "entries": [_construct(NodeHistoryEntry, e) for e in data["entries"]],
+            "segments": data.get("segments", []),
+        })
 
     @classmethod
     def create(cls, path: str, entries: List[NodeHistoryEntry] = None) -> NodeHistory:
@@ -90,7 +155,7 @@ class NodeHistory(BaseModel):
             is_absolute = True
             for entry in reversed(self.entries):
                 result.append(entry)
-                if entry.base_version:
+                if entry.has_base:
                     break
         else:
             last_key = other.last.key
@@ -105,16 +170,46 @@ class NodeHistory(BaseModel):
                     break
                 else:
                     delta_size += entry.delta_size
-                    if entry.base_version and not last_base:
+                    if entry.has_base and not last_base:
                         last_base = len(result), entry.base_size
                     if last_base and delta_size > last_base[1]:
                         result = result[:last_base[0] + 1]
                         is_absolute = True
                         break
                 result.append(entry)
+            else:
+                if last_base:
+                    # The stored entry is older than the head, start from
+                    # its base.
+                    result = result[:last_base[0] + 1]
+                    is_absolute = True
 
         return list(reversed(result)), is_absolute
 
+    def needs_rebase(self, delta_size: int, ratio: float) -> bool:
+        """
+        Whether the next version, a delta of `delta_size` bytes, should be
+        stored as a new base instead: when the deltas since the latest base
+        would add up to more than `ratio` times its size. Restores would
+        download more than the whole file otherwise, and the entries before
+        a new base are what `compact` archives.
+        """
+        for entry in reversed(self.entries):
+            delta_size += entry.delta_size
+            if entry.has_base:
+                return delta_size > entry.base_size * ratio
+        return True
+
+    def compact(self) -> List[NodeHistoryEntry]:
+        """
+        Remove the entries before the latest base and return them.
+        """
+        for i in range(len(self.entries) - 1, -1, -1):
+            if self.entries[i].has_base:
+                archived, self.entries = self.entries[:i], self.entries[i:]
+                return archived
+        return []
+
     def add_delete_marker(self) -> None:
         self.entries.append(NodeHistoryEntry.create_deleted())
 
@@ -161,21 +256,64 @@ class RemoteNodeHistory:
         download_to_fd(
             session.s3_client, session.internal_bucket, s3_path, fd,
         )
-        fd.seek(0, os.SEEK_SET)
-        data = json.load(fd)
-        self.history = NodeHistory.parse_obj(data)
+        self.history = NodeHistory.parse_obj(history_codec.decode(fd.getvalue()))
         obj = get_file_metadata(session.s3_client, session.internal_bucket, s3_path)
         self.etag = obj.get("ETag", "").strip('"')
 
-    def save(self, session: Session) -> None:
+    def load_archive(self, session: Session) -> List[NodeHistoryEntry]:
+        """
+        The archived entries, oldest first.
+        """
+        entries: List[NodeHistoryEntry] = []
+        for segment in cast(NodeHistory, self.history).segments:
+            fd = BytesIO()
+            download_to_fd(
+                session.s3_client, session.internal_bucket, self.segment_path(session, segment), fd,
+            )
+            data = history_codec.decode(fd.getvalue())
+            # Segments were JSON lists of entries at first.
+            archived = data if isinstance(data, list) else data["entries"]
+            entries.extend(NodeHistoryEntry.parse_obj(e) for e in archived)
+        return entries
+
+    def segment_path(self, session: Session, segment: str) -> str:
+        return f"{session.s3_prefix}/{session.sync_metadata_prefix}/archive/{self.key}/{segment}"
+
+    def save_segment(self, session: Session, entries: List[NodeHistoryEntry]) -> None:
+        """
+        Archive `entries` in a new segment, after the existing ones.
+        """
+        history = cast(NodeHistory, self.history)
+        # Uploaded before the head which refers to it, a segment is never
+        # changed afterwards.
+        segment = uuid4().hex
+        fd = BytesIO(history_codec.encode(
+            NodeHistory(path=history.path, key=history.key, entries=entries).dict()
+        ))
+        upload_from_fd(
+            session.s3_client, fd, session.internal_bucket, self.segment_path(session, segment)
+        )
+        history.segments = history.segments + [segment]
+
+    def save(self, session: Session, if_unchanged: bool = False) -> None:
+        """
+        Upload the history, with `if_unchanged` only if it is still the one
+        with our etag, failing with a `PreconditionFailed` error otherwise.
+        """
         if not self.is_loaded:
             return
-        fd = BytesIO(
-            json.dumps(cast(NodeHistory, self.history).dict()).encode("utf-8")
-        )
-        fd.seek(0, os.SEEK_SET)
+        history = cast(NodeHistory, self.history)
+        archived = history.compact()
+        if archived:
+            self.save_segment(session, archived)
+        data = history_codec.encode(history.dict())
         s3_path = f"{session.s3_prefix}/{session.sync_metadata_prefix}/history/{self.key}"
-        upload_from_fd(session.s3_client, fd, session.internal_bucket, s3_path)
+        if if_unchanged:
+            self.etag = put_if_match(
+                session.s3_client, data, session.internal_bucket, s3_path, cast(str, self.etag)
+            )
+            return
+        upload_from_fd(session.s3_client, BytesIO(data), session.internal_bucket, s3_path)
         obj = get_file_metadata(session.s3_client, session.internal_bucket, s3_path)
         self.etag = obj.get("ETag", "").strip('"')
 
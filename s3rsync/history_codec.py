@@ -0,0 +1,227 @@
+"""
+Compact binary form of node histories, as the dicts `NodeHistory.dict()`
+gives and `NodeHistory.parse_obj` takes.
+
+    magic, version
+    path, key, segment count, segments..., entry count, entries...
+
+Every entry is a flags byte followed by its key, etag, base version, base
+size, delta size and timestamp, then its basis path and version when the
+flags have HAS_BASIS (version 2). Keys, etags and other 32 digit hex strings
+take 16 bytes, sizes are varints and timestamps in the `now_as_iso` format
+are microseconds since the epoch. Anything else is kept as a string, so
+every history round trips exactly.
+
+`decode` still reads the JSON histories were stored as before.
+"""
+import json
+import re
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Union
+
+
+MAGIC = b"\x89NH"
+VERSION = 2
+
+DELETED = 1
+HAS_DELTA = 2
+HAS_BASIS = 4
+
+NONE = 0
+DIGEST = 1
+STRING = 2
+MICROSECONDS = 3
+
+EPOCH = datetime(1970, 1, 1)
+TIMESTAMP_RE = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.(\d{6}))?000Z")
+
+
+class HistoryCodecError(ValueError):
+    pass
+
+
+def encode(history: Dict[str, Any]) -> bytes:
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    _write_value(out, history["path"])
+    _write_value(out, history["key"])
+    segments = history.get("segments", [])
+    _write_varint(out, len(segments))
+    for segment in segments:
+        _write_value(out, segment)
+    _write_varint(out, len(history["entries"]))
+    for entry in history["entries"]:
+        basis_version = entry.get("basis_version")
+        out.append(
+            (DELETED if entry["deleted"] else 0)
+            | (HAS_DELTA if entry["has_delta"] else 0)
+            | (HAS_BASIS if basis_version is not None else 0)
+        )
+        _write_value(out, entry["key"])
+        _write_value(out, entry["etag"])
+        _write_value(out, entry["base_version"])
+        _write_varint(out, entry["base_size"])
+        _write_varint(out, entry["delta_size"])
+        _write_timestamp(out, entry["timestamp"])
+        if basis_version is not None:
+            _write_value(out, entry["basis_path"])
+            _write_value(out, basis_version)
+    return bytes(out)
+
+
+def decode(data: Union[bytes, str]) -> Any:
+    if isinstance(data, str) or not data.startswith(MAGIC):
+        return json.loads(data)
+    if len(data) <= len(MAGIC):
+        raise HistoryCodecError("Truncated history")
+    version = data[len(MAGIC)]
+    # Version 1 is version 2 without HAS_BASIS.
+    if not 1 <= version <= VERSION:
+        raise HistoryCodecError(f"Unknown history format version {version}")
+    reader = _Reader(data, len(MAGIC) + 1)
+    value, varint = reader.value, reader.varint
+    try:
+        path = value()
+        key = value()
+        segments = [value() for _ in range(varint())]
+        entries = []
+        for _ in range(varint()):
+            flags = reader.byte()
+            entry = {
+                "key": value(),
+                "deleted": bool(flags & DELETED),
+                "etag": value(),
+                "base_version": value(),
+                "base_size": varint(),
+                "has_delta": bool(flags & HAS_DELTA),
+                "delta_size": varint(),
+                "timestamp": value(),
+                "basis_path": None,
+                "basis_version": None,
+            }
+            if flags & HAS_BASIS:
+                entry["basis_path"] = value()
+                entry["basis_version"] = value()
+            entries.append(entry)
+    except IndexError:
+        raise HistoryCodecError("Truncated history") from None
+    return {"path": path, "key": key, "entries": entries, "segments": segments}
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    if value < 0:
+        raise HistoryCodecError(f"Negative size {value}")
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_value(out: bytearray, value: Optional[str]) -> None:
+    if value is None:
+        out.append(NONE)
+        return
+    if len(value) == 32:
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            digest = b""
+        # Upper case or spaced hex would not come back the same.
+        if len(digest) == 16 and digest.hex() == value:
+            out.append(DIGEST)
+            out += digest
+            return
+    out.append(STRING)
+    encoded = value.encode("utf-8")
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _write_timestamp(out: bytearray, value: str) -> None:
+    microseconds = _parse_timestamp(value)
+    if microseconds is None:
+        _write_value(out, value)
+        return
+    out.append(MICROSECONDS)
+    _write_varint(out, microseconds)
+
+
+def _parse_timestamp(value: str) -> Optional[int]:
+    """
+    Microseconds since the epoch, if formatting them gives `value` back.
+    """
+    match = TIMESTAMP_RE.fullmatch(value)
+    # `now_as_iso` leaves zero microseconds out.
+    if match is None or match.group(1) == "000000":
+        return None
+    try:
+        delta = datetime.fromisoformat(value[:-4]) - EPOCH
+    except ValueError:
+        return None
+    if delta.days < 0:
+        return None
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _format_timestamp(microseconds: int) -> str:
+    # The same as `now_as_iso`.
+    return (EPOCH + timedelta(microseconds=microseconds)).isoformat() + "000Z"
+
+
+class _Reader:
+    __slots__ = ("data", "offset")
+
+    def __init__(self, data: bytes, offset: int):
+        self.data = data
+        self.offset = offset
+
+    def byte(self) -> int:
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def varint(self) -> int:
+        data = self.data
+        b = data[self.offset]
+        self.offset += 1
+        value = b & 0x7F
+        shift = 7
+        while b >= 0x80:
+            b = data[self.offset]
+            self.offset += 1
+            value |= (b & 0x7F) << shift
+            shift += 7
+        return value
+
+    def read(self, size: int) -> bytes:
+        end = self.offset + size
+        if end > len(self.data):
+            raise IndexError
+        value = self.data[self.offset:end]
+        self.offset = end
+        return value
+
+    def value(self) -> Any:
+        kind = self.data[self.offset]
+        self.offset += 1
+        if kind == DIGEST:
+            return self.read(16).hex()
+        elif kind == NONE:
+            return None
+        elif kind == MICROSECONDS:
+            return _format_timestamp(self.varint())
+        elif kind == STRING:
+            return self.read(self.varint()).decode("utf-8")
+        raise HistoryCodecError(f"Unknown value kind {kind}")
+
+
+def _main(paths: List[str]) -> None:
+    # Prints histories as JSON, for scripts/dump-history.sh.
+    for path in paths:
+        with open(path, "rb") as f:
+            print(json.dumps(decode(f.read()), indent=2))
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -1,4 +1,9 @@
+import logging
+from concurrent.futures import Future
 from contextlib import contextmanager
+from queue import Empty, Queue
+from threading import Lock, Thread, local
+from typing import Any, Callable, Dict, Optional
 
 import peewee  # type: ignore
 from dynaconf import settings  # type: ignore
@@ -7,11 +12,116 @@ from dynaconf import settings  # type: ignore
 database = peewee.DatabaseProxy()
 
 
+def database_pragmas(pragmas: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    The tuning profile from `LOCAL_DB_PRAGMAS`, or `pragmas`, plus foreign
+    keys, which the models rely on.
+    """
+    if pragmas is None:
+        pragmas = dict(settings.LOCAL_DB_PRAGMAS)
+    return {**{k.lower(): v for k, v in pragmas.items()}, "foreign_keys": 1}
+
+
+class DatabaseWriter:
+    """
+    A thread doing the writes to the local DB on behalf of other threads.
+
+    Writes queued while a transaction is open are committed together in the
+    next one, up to `max_batch` of them, so concurrent workers share one
+    commit and its fsync instead of each waiting for the database lock. Every
+    write runs in its own savepoint, a failing one is rolled back alone.
+    `write` returns once the transaction holding the write is committed.
+    """
+
+    def __init__(self, db: peewee.Database, max_batch: int = 256):
+        self.db = db
+        self.max_batch = max_batch
+        self.queue: Queue = Queue()
+        self.thread: Optional[Thread] = None
+        self.lock = Lock()
+        self.local = local()
+        self.commits = 0
+        self.writes = 0
+
+    def write(self, fn: Callable, *args, **kwargs) -> Any:
+        if getattr(self.local, "writing", False):
+            # A write done by another write, it is part of the same batch.
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future: Future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="db-writer", daemon=True)
+                self.thread.start()
+            self.queue.put((fn, args, kwargs, future))
+        return future
+
+    def stop(self) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return
+            self.queue.put(None)
+        thread.join()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"commits": self.commits, "writes": self.writes}
+
+    def _run(self) -> None:
+        self.local.writing = True
+        try:
+            while True:
+                batch = [self.queue.get()]
+                while batch[-1] is not None and len(batch) < self.max_batch:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                stop = batch[-1] is None
+                self._commit([w for w in batch if w is not None])
+                if stop:
+                    return
+        finally:
+            self.db.close()
+
+    def _commit(self, batch) -> None:
+        if not batch:
+            return
+        results = []
+        try:
+            with self.db.atomic():
+                for fn, args, kwargs, future in batch:
+                    try:
+                        with self.db.atomic():
+                            results.append((future, fn(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            logging.exception("[DB] Commit of %d writes failed", len(batch))
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.commits += 1
+        self.writes += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+writer = DatabaseWriter(database, max_batch=settings.LOCAL_DB_WRITE_BATCH_SIZE)
+
+
 @contextmanager
-def open_database(path=settings.LOCAL_DB):
-    database.initialize(peewee.SqliteDatabase(path, pragmas={"foreign_keys": 1}))
+def open_database(path=settings.LOCAL_DB, pragmas: Optional[Dict[str, Any]] = None):
+    database.initialize(peewee.SqliteDatabase(path, pragmas=database_pragmas(pragmas)))
     try:
         database.connect()
         yield database
     finally:
+        writer.stop()
         database.close()
@@ -1,13 +1,20 @@
 from __future__ import annotations
 
 import json
-from typing import Optional, Dict
+import os
+import posixpath
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Dict, List, Tuple
 
 import peewee  # type: ignore
+from dynaconf import settings  # type: ignore
+from playhouse.migrate import SqliteMigrator, migrate  # type: ignore
 
+from s3rsync import history_codec
 from s3rsync.session import Session
 from s3rsync.local_db import database
-from s3rsync.history import NodeHistory
+from s3rsync.history import NodeHistory, RemoteNodeHistory
 
 
 def recored_as_dict(record):
@@ -29,6 +36,102 @@ class JSONField(peewee.TextField):
             return json.loads(value)
 
 
+class HistoryCache:
+    """
+    Histories parsed from stored rows, shared by all row instances, so the
+    rows selected again every sync cycle are not parsed again while their
+    remote history does not change. Keyed by root folder, node key and remote
+    history etag.
+
+    Bounded by count and by an estimate of the memory of the parsed entries,
+    the least recently used histories are evicted first.
+    """
+
+    # Rough memory of one parsed NodeHistoryEntry with its strings.
+    ENTRY_SIZE = 1024
+
+    def __init__(self, max_count: int, max_size: int):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.size = 0
+        self.histories: OrderedDict[Tuple, NodeHistory] = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple) -> Optional[NodeHistory]:
+        with self.lock:
+            history = self.histories.get(key)
+            if history is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.histories.move_to_end(key)
+            return history
+
+    def put(self, key: Tuple, history: NodeHistory) -> None:
+        with self.lock:
+            self._discard(key)
+            self.histories[key] = history
+            self.size += self._size(history)
+            while len(self.histories) > 1 and (
+                len(self.histories) > self.max_count or self.size > self.max_size
+            ):
+                self._discard(next(iter(self.histories)))
+
+    def discard(self, key: Tuple) -> None:
+        with self.lock:
+            self._discard(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.histories.clear()
+            self.size = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "count": len(self.histories), "size": self.size}
+
+    def _discard(self, key: Tuple) -> None:
+        history = self.histories.pop(key, None)
+        if history is not None:
+            self.size -= self._size(history)
+
+    def _size(self, history: NodeHistory) -> int:
+        return (len(history.entries) + 1) * self.ENTRY_SIZE
+
+
+history_cache = HistoryCache(
+    max_count=settings.HISTORY_CACHE_COUNT, max_size=settings.HISTORY_CACHE_MAX_SIZE
+)
+
+
+class HistoryAccessor(peewee.FieldAccessor):
+    def __set__(self, instance, value):
+        if self.name in instance.__data__:
+            # Replaced, not loaded, the cached history may be stale.
+            history_cache.discard(instance.history_cache_key)
+        super().__set__(instance, value)
+
+
+class HistoryField(peewee.BlobField):
+    """
+    `NodeHistory.dict()` stored in the compact binary form, rows written as
+    JSON before are still read.
+    """
+
+    accessor_class = HistoryAccessor
+
+    def db_value(self, value):
+        if isinstance(value, dict):
+            value = history_codec.encode(value)
+        return super().db_value(value)
+
+    def python_value(self, value):
+        if value is not None:
+            return history_codec.decode(value)
+
+
 class RootFolder(peewee.Model):
     path = peewee.CharField()
 
@@ -41,24 +144,324 @@ class RootFolder(peewee.Model):
 
 
 class StoredNodeHistory(peewee.Model):
+    """
+    The history of a node as last synced, one row per root folder and node.
+    The latest entry is summarized in its own columns, `data` holds the
+    whole history and is only read when `history` is needed.
+    """
+
     id = peewee.AutoField()
-    key = peewee.CharField(index=True)
+    key = peewee.CharField()
     root_folder = peewee.ForeignKeyField(RootFolder, on_delete="CASCADE")
-    data = JSONField()
+    path = peewee.CharField(null=True)
+    last_entry_key = peewee.CharField(null=True)
+    last_etag = peewee.CharField(null=True)
+    deleted = peewee.BooleanField(default=False)
+    data = HistoryField()
     local_modified_time = peewee.IntegerField()
     local_created_time = peewee.IntegerField()
+    # The file as synced, to find it again after a move.
+    local_inode = peewee.IntegerField(null=True)
+    local_size = peewee.IntegerField(null=True)
     remote_history_etag = peewee.DateTimeField()
 
     class Meta:
         database = database
+        indexes = (
+            (("root_folder", "key"), True),
+        )
 
-    _history: Optional[Dict[float, NodeHistory]] = None
+    # Rows per query when loading the data of many rows.
+    LOAD_BATCH_SIZE = 500
+
+    _upsert_sql: Optional[str] = None
+
+    @classmethod
+    def select_summary(cls) -> peewee.ModelSelect:
+        """
+        Rows without their `data`, `history` loads it on first use.
+        """
+        return cls.select(*[f for f in cls._meta.sorted_fields if f is not cls.data])
+
+    @classmethod
+    def upsert(
+        cls,
+        root_folder: RootFolder,
+        history: NodeHistory,
+        remote_history_etag: Optional[str],
+        local_modified_time: float,
+        local_created_time: float,
+        local_inode: Optional[int] = None,
+        local_size: Optional[int] = None,
+    ) -> None:
+        """
+        Insert or replace the row of `history`'s node in `root_folder`.
+        """
+        last = history.entries[-1] if history.entries else None
+        values = (
+            history.key,
+            root_folder.id,
+            history.path,
+            last.key if last else None,
+            last.etag if last else None,
+            bool(last and last.deleted),
+            cls.data.db_value(history.dict()),
+            local_modified_time,
+            local_created_time,
+            local_inode,
+            local_size,
+            remote_history_etag,
+        )
+        # Runs for every synced node, the statement is built once instead of
+        # by peewee every time.
+        if cls._upsert_sql is None:
+            cls._upsert_sql = cls._build_upsert_sql()
+        cls._meta.database.execute_sql(cls._upsert_sql, values)
+        history_cache.discard((root_folder.id, history.key, remote_history_etag))
+
+    @classmethod
+    def _build_upsert_sql(cls) -> str:
+        # The order of the values `upsert` passes.
+        columns = [
+            f'"{cls._meta.fields[name].column_name}"'
+            for name in (
+                "key", "root_folder", "path", "last_entry_key", "last_etag", "deleted",
+                "data", "local_modified_time", "local_created_time", "local_inode", "local_size",
+                "remote_history_etag",
+            )
+        ]
+        return (
+            f'INSERT INTO "{cls._meta.table_name}" ({", ".join(columns)}) '
+            f'VALUES ({", ".join("?" for _ in columns)}) '
+            f'ON CONFLICT ({columns[1]}, {columns[0]}) '
+            f'DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in columns[2:])}'
+        )
+
+    @classmethod
+    def load_histories(cls, rows: List[StoredNodeHistory]) -> None:
+        """
+        Load the data of `rows` whose history is not cached, in batches.
+        """
+        missing = {
+            row.id: row
+            for row in rows
+            if "data" not in row.__data__ and history_cache.get(row.history_cache_key) is None
+        }
+        ids = list(missing)
+        for i in range(0, len(ids), cls.LOAD_BATCH_SIZE):
+            query = cls.select(cls.id, cls.data).where(cls.id.in_(ids[i:i + cls.LOAD_BATCH_SIZE]))
+            for row in query:
+                missing[row.id].__data__["data"] = row.data
+
+    @property
+    def history_cache_key(self) -> Tuple:
+        return (self.root_folder_id, self.key, self.remote_history_etag)
 
     @property
     def history(self) -> NodeHistory:
-        if self._history is None:
-            self._history = {}
-        key = self.remote_history_etag
-        if key not in self._history:
-            self._history[key] = NodeHistory.parse_obj(self.data)
-        return self._history[key]
+        """
+        The parsed `data`, shared with other rows of the same node and remote
+        history, copy it before changing it.
+        """
+        key = self.history_cache_key
+        history = history_cache.get(key)
+        if history is None:
+            if "data" not in self.__data__:
+                self.load_histories([self])
+            history = NodeHistory.parse_trusted(self.data)
+            history_cache.put(key, history)
+        return history
+
+
+# Columns added to StoredNodeHistory after its first version.
+ADDED_COLUMNS = (
+    StoredNodeHistory.path,
+    StoredNodeHistory.last_entry_key,
+    StoredNodeHistory.last_etag,
+    StoredNodeHistory.deleted,
+    StoredNodeHistory.local_inode,
+    StoredNodeHistory.local_size,
+)
+
+
+def migrate_schema(db: peewee.Database) -> None:
+    """
+    Bring a StoredNodeHistory table from an older version up to date: add
+    the missing columns and, for a table from before the summary columns,
+    fill them, keep the newest row of duplicated nodes and replace the
+    index on `key` with the unique one. Also add the missing columns of
+    MultipartUpload.
+    """
+    upload_table = MultipartUpload._meta.table_name
+    if db.table_exists(upload_table) and "progressed" not in {c.name for c in db.get_columns(upload_table)}:
+        migrate(SqliteMigrator(db).add_column(upload_table, "progressed", MultipartUpload.progressed))
+    table = StoredNodeHistory._meta.table_name
+    if not db.table_exists(table):
+        return
+    columns = {c.name for c in db.get_columns(table)}
+    missing = [f for f in ADDED_COLUMNS if f.column_name not in columns]
+    if not missing:
+        return
+    migrator = SqliteMigrator(db)
+    with db.atomic():
+        migrate(*[migrator.add_column(table, f.column_name, f) for f in missing])
+        if "last_entry_key" in columns:
+            return
+        newest = StoredNodeHistory.select(peewee.fn.MAX(StoredNodeHistory.id)).group_by(
+            StoredNodeHistory.root_folder, StoredNodeHistory.key
+        )
+        StoredNodeHistory.delete().where(StoredNodeHistory.id.not_in(newest)).execute()
+        if f"{table}_key" in {i.name for i in db.get_indexes(table)}:
+            migrate(migrator.drop_index(table, f"{table}_key"))
+        migrate(migrator.add_index(table, ("root_folder_id", "key"), unique=True))
+        for row in StoredNodeHistory.select():
+            StoredNodeHistory.upsert(
+                row.root_folder,
+                NodeHistory.parse_trusted(row.data),
+                row.remote_history_etag,
+                row.local_modified_time,
+                row.local_created_time,
+            )
+
+
+class MultipartUpload(peewee.Model):
+    """
+    An upload of a large file in progress, so it resumes with the missing
+    parts after a restart. `parts` maps part numbers to their ETags, the
+    source identity tells whether the file is still the one being uploaded.
+    """
+
+    id = peewee.AutoField()
+    root_folder = peewee.ForeignKeyField(RootFolder, on_delete="CASCADE")
+    bucket = peewee.CharField()
+    s3_path = peewee.CharField()
+    upload_id = peewee.CharField()
+    part_size = peewee.IntegerField()
+    parts = JSONField()
+    source_size = peewee.IntegerField()
+    source_modified_time = peewee.IntegerField()
+    source_inode = peewee.IntegerField()
+    initiated = peewee.IntegerField()
+    # When the latest part was uploaded.
+    progressed = peewee.IntegerField(null=True)
+
+    class Meta:
+        database = database
+        indexes = (
+            (("root_folder", "bucket", "s3_path"), True),
+        )
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return (
+            self.source_size == stat.st_size
+            and self.source_modified_time == stat.st_mtime_ns
+            and self.source_inode == stat.st_ino
+        )
+
+
+class ContentIndex(peewee.Model):
+    """
+    Where the content of a node is stored whole: every node under the
+    prefix whose latest entry is a base, by the etag of its content. A new
+    file with the same content is copied from that base within S3.
+    `remote_history_etag` is the version of the history the row is from.
+    """
+
+    id = peewee.AutoField()
+    root_folder = peewee.ForeignKeyField(RootFolder, on_delete="CASCADE")
+    key = peewee.CharField()
+    etag = peewee.CharField(index=True)
+    path = peewee.CharField()
+    entry_key = peewee.CharField()
+    base_version = peewee.CharField()
+    size = peewee.IntegerField()
+    remote_history_etag = peewee.CharField()
+
+    class Meta:
+        database = database
+        indexes = (
+            (("root_folder", "key"), True),
+        )
+
+    # Rows per insert, within SQLite's limit of 999 parameters.
+    INSERT_BATCH_SIZE = 100
+
+    @classmethod
+    def find(cls, root_folder: RootFolder, etag: str, size: int) -> Optional[ContentIndex]:
+        return cls.get_or_none(cls.root_folder == root_folder, cls.etag == etag, cls.size == size)
+
+    @classmethod
+    def basis_candidates(
+        cls, root_folder: RootFolder, key: str, path: str, size: int, count: int, size_range: float
+    ) -> List[ContentIndex]:
+        """
+        Up to `count` nodes, other than `key`, which a new file at `path` may
+        be an edited copy of, best first: in the same folder with the same
+        extension, with the same extension, in the same folder, and the
+        closer in size the better. Their size is within `size_range` of
+        `size`, as a fraction of it.
+        """
+        folder, name = posixpath.split(path)
+        prefix = folder + "/" if folder else ""
+        # Right in the folder, not in one below it.
+        same_folder = cls.path.startswith(prefix) & (
+            peewee.fn.INSTR(peewee.fn.SUBSTR(cls.path, len(prefix) + 1), "/") == 0
+        )
+        matches = same_folder
+        score = peewee.Case(None, [(same_folder, 1)], 0)
+        extension = posixpath.splitext(name)[1]
+        if extension:
+            same_extension = cls.path.endswith(extension)
+            matches = matches | same_extension
+            score = score + peewee.Case(None, [(same_extension, 2)], 0)
+        return list(
+            cls.select()
+            .where(
+                cls.root_folder == root_folder,
+                cls.key != key,
+                cls.size.between(int(size * (1 - size_range)), int(size * (1 + size_range))),
+                matches,
+            )
+            .order_by(score.desc(), peewee.fn.ABS(cls.size - size))
+            .limit(count)
+        )
+
+    @classmethod
+    def refresh(cls, root_folder: RootFolder, remote_history: List[RemoteNodeHistory]) -> None:
+        """
+        Update the rows of the nodes whose history changed since they were
+        indexed, and remove the ones of nodes which are gone.
+        """
+        indexed = dict(
+            cls.select(cls.key, cls.remote_history_etag).where(cls.root_folder == root_folder).tuples()
+        )
+        stale = set(indexed)
+        rows = []
+        for remote in remote_history:
+            stale.discard(remote.key)
+            if remote.history is None or indexed.get(remote.key) == remote.etag:
+                continue
+            entries = remote.history.entries
+            last = entries[-1] if entries else None
+            if last is None or last.deleted or last.has_delta or not last.base_version or not last.etag:
+                stale.add(remote.key)
+                continue
+            rows.append({
+                "root_folder": root_folder,
+                "key": remote.key,
+                "etag": last.etag,
+                "path": remote.history.path,
+                "entry_key": last.key,
+                "base_version": last.base_version,
+                "size": last.base_size,
+                "remote_history_etag": remote.etag,
+            })
+        for i in range(0, len(rows), cls.INSERT_BATCH_SIZE):
+            cls.insert_many(rows[i:i + cls.INSERT_BATCH_SIZE]).on_conflict(
+                conflict_target=[cls.root_folder, cls.key],
+                preserve=[cls.etag, cls.path, cls.entry_key, cls.base_version, cls.size, cls.remote_history_etag],
+            ).execute()
+        stale_keys = list(stale & set(indexed))
+        for i in range(0, len(stale_keys), StoredNodeHistory.LOAD_BATCH_SIZE):
+            keys = stale_keys[i:i + StoredNodeHistory.LOAD_BATCH_SIZE]
+            cls.delete().where(cls.root_folder == root_folder, cls.key.in_(keys)).execute()
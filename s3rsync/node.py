@@ -43,6 +43,7 @@ class LocalNode:
     created_time: float
     size: int
     etag: Optional[str]
+    inode: Optional[int] = None
 
     def __post_init__(self):
         self.key = hash_path(self.path)
@@ -57,7 +58,8 @@ class LocalNode:
             modified_time=int(stat.st_mtime),
             created_time=int(stat.st_ctime),
             size=stat.st_size,
-            etag=None
+            etag=None,
+            inode=stat.st_ino,
         )
 
     def updated(self, stored: StoredNodeHistory) -> bool:
@@ -0,0 +1,141 @@
+import itertools
+import logging
+from contextlib import nullcontext
+from queue import Empty, PriorityQueue
+from threading import Thread
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from s3rsync.local_db import DatabaseWriter
+from s3rsync.scheduler import SyncScheduler
+from s3rsync.session import Session
+from s3rsync.sync_action import Stage, StagedSyncActionResult, SyncAction
+
+
+STAGES: List[Stage] = list(Stage)
+
+
+class SyncPipeline:
+    """
+    Runs sync actions stage by stage. Every stage has a bounded queue and its
+    own pool of worker threads, so while one action uploads another one can
+    compute its delta and a third one fetch its signature.
+
+    An action moves to the next queue when it yields the next stage. Stages
+    only move forward, so a full queue can block a stage but never deadlock
+    the pipeline. The commit stage has a single worker, it is the only one
+    writing to the local DB. It takes up to `commit_batch_size` queued
+    actions at a time and hands them to `writer` as one write, so they are
+    committed in one transaction instead of one per row. Every action runs
+    in its own savepoint, a failing one is rolled back alone.
+
+    Every queue is ordered by the deadline `scheduler` gives the action, so a
+    small action does not wait behind a large one in any stage. Without a
+    scheduler actions run in the order they are given.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        workers: Dict[Stage, int],
+        queue_size: int,
+        scheduler: Optional[SyncScheduler] = None,
+        writer: Optional[DatabaseWriter] = None,
+        commit_batch_size: int = 1,
+    ):
+        self.session = session
+        self.scheduler = scheduler
+        self.writer = writer
+        self.commit_batch_size = commit_batch_size
+        self.sequence = itertools.count()
+        self.queues: Dict[Stage, PriorityQueue] = {
+            stage: PriorityQueue(maxsize=queue_size) for stage in STAGES
+        }
+        for stage in STAGES:
+            count = 1 if stage == Stage.COMMIT else workers[stage]
+            for i in range(count):
+                target = self._commit if stage == Stage.COMMIT else self._work
+                thread = Thread(target=target, args=(stage,), name=f"{stage.value}-{i}", daemon=True)
+                thread.start()
+
+    def run(self, actions: Iterable[SyncAction]) -> None:
+        """
+        Feed `actions` into the pipeline and wait until all of them are done.
+        """
+        if self.scheduler is not None:
+            scheduled = self.scheduler.order(actions)
+        else:
+            scheduled = [(0.0, action) for action in actions]
+        for deadline, action in scheduled:
+            logging.info("[PIPELINE] Scheduling sync action: %r", action)
+            steps = action.steps(self.session)
+            self._advance((deadline, next(self.sequence), steps), None)
+        for stage in STAGES:
+            self.queues[stage].join()
+
+    def _work(self, stage: Stage) -> None:
+        queue = self.queues[stage]
+        while True:
+            item = queue.get()
+            try:
+                self._advance(item, stage)
+            finally:
+                queue.task_done()
+
+    def _commit(self, stage: Stage) -> None:
+        queue = self.queues[stage]
+        while True:
+            batch = [queue.get()]
+            while len(batch) < self.commit_batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+
+            def commit() -> None:
+                for item in batch:
+                    self._advance_atomic(item, stage)
+
+            try:
+                if self.writer is not None:
+                    self.writer.write(commit)
+                else:
+                    commit()
+            except Exception:
+                logging.exception("[PIPELINE] Commit of %d sync actions failed", len(batch))
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _advance_atomic(self, item: Tuple[float, int, StagedSyncActionResult], stage) -> None:
+        """
+        `_advance` in a savepoint of its own, the writes of a failing action
+        are rolled back without the rest of the batch.
+        """
+        atomic = self.writer.db.atomic if self.writer is not None else nullcontext
+        try:
+            with atomic():
+                self._advance(item, stage, raise_errors=True)
+        except Exception:
+            logging.exception("[PIPELINE] Sync action failed in %s stage, rolled back", stage)
+
+    def _advance(self, item: Tuple[float, int, StagedSyncActionResult], stage, raise_errors: bool = False) -> None:
+        """
+        Run the action up to its next stage and queue it there.
+        """
+        steps = item[-1]
+        try:
+            next_stage = next(steps)
+            while next_stage == stage:
+                next_stage = next(steps)
+        except StopIteration:
+            return
+        except Exception:
+            if raise_errors:
+                raise
+            logging.exception("[PIPELINE] Sync action failed in %s stage", stage)
+            return
+        if stage is not None and STAGES.index(next_stage) < STAGES.index(stage):
+            steps.close()
+            logging.error("[PIPELINE] Sync action went back from %s to %s", stage, next_stage)
+            return
+        self.queues[next_stage].put(item)
@@ -0,0 +1,234 @@
+"""
+Sync planning for whole trees at once. The local snapshot columns, the
+stored stats and the remote history etags are aligned by key in NumPy
+arrays, every node is classified in one vectorized pass, and Python only
+runs for the nodes which need an action. Decides the same as `handle_node`,
+except for files moved since they were synced, which become a `move`.
+"""
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple, cast
+
+import numpy as np  # type: ignore
+
+from s3rsync.history import NodeHistory, RemoteNodeHistory
+from s3rsync.models import StoredNodeHistory
+from s3rsync.node import LocalNode
+from s3rsync.sync_action import (
+    SyncAction,
+    conflict,
+    delete_history,
+    delete_local,
+    delete_remote,
+    download,
+    move,
+    upload,
+)
+from s3rsync.sync_logic import handle_node
+from s3rsync.tree_snapshot import TreeSnapshot
+
+
+# What `handle_node` would return, by node.
+NOP = 0
+DELETE_HISTORY = 1
+UPLOAD_NEW = 2
+DELETE_LOCAL = 3
+DOWNLOAD_NEW = 4
+DELETE_REMOTE = 5
+CONFLICT = 6
+UPLOAD = 7
+DOWNLOAD = 8
+# Depends on the content etags, decided by `handle_node`.
+HANDLE_NODE = 9
+# A DELETE_REMOTE and an UPLOAD_NEW of the same file, see `pair_moves`.
+MOVE = 10
+
+
+def key_array(keys: Sequence[str]) -> np.ndarray:
+    return np.frombuffer(bytes.fromhex("".join(keys)), dtype="S16")
+
+
+def align(keys: np.ndarray, all_keys: np.ndarray) -> np.ndarray:
+    """
+    Index into `keys` of every key in `all_keys`, -1 where it is missing.
+    """
+    index = np.full(len(all_keys), -1, dtype=np.int64)
+    index[np.searchsorted(all_keys, keys)] = np.arange(len(keys))
+    return index
+
+
+def classify(
+    has_remote: np.ndarray,
+    has_local: np.ndarray,
+    has_stored: np.ndarray,
+    remote_deleted: np.ndarray,
+    local_updated: np.ndarray,
+    remote_updated: np.ndarray,
+) -> np.ndarray:
+    """
+    The decision table of `handle_node` over arrays of nodes.
+    """
+    r, l, s, d = has_remote, has_local, has_stored, remote_deleted
+    lu, ru = local_updated, remote_updated
+    conditions = [
+        ~r & ~l & s,
+        ~r & l & ~s,
+        ~r & l & s,
+        r & ~d & ~l & ~s,
+        r & ~d & ~l & s,
+        r & d & ~l & s,
+        r & l & ~s & d,
+        r & l & ~s,
+        r & l & s & d & lu,
+        r & l & s & d,
+        r & l & s & lu & ru,
+        r & l & s & lu,
+        r & l & s & ru,
+    ]
+    choices = [
+        DELETE_HISTORY,
+        UPLOAD_NEW,
+        DELETE_LOCAL,
+        DOWNLOAD_NEW,
+        DELETE_REMOTE,
+        DELETE_HISTORY,
+        DELETE_LOCAL,
+        HANDLE_NODE,
+        CONFLICT,
+        DELETE_LOCAL,
+        HANDLE_NODE,
+        UPLOAD,
+        DOWNLOAD,
+    ]
+    return np.select(conditions, choices, default=NOP).astype(np.int8)
+
+
+ACTIONS: Dict[int, Callable] = {
+    DELETE_HISTORY: lambda remote, local, stored: delete_history(stored),
+    UPLOAD_NEW: lambda remote, local, stored: upload(None, local),
+    DELETE_LOCAL: lambda remote, local, stored: delete_local(local, stored),
+    DOWNLOAD_NEW: lambda remote, local, stored: download(remote, None),
+    DELETE_REMOTE: lambda remote, local, stored: delete_remote(remote, stored),
+    CONFLICT: lambda remote, local, stored: conflict(remote, local, stored),
+    UPLOAD: lambda remote, local, stored: upload(remote, local),
+    DOWNLOAD: lambda remote, local, stored: download(remote, stored),
+    HANDLE_NODE: handle_node,
+}
+
+
+def pair_moves(
+    codes: np.ndarray,
+    snapshot: TreeSnapshot,
+    root_folder: Path,
+    local_index: np.ndarray,
+    remote_index: np.ndarray,
+    stored_index: np.ndarray,
+    remote_history: List[RemoteNodeHistory],
+    stored_history: List[StoredNodeHistory],
+) -> Dict[int, Tuple[int, LocalNode]]:
+    """
+    Pair the nodes whose file is gone with the new files which are the same
+    file moved: the same inode and size as it was synced with, and the same
+    content as its latest entry. Nodes changed remotely since are left out,
+    moving them would take the other side's content to the new path. The
+    pairs become MOVEs, by the new node's row, with the row of the old one
+    and the new file.
+    """
+    gone: Dict[Tuple[int, int], List[int]] = {}
+    for i in np.flatnonzero(codes == DELETE_REMOTE).tolist():
+        stored = stored_history[stored_index[i]]
+        remote = remote_history[remote_index[i]]
+        if (
+            stored.local_inode
+            and stored.last_etag
+            and remote.etag == stored.remote_history_etag
+            and cast(NodeHistory, remote.history).etag == stored.last_etag
+        ):
+            gone.setdefault((stored.local_inode, stored.local_size), []).append(i)
+    moves: Dict[int, Tuple[int, LocalNode]] = {}
+    if not gone:
+        return moves
+    for i in np.flatnonzero(codes == UPLOAD_NEW).tolist():
+        li = int(local_index[i])
+        candidates = gone.get((snapshot.inodes[li], snapshot.sizes[li]))
+        if not candidates:
+            continue
+        node = snapshot.node(li, root_folder)
+        for old in candidates:
+            # Hashing is cheaper than the upload it saves, and the upload
+            # would hash it too.
+            if node.calc_etag() == stored_history[stored_index[old]].last_etag:
+                candidates.remove(old)
+                codes[old] = NOP
+                codes[i] = MOVE
+                moves[i] = (old, node)
+                break
+    return moves
+
+
+def plan_actions(
+    root_folder: Path,
+    snapshot: TreeSnapshot,
+    remote_history: List[RemoteNodeHistory],
+    stored_history: List[StoredNodeHistory],
+) -> List[SyncAction]:
+    """
+    The actions `handle_node` returns for every node, in key order, except
+    the `nop`s.
+    """
+    local_keys = np.frombuffer(snapshot.keys, dtype="S16")
+    remote_keys = key_array([h.key for h in remote_history])
+    stored_keys = key_array([h.key for h in stored_history])
+    all_keys = np.sort(np.concatenate([local_keys, remote_keys, stored_keys]))
+    all_keys = all_keys[np.concatenate([[True], all_keys[1:] != all_keys[:-1]])]
+    local_index = align(local_keys, all_keys)
+    remote_index = align(remote_keys, all_keys)
+    stored_index = align(stored_keys, all_keys)
+    has_local, has_remote, has_stored = local_index >= 0, remote_index >= 0, stored_index >= 0
+
+    both = has_local & has_stored
+    local_modified = np.frombuffer(snapshot.modified_times, dtype=np.int64)[local_index[both]]
+    local_created = np.frombuffer(snapshot.created_times, dtype=np.int64)[local_index[both]]
+    stored_modified = np.array([h.local_modified_time for h in stored_history], dtype=np.int64)
+    stored_created = np.array([h.local_created_time for h in stored_history], dtype=np.int64)
+    local_updated = np.zeros(len(all_keys), dtype=bool)
+    local_updated[both] = (
+        (local_modified != stored_modified[stored_index[both]])
+        | (local_created != stored_created[stored_index[both]])
+    )
+
+    both = has_remote & has_stored
+    remote_etags = np.array([h.etag for h in remote_history], dtype=object)
+    stored_etags = np.array([h.remote_history_etag for h in stored_history], dtype=object)
+    remote_updated = np.zeros(len(all_keys), dtype=bool)
+    remote_updated[both] = remote_etags[remote_index[both]] != stored_etags[stored_index[both]]
+
+    remote_deleted = np.zeros(len(all_keys), dtype=bool)
+    deleted = np.array([bool(h.deleted) for h in remote_history], dtype=bool)
+    remote_deleted[has_remote] = deleted[remote_index[has_remote]]
+
+    codes = classify(has_remote, has_local, has_stored, remote_deleted, local_updated, remote_updated)
+    moves = pair_moves(
+        codes, snapshot, root_folder, local_index, remote_index, stored_index, remote_history, stored_history
+    )
+    rows = np.flatnonzero(codes != NOP)
+    actions = []
+    for i, code, ri, li, si in zip(
+        rows.tolist(),
+        codes[rows].tolist(),
+        remote_index[rows].tolist(),
+        local_index[rows].tolist(),
+        stored_index[rows].tolist(),
+    ):
+        if code == MOVE:
+            old, node = moves[i]
+            actions.append(move(
+                remote_history[remote_index[old]], stored_history[stored_index[old]], node
+            ))
+            continue
+        remote = remote_history[ri] if ri >= 0 else None
+        local = snapshot.node(li, root_folder) if li >= 0 else None
+        stored = stored_history[si] if si >= 0 else None
+        action = ACTIONS[code](remote, local, stored)
+        if action.name != "nop":
+            actions.append(action)
+    return actions
@@ -1,34 +1,46 @@
-import os
 import shutil
 from typing import List, cast
 
-from librsync import patch_from_paths, delta_from_paths, signature_from_paths
+from librsync import patch
 
+from s3rsync.exceptions import RsyncError
 from s3rsync.session import Session
-from s3rsync.file_transfer import download_metadata
+from s3rsync.file_transfer import download_metadata, open_metadata
 from s3rsync.util.file import create_temp_file
 
 # TODO: error handling for librsync
 
 
-def calc_signature(session: Session, local_path: str, key: str, signature_path: str) -> None:
-    signature_from_paths(local_path, signature_path)
-    # TODO: keep only the last signature
-    shutil.copy(
-        signature_path,
-        os.fspath(session.signature_folder / key)
-    )
+def calc_signature(
+    session: Session, local_path: str, node_key: str, key: str, signature_path: str
+) -> None:
+    if not session.cpu_pool.signature(local_path, signature_path):
+        raise RsyncError(f"Signature of {local_path} failed")
+    session.signature_store.put(node_key, key, signature_path)
 
 
-def calc_delta(session: Session, local_path: str, key: str, delta_path: str) -> None:
-    with create_temp_file() as tmp_file:
-        if (session.signature_folder / key).exists():
-            signature_path = os.fspath(session.signature_folder / key)
-        else:
+def fetch_signature(session: Session, node_key: str, key: str) -> str:
+    """
+    Where the signature is in the store, downloaded if needed. Pin it, see
+    `SignatureStore.pin`, for as long as it is read.
+    """
+    store = session.signature_store
+    signature_path = store.get(node_key, key)
+    if signature_path is None:
+        with create_temp_file() as tmp_file:
             download_metadata(session, key, "signature", tmp_file)
-            signature_path = tmp_file
+            store.put(node_key, key, tmp_file)
+        signature_path = store.get(node_key, key)
+    if signature_path is None:
+        raise RsyncError(f"Signature {key} of {node_key} was evicted")
+    return signature_path
 
-        delta_from_paths(signature_path, local_path, delta_path)
+
+def calc_delta(session: Session, local_path: str, node_key: str, key: str, delta_path: str) -> None:
+    with session.signature_store.pin(node_key, key):
+        signature_path = fetch_signature(session, node_key, key)
+        if not session.cpu_pool.delta(signature_path, key, local_path, delta_path):
+            raise RsyncError(f"Delta of {local_path} against {key} failed")
 
 
 def patch_file(session: Session, local_path: str, keys: List[str]) -> None:
@@ -46,6 +58,7 @@ def patch_file(session: Session, local_path: str, keys: List[str]) -> None:
 
 
 def apply_delta(session: Session, base_path: str, key: str, result_path: str) -> None:
-    with create_temp_file() as delta_path:
-        download_metadata(session, key, "delta", delta_path)
-        patch_from_paths(base_path, delta_path, result_path)
+    # The delta is fed to librsync while it downloads, it never touches the disk.
+    with open(base_path, "rb") as base, open(result_path, "wb") as result, \
+            open_metadata(session, key, "delta") as delta:
+        patch(base, delta, result)
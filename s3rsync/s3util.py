@@ -1,12 +1,116 @@
 import logging
+import os
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
 
-from s3rsync.util.file import get_stats
+import boto3  # type: ignore
+from boto3.s3.transfer import TransferConfig  # type: ignore
+from botocore.config import Config  # type: ignore
+
+from s3rsync.util.limiter import THROTTLE_ERROR_CODES, AdaptiveLimiter, limited
 
 
 CHUNK_SIZE = 1000
+# Most keys `delete_objects` takes in one request.
+DELETE_BATCH_SIZE = 1000
+MB = 1024 ** 2
+# Largest object `copy_object` copies in one request.
+MAX_COPY_SIZE = 5 * 1024 ** 3
+
+# Every S3 request goes through this limiter, see `Session.create` for its
+# settings. Single requests are wrapped in `limiter.call`, which retries them,
+# the requests of managed transfers are limited one by one by the hooks
+# `create_client` installs, and retried by botocore.
+limiter = AdaptiveLimiter()
+
+_clients: Dict[Tuple, Any] = {}
+_clients_lock = Lock()
+
+
+def create_client(
+    max_pool_connections: int = 10,
+    connect_timeout: float = 60,
+    read_timeout: float = 60,
+    tcp_keepalive: bool = False,
+):
+    """
+    S3 client with the given connection pool and timeouts. Clients are thread
+    safe, so one client per configuration is created and shared.
+    """
+    key = (max_pool_connections, connect_timeout, read_timeout, tcp_keepalive)
+    with _clients_lock:
+        if key not in _clients:
+            options = dict(
+                max_pool_connections=max_pool_connections,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+            )
+            if "tcp_keepalive" in Config.OPTION_DEFAULTS:
+                options["tcp_keepalive"] = tcp_keepalive
+            client = boto3.client("s3", config=Config(**options))
+            limiter.instrument(client)
+            _clients[key] = client
+        return _clients[key]
+
+
+@dataclass
+class TransferProfile:
+    """
+    Multipart settings for transfers of objects up to `max_size` bytes,
+    None meaning any size.
+    """
+
+    multipart_threshold: int
+    multipart_chunksize: int
+    max_concurrency: int
+    max_size: Optional[int] = None
+
+    @property
+    def config(self) -> TransferConfig:
+        return TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize,
+            max_concurrency=self.max_concurrency,
+        )
+
+
+transfer_profiles: List[TransferProfile] = [
+    TransferProfile(
+        max_size=64 * MB, multipart_threshold=64 * MB, multipart_chunksize=8 * MB, max_concurrency=4
+    ),
+    TransferProfile(
+        max_size=1024 * MB, multipart_threshold=8 * MB, multipart_chunksize=16 * MB, max_concurrency=8
+    ),
+    TransferProfile(multipart_threshold=64 * MB, multipart_chunksize=64 * MB, max_concurrency=16),
+]
+
+
+def configure_transfers(profiles: List[Dict]) -> None:
+    global transfer_profiles
+    transfer_profiles = sorted(
+        (TransferProfile(**p) for p in profiles),
+        key=lambda p: p.max_size if p.max_size is not None else float("inf"),
+    )
+
 
+def transfer_profile(size: Optional[int]) -> TransferProfile:
+    """
+    The smallest profile that fits `size`, the largest one if the size is not
+    known.
+    """
+    if size is not None:
+        for profile in transfer_profiles:
+            if profile.max_size is None or size <= profile.max_size:
+                return profile
+    return transfer_profiles[-1]
 
-def list_versions(client, bucket, prefix):
+
+def transfer_config(size: Optional[int]) -> TransferConfig:
+    return transfer_profile(size).config
+
+
+def list_versions(client, bucket, prefix, latest_only=True):
     key_marker = None
     version_id_marker = None
     has_more_items = True
@@ -17,7 +121,8 @@ def list_versions(client, bucket, prefix):
             if key_marker
             else {}
         )
-        result = client.list_object_versions(
+        result = limiter.call(
+            client.list_object_versions,
             Bucket=bucket,
             Prefix=prefix.rstrip("/") + "/",
             MaxKeys=CHUNK_SIZE,
@@ -27,9 +132,10 @@ def list_versions(client, bucket, prefix):
         key_marker = result["KeyMarker"]
         version_id_marker = result["VersionIdMarker"]
 
-        yield from (v for v in result.get("Versions", []) if v["IsLatest"])
+        yield from (v for v in result.get("Versions", []) if v["IsLatest"] or not latest_only)
 
 
+@limited(limiter)
 def get_file_metadata(client, bucket, s3_path):
     obj = client.head_object(Bucket=bucket, Key=s3_path)
     obj["Key"] = s3_path
@@ -37,25 +143,145 @@ def get_file_metadata(client, bucket, s3_path):
 
 
 def upload_file(client, local_path, bucket, s3_path):
-    client.upload_file(local_path, bucket, s3_path)
-    logging.info("⬆ %s [%.3fMB]", s3_path, get_stats(local_path)["size"])
+    size = os.path.getsize(local_path)
+    client.upload_file(local_path, bucket, s3_path, Config=transfer_config(size))
+    logging.info("⬆ %s [%.3fMB]", s3_path, size / MB)
 
 
 def upload_from_fd(client, fd, bucket, s3_path):
-    client.upload_fileobj(fd, bucket, s3_path)
+    fd.seek(0, os.SEEK_END)
+    config = transfer_config(fd.tell())
+    fd.seek(0)
+    client.upload_fileobj(fd, bucket, s3_path, Config=config)
+
+
+@limited(limiter)
+def create_multipart_upload(client, bucket, s3_path) -> str:
+    return client.create_multipart_upload(Bucket=bucket, Key=s3_path)["UploadId"]
+
+
+@limited(limiter, measure=False)
+def upload_part(client, bucket, s3_path, upload_id, part_number, data) -> str:
+    response = client.upload_part(
+        Bucket=bucket, Key=s3_path, UploadId=upload_id, PartNumber=part_number, Body=data
+    )
+    return response["ETag"]
+
+
+@limited(limiter, measure=False)
+def complete_multipart_upload(client, bucket, s3_path, upload_id, parts: Dict[int, str]):
+    response = client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=s3_path,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [{"PartNumber": n, "ETag": parts[n]} for n in sorted(parts)]
+        },
+    )
+    logging.info("⬆ %s [%d parts]", s3_path, len(parts))
+    return response
+
+
+@limited(limiter)
+def abort_multipart_upload(client, bucket, s3_path, upload_id):
+    try:
+        client.abort_multipart_upload(Bucket=bucket, Key=s3_path, UploadId=upload_id)
+    except client.exceptions.NoSuchUpload:
+        pass
+
+
+def list_multipart_uploads(client, bucket, prefix):
+    key_marker = None
+    upload_id_marker = None
+    has_more_items = True
 
+    while has_more_items:
+        extra_kwargs = (
+            {"KeyMarker": key_marker, "UploadIdMarker": upload_id_marker}
+            if key_marker
+            else {}
+        )
+        result = limiter.call(
+            client.list_multipart_uploads,
+            Bucket=bucket,
+            Prefix=prefix,
+            MaxUploads=CHUNK_SIZE,
+            **extra_kwargs
+        )
+        has_more_items = result["IsTruncated"]
+        key_marker = result.get("NextKeyMarker")
+        upload_id_marker = result.get("NextUploadIdMarker")
+
+        yield from result.get("Uploads", [])
+
+
+@limited(limiter, measure=False)
+def put_if_match(client, data: bytes, bucket, s3_path, etag: str) -> str:
+    """
+    Replace the object if it still has `etag`, fails with a
+    `PreconditionFailed` error otherwise. Returns the new etag.
+    """
+    response = client.put_object(Body=data, Bucket=bucket, Key=s3_path, IfMatch=f'"{etag}"')
+    return response["ETag"].strip('"')
 
-def download_file(client, bucket, s3_path, local_path, version=None):
+
+def copy_file(client, bucket, source_path, source_version, s3_path, size) -> Optional[str]:
+    """
+    Copy a version of an object within `bucket`, without the data leaving
+    S3. Returns the version id of the copy.
+    """
+    source = {"Bucket": bucket, "Key": source_path}
+    if source_version:
+        source["VersionId"] = source_version
+    if size <= MAX_COPY_SIZE:
+        version = client.copy_object(CopySource=source, Bucket=bucket, Key=s3_path).get("VersionId")
+    else:
+        # A multipart copy, which does not return the version.
+        client.copy(source, bucket, s3_path, Config=transfer_config(size))
+        version = client.head_object(Bucket=bucket, Key=s3_path).get("VersionId")
+    logging.info("⇢ %s -> %s [%.3fMB]", source_path, s3_path, size / MB)
+    return version
+
+
+def download_file(client, bucket, s3_path, local_path, version=None, size=None):
     extra_args = {'VersionId': version} if version else None
-    client.download_file(bucket, s3_path, local_path, ExtraArgs=extra_args)
-    logging.info("⬇ %s [%.3fMB]", s3_path, get_stats(local_path)["size"])
+    client.download_file(
+        bucket, s3_path, local_path, ExtraArgs=extra_args, Config=transfer_config(size)
+    )
+    if size is None:
+        size = os.path.getsize(local_path)
+    logging.info("⬇ %s [%.3fMB]", s3_path, size / MB)
 
 
-def download_to_fd(client, bucket, s3_path, fd, version=None):
+def download_to_fd(client, bucket, s3_path, fd, version=None, size=None):
+    fd.seek(0)
+    fd.truncate()
     extra_args = {'VersionId': version} if version else None
-    client.download_fileobj(bucket, s3_path, fd, ExtraArgs=extra_args)
+    client.download_fileobj(
+        bucket, s3_path, fd, ExtraArgs=extra_args, Config=transfer_config(size)
+    )
 
 
+@limited(limiter, measure=False)
+def download_range(client, bucket, s3_path, start, end, version=None) -> bytes:
+    """
+    Bytes `start` to `end`, inclusive, of the object.
+    """
+    kwargs = {"Bucket": bucket, "Key": s3_path, "Range": f"bytes={start}-{end}"}
+    if version:
+        kwargs["VersionId"] = version
+    return client.get_object(**kwargs)["Body"].read()
+
+
+@limited(limiter)
+def open_stream(client, bucket, s3_path, version=None):
+    kwargs = {"Bucket": bucket, "Key": s3_path}
+    if version:
+        kwargs["VersionId"] = version
+    return client.get_object(**kwargs)["Body"]
+
+
+@limited(limiter)
 def delete_file(client, bucket, s3_path, version=None):
     kwargs = {
         "Bucket": bucket,
@@ -68,6 +294,80 @@ def delete_file(client, bucket, s3_path, version=None):
     logging.info("❌ %s", s3_path)
 
 
+@limited(limiter)
+def delete_files(client, bucket, objects: List[Dict]) -> List[Dict]:
+    """
+    Delete up to `DELETE_BATCH_SIZE` objects, given as `{"Key": ..., "VersionId":
+    ...}`, in one request. Returns the errors of the keys which failed.
+    """
+    response = client.delete_objects(Bucket=bucket, Delete={"Objects": objects, "Quiet": True})
+    for obj in response.get("Deleted", []):
+        logging.info("❌ %s", obj["Key"])
+    return response.get("Errors", [])
+
+
+class BatchDeleter:
+    """
+    Collects deletes from many threads and sends them with `delete_files`,
+    a batch as soon as a bucket has `DELETE_BATCH_SIZE` of them, the rest on
+    `flush`, or sends batches made by the caller with `send`. Keys failing
+    with a throttling error are sent again after the limiter's backoff, up
+    to `max_attempts` times, other failures are logged and counted.
+    """
+
+    def __init__(self, client, max_attempts: int = 3):
+        self.client = client
+        self.max_attempts = max_attempts
+        self.pending: Dict[str, List[Dict]] = {}
+        self.failed = 0
+        self.lock = Lock()
+
+    def delete(self, bucket: str, s3_path: str, version: str = None) -> None:
+        obj = {"Key": s3_path}
+        if version:
+            obj["VersionId"] = version
+        with self.lock:
+            objects = self.pending.setdefault(bucket, [])
+            objects.append(obj)
+            if len(objects) < DELETE_BATCH_SIZE:
+                return
+            del self.pending[bucket]
+        self.send(bucket, objects)
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for bucket, objects in pending.items():
+            self.send(bucket, objects)
+
+    def send(self, bucket: str, objects: List[Dict]) -> List[Dict]:
+        """
+        Delete up to `DELETE_BATCH_SIZE` `objects` now, returns the errors of
+        those which failed for good.
+        """
+        failed = []
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt > 1:
+                limiter.back_off(attempt - 1)
+            errors = delete_files(self.client, bucket, objects)
+            retry = {_object_id(e) for e in errors if e.get("Code") in THROTTLE_ERROR_CODES}
+            for error in errors:
+                if _object_id(error) not in retry or attempt == self.max_attempts:
+                    logging.error("[S3] Failed to delete %s: %s", error["Key"], error.get("Message"))
+                    failed.append(error)
+                    with self.lock:
+                        self.failed += 1
+            objects = [o for o in objects if _object_id(o) in retry]
+            if not objects:
+                break
+        return failed
+
+
+def _object_id(obj: Dict) -> Tuple[str, Optional[str]]:
+    # The same key may be in a batch once per version.
+    return obj["Key"], obj.get("VersionId")
+
+
 def show_versions(bucket, prefix):
     from pprint import pprint
 
@@ -0,0 +1,90 @@
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from s3rsync.history import NodeHistory
+from s3rsync.sync_action import SyncAction
+
+
+PriorityHook = Callable[[SyncAction], float]
+
+
+def upload_cost(arguments: Dict) -> int:
+    # Signature, delta and etag read the whole file, the base upload sends it.
+    return arguments["node"].size
+
+
+def download_cost(arguments: Dict) -> int:
+    history: NodeHistory = arguments["remote_history"].history
+    stored = arguments["stored_history"]
+    entries, is_absolute = history.diff(stored.history if stored is not None else None)
+    cost = sum(e.delta_size for e in entries)
+    if is_absolute and entries:
+        cost += entries[0].base_size
+        if not entries[0].basis_version:
+            # The entry's own base, its delta is not needed.
+            cost -= entries[0].delta_size
+    return cost
+
+
+COST_ESTIMATES: Dict[str, Callable[[Dict], int]] = {
+    "upload": upload_cost,
+    "download": download_cost,
+}
+
+
+def explicit_priority(action: SyncAction) -> float:
+    return action.priority
+
+
+def recently_modified_first(window: float) -> PriorityHook:
+    """
+    Moves uploads of files modified in the last `window` seconds ahead, the
+    more recent the edit the further.
+    """
+
+    def hook(action: SyncAction) -> float:
+        node = action.arguments.get("node")
+        if node is None:
+            return action.priority
+        age = time.time() - node.modified_time
+        return action.priority + max(window - age, 0)
+
+    return hook
+
+
+class SyncScheduler:
+    """
+    Orders sync actions shortest job first, without starving long ones.
+
+    Every action gets a deadline: the time it was scheduled plus its estimated
+    cost, in bytes, divided by `aging_rate`. Actions run in deadline order, so
+    small actions go first, but an action scheduled later never overtakes a
+    large one by more than the large one's cost allows. A 20GB upload at
+    10MB/s lets edits scheduled in the next ~34 minutes go before it, then it
+    runs.
+
+    `priority_hook` returns seconds by which an action is moved ahead.
+    """
+
+    def __init__(self, aging_rate: float, priority_hook: Optional[PriorityHook] = None):
+        self.aging_rate = aging_rate
+        self.priority_hook = priority_hook or explicit_priority
+
+    def cost(self, action: SyncAction) -> int:
+        estimate = COST_ESTIMATES.get(action.name)
+        if estimate is None:
+            return 0
+        try:
+            return max(estimate(action.arguments), 0)
+        except Exception:
+            # Missing history or size, schedule it as a cheap action.
+            return 0
+
+    def deadline(self, action: SyncAction, now: float) -> float:
+        return now + self.cost(action) / self.aging_rate - self.priority_hook(action)
+
+    def order(self, actions: Iterable[SyncAction]) -> List[Tuple[float, SyncAction]]:
+        now = time.monotonic()
+        scheduled = [(self.deadline(action, now), action) for action in actions]
+        scheduled.sort(key=lambda s: s[0])
+        return scheduled
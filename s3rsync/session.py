@@ -5,9 +5,13 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
-import boto3  # type: ignore
 from dynaconf import settings  # type: ignore
 
+from s3rsync import s3util
+from s3rsync.cpu_pool import CPUPool
+from s3rsync.signature_store import SignatureStore
+from s3rsync.util.file import hash_path
+
 
 @dataclass
 class RootFolder:
@@ -20,6 +24,14 @@ class RootFolder:
         return cls(path=path, fspath=os.fspath(path))
 
 
+def signature_folder(root_folder: RootFolder) -> Path:
+    """
+    One folder per root folder, the store removes the signatures of every
+    node the root folder does not have.
+    """
+    return Path(settings.SIGNATURE_FOLDER) / hash_path(root_folder.fspath)
+
+
 @dataclass
 class Session:
     s3_prefix: str
@@ -28,21 +40,43 @@ class Session:
     storage_bucket: str
     internal_bucket: str
     sync_metadata_prefix: str
-    signature_folder: Path
+    signature_store: SignatureStore
+    cpu_pool: CPUPool
+    deleter: s3util.BatchDeleter
 
     @classmethod
     def create(cls, s3_prefix: str, root_fspath: str) -> Session:
         root_folder = RootFolder.create(root_fspath)
-        signature_folder = Path(settings.SIGNATURE_FOLDER)
-        if not signature_folder.exists():
-            signature_folder.mkdir(parents=True)
+        signature_store = SignatureStore(
+            signature_folder(root_folder),
+            max_size=settings.SIGNATURE_FOLDER_MAX_SIZE,
+        )
+        s3util.limiter.configure(
+            min_limit=settings.S3_MIN_CONCURRENCY,
+            max_limit=settings.S3_MAX_CONCURRENCY,
+            max_attempts=settings.S3_MAX_ATTEMPTS,
+        )
+        s3util.configure_transfers(settings.S3_TRANSFER_PROFILES)
+        s3_client = s3util.create_client(
+            max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+            connect_timeout=settings.S3_CONNECT_TIMEOUT,
+            read_timeout=settings.S3_READ_TIMEOUT,
+            tcp_keepalive=settings.S3_TCP_KEEPALIVE,
+        )
+        cpu_pool = CPUPool(
+            workers=settings.CPU_WORKERS,
+            cache_count=settings.LOADED_SIGNATURE_CACHE_COUNT,
+            cache_size=settings.LOADED_SIGNATURE_CACHE_MAX_SIZE,
+        )
 
         return cls(
             root_folder=root_folder,
             s3_prefix=s3_prefix,
-            s3_client=boto3.client("s3"),
+            s3_client=s3_client,
             storage_bucket=settings.STORAGE_BUCKET,
             internal_bucket=settings.INTERNAL_BUCKET,
             sync_metadata_prefix=settings.SYNC_METADATA_PREFIX,
-            signature_folder=signature_folder
+            signature_store=signature_store,
+            cpu_pool=cpu_pool,
+            deleter=s3util.BatchDeleter(s3_client, max_attempts=settings.S3_MAX_ATTEMPTS),
         )
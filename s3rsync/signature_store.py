@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from librsync import free_signature, load_signature
+
+
+@dataclass
+class StoredSignature:
+    entry_key: str
+    size: int
+
+
+class SignatureStore:
+    """
+    Local copies of the latest signature of each node, kept as
+    `<folder>/<node key>.<entry key>`. Entry keys identify the content the
+    signature was made from, so a signature is never rewritten, only replaced
+    when the node gets a new entry.
+
+    The total size is capped, the least recently used signatures are evicted
+    first. Evicted signatures are downloaded again when needed. A pinned
+    signature, see `pin`, is not evicted, and its file stays until it is
+    unpinned even when the node gets a new one.
+    """
+
+    def __init__(self, folder: Path, max_size: int):
+        self.folder = folder
+        self.max_size = max_size
+        self.size = 0
+        self.signatures: OrderedDict[str, StoredSignature] = OrderedDict()
+        self.lock = Lock()
+        self.pins: Dict[Tuple[str, str], int] = {}
+        # Files of pinned signatures which were removed from the store.
+        self.unlinked: Set[Tuple[str, str]] = set()
+        self._scan()
+
+    def path(self, node_key: str, entry_key: str) -> Path:
+        return self.folder / f"{node_key}.{entry_key}"
+
+    def get(self, node_key: str, entry_key: str) -> Optional[str]:
+        with self.lock:
+            signature = self.signatures.get(node_key)
+            if signature is None or signature.entry_key != entry_key:
+                return None
+            self.signatures.move_to_end(node_key)
+            path = self.path(node_key, entry_key)
+        # The modified time keeps the LRU order across restarts.
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return os.fspath(path)
+
+    @contextmanager
+    def pin(self, node_key: str, entry_key: str) -> Iterator[None]:
+        """
+        Keep the file of the signature, once it is stored, while a job reads
+        it.
+        """
+        pin = node_key, entry_key
+        with self.lock:
+            self.pins[pin] = self.pins.get(pin, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pins[pin] -= 1
+                if not self.pins[pin]:
+                    del self.pins[pin]
+                    if pin in self.unlinked:
+                        self.unlinked.discard(pin)
+                        self._unlink(node_key, entry_key)
+
+    def put(self, node_key: str, entry_key: str, signature_path: str) -> None:
+        path = self.path(node_key, entry_key)
+        shutil.copyfile(signature_path, path)
+        with self.lock:
+            self.unlinked.discard((node_key, entry_key))
+            self._remove(node_key, keep=entry_key)
+            signature = StoredSignature(entry_key=entry_key, size=path.stat().st_size)
+            self.signatures[node_key] = signature
+            self.size += signature.size
+            self._evict()
+
+    def move(self, node_key: str, new_node_key: str) -> None:
+        """
+        Keep the signature of `node_key` as the one of `new_node_key`.
+        """
+        with self.lock:
+            signature = self.signatures.get(node_key)
+            if signature is None:
+                return
+            self._remove(new_node_key)
+            try:
+                os.replace(self.path(node_key, signature.entry_key), self.path(new_node_key, signature.entry_key))
+            except OSError:
+                self._remove(node_key)
+                return
+            del self.signatures[node_key]
+            self.signatures[new_node_key] = signature
+
+    def remove(self, node_key: str) -> None:
+        with self.lock:
+            self._remove(node_key)
+
+    def collect_garbage(self, node_keys: Iterable[str]) -> None:
+        """
+        Remove the signatures of all nodes except `node_keys`.
+        """
+        keep = set(node_keys)
+        with self.lock:
+            for node_key in [k for k in self.signatures if k not in keep]:
+                logging.info("[SIGNATURE] Removing orphan signature %s", node_key)
+                self._remove(node_key)
+
+    def _remove(self, node_key: str, keep: str = None) -> None:
+        signature = self.signatures.pop(node_key, None)
+        if signature is None:
+            return
+        self.size -= signature.size
+        if signature.entry_key == keep:
+            return
+        if (node_key, signature.entry_key) in self.pins:
+            self.unlinked.add((node_key, signature.entry_key))
+            return
+        self._unlink(node_key, signature.entry_key)
+
+    def _unlink(self, node_key: str, entry_key: str) -> None:
+        try:
+            self.path(node_key, entry_key).unlink()
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        evictable = (
+            k for k, s in list(self.signatures.items())[:-1] if (k, s.entry_key) not in self.pins
+        )
+        for node_key in evictable:
+            if self.size <= self.max_size:
+                break
+            logging.info("[SIGNATURE] Evicting signature %s", node_key)
+            self._remove(node_key)
+
+    def _scan(self) -> None:
+        if not self.folder.exists():
+            self.folder.mkdir(parents=True)
+        found = []
+        for path in self.folder.iterdir():
+            node_key, _, entry_key = path.name.partition(".")
+            if not entry_key:
+                # Left from the layout which kept every signature forever.
+                path.unlink()
+                continue
+            stat = path.stat()
+            found.append((stat.st_mtime, node_key, entry_key, stat.st_size))
+        for _, node_key, entry_key, size in sorted(found):
+            self._remove(node_key)
+            self.signatures[node_key] = StoredSignature(entry_key=entry_key, size=size)
+            self.size += size
+        self._evict()
+
+
+@dataclass
+class LoadedSignature:
+    handle: object
+    size: int
+    users: int = 0
+    discarded: bool = False
+
+
+class LoadedSignatureCache:
+    """
+    Signatures loaded by librsync, with their hash tables built, keyed by entry
+    key. Repeated deltas against the same basis reuse them instead of parsing
+    the signature file again. Entry keys are never reused, so a cached
+    signature can outlive its file in the store.
+
+    Bounded by count and by the size of the signature files, a handle is freed
+    once it is evicted and no delta is using it.
+    """
+
+    def __init__(self, max_count: int, max_size: int):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.size = 0
+        self.signatures: OrderedDict[str, LoadedSignature] = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def use(self, entry_key: str, signature_path: str) -> Iterator:
+        loaded = self._acquire(entry_key, signature_path)
+        try:
+            yield loaded.handle if loaded else None
+        finally:
+            if loaded:
+                self._release(loaded)
+
+    def discard(self, entry_key: str) -> None:
+        with self.lock:
+            self._discard(entry_key)
+
+    def clear(self) -> None:
+        with self.lock:
+            for entry_key in list(self.signatures):
+                self._discard(entry_key)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "count": len(self.signatures), "size": self.size}
+
+    def _acquire(self, entry_key: str, signature_path: str) -> Optional[LoadedSignature]:
+        with self.lock:
+            loaded = self.signatures.get(entry_key)
+            if loaded is not None:
+                self.hits += 1
+                self.signatures.move_to_end(entry_key)
+                loaded.users += 1
+                return loaded
+            self.misses += 1
+
+        handle = load_signature(signature_path)
+        if handle is None:
+            return None
+        loaded = LoadedSignature(handle=handle, size=os.path.getsize(signature_path), users=1)
+        with self.lock:
+            if entry_key in self.signatures:
+                # Loaded concurrently, keep ours private to this caller.
+                loaded.discarded = True
+                return loaded
+            self.signatures[entry_key] = loaded
+            self.size += loaded.size
+            while len(self.signatures) > 1 and (
+                len(self.signatures) > self.max_count or self.size > self.max_size
+            ):
+                self._discard(next(iter(self.signatures)))
+        return loaded
+
+    def _release(self, loaded: LoadedSignature) -> None:
+        with self.lock:
+            loaded.users -= 1
+            if loaded.discarded and loaded.users == 0:
+                free_signature(loaded.handle)
+
+    def _discard(self, entry_key: str) -> None:
+        loaded = self.signatures.pop(entry_key, None)
+        if loaded is None:
+            return
+        self.size -= loaded.size
+        loaded.discarded = True
+        if loaded.users == 0:
+            free_signature(loaded.handle)
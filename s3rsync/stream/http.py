@@ -1,41 +1,119 @@
+import io
+from typing import Iterator, Optional
+
 import requests
+from requests.adapters import HTTPAdapter
+
+
+CHUNK_SIZE = 16 * 4096
+POOL_SIZE = 10
+
+_http_session: Optional[requests.Session] = None
+
+
+def get_http_session() -> requests.Session:
+    """
+    Shared `requests.Session`, so consecutive downloads reuse the pooled
+    keep-alive connections instead of opening a new one per request.
+    """
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        _http_session.mount("http://", adapter)
+        _http_session.mount("https://", adapter)
+    return _http_session
 
 
 class HTTPRequest:
-    def __init__(self, url):
+    def __init__(self, url, session: requests.Session = None):
         self.url = url
+        self.session = session or get_http_session()
+        self.response = None
 
     def start(self):
-        self.response = requests.get(self.url, stream=True)
+        self.response = self.session.get(self.url, stream=True)
         self.response.raise_for_status()
-        self.content_iter = self.response.iter_content(chunk_size=16 * 4096)
+        self.content_iter = self.response.iter_content(chunk_size=CHUNK_SIZE)
         return self
 
     def read_chunk(self):
         """ Will raise StopIteration on EOF"""
         return next(self.content_iter)
 
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+
+class ChunkSource(io.RawIOBase):
+    """
+    Read only, non seekable stream over an iterator of byte chunks.
+    """
+
+    def __init__(self):
+        self.chunk = memoryview(b"")
+        self.chunks: Optional[Iterator[bytes]] = None
+        self.eof = False
 
-# TODO: extend io.IOBase
-class HTTPSource:
-    request = None
-    min_buffer_length = 16 * 4096
+    def iter_chunks(self) -> Iterator[bytes]:
+        raise NotImplementedError
 
-    def __init__(self, url):
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.chunk and not self.eof:
+            self.chunk = self._next_chunk()
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def _next_chunk(self) -> memoryview:
+        if self.chunks is None:
+            self.chunks = iter(self.iter_chunks())
+        for chunk in self.chunks:
+            if chunk:
+                return memoryview(chunk)
+        self.eof = True
+        return memoryview(b"")
+
+
+class HTTPSource(ChunkSource):
+    def __init__(self, url, session: requests.Session = None):
+        super().__init__()
         self.url = url
-        self.buffer = None
+        self.request = HTTPRequest(url, session=session)
+
+    def iter_chunks(self):
+        self.request.start()
+        while True:
+            try:
+                yield self.request.read_chunk()
+            except StopIteration:
+                return
+
+    def close(self):
+        self.request.close()
+        super().close()
+
+
+class StreamingBodySource(ChunkSource):
+    """
+    Adapts the `Body` of a boto3 `get_object` response.
+    """
 
-    def read(self):
-        if self.request is None:
-            self.request = HTTPRequest(self.url).start()
+    def __init__(self, body):
+        super().__init__()
+        self.body = body
 
-        # TODO: EOF
-        while not self.buffer or len(self.buffer) < self.min_buffer_length:
-            self.buffer += self.request.read_chunk()
+    def iter_chunks(self):
+        return self.body.iter_chunks(chunk_size=CHUNK_SIZE)
 
-        result = self.buffer
-        self.buffer = None
-        return result
+    def close(self):
+        self.body.close()
+        super().close()
 
 
 class HTTPForwardSeekableSource(HTTPSource):
@@ -66,7 +66,8 @@ class BufferWriter(IOBase):
 
     def write(self, buffer):
         print(self.name, "write <-", buffer)
-        self.queue.put(buffer)
+        # librsync re-uses the buffer it writes from
+        self.queue.put(bytes(buffer))
 
     def seek(self, offset, whence=os.SEEK_SET):
         print(self.name, "seek", 0, offset, whence)
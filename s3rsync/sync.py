@@ -1,21 +1,28 @@
 import enum
-from copy import copy
 from functools import partial
 from itertools import chain, groupby
 import logging
+from pathlib import Path
 from queue import Queue
-from typing import Callable, Any, List, Tuple, Iterable
+import time
+from typing import Callable, Any, List, Optional, Tuple
 
+from dynaconf import settings  # type: ignore
+
+from s3rsync import file_transfer, s3util
 from s3rsync.session import Session
 from s3rsync.history import RemoteNodeHistory
-from s3rsync.models import StoredNodeHistory, RootFolder
-from s3rsync.node import LocalNode
-from s3rsync.sync_action import SyncActionExecutor, SyncAction
-from s3rsync.sync_logic import handle_node
+from s3rsync import local_db
+from s3rsync.models import ContentIndex, StoredNodeHistory, RootFolder, history_cache
+from s3rsync.pipeline import SyncPipeline
+from s3rsync.planner import plan_actions
+from s3rsync.scheduler import SyncScheduler, recently_modified_first
+from s3rsync.sync_action import Stage, SyncAction
+from s3rsync.tree_snapshot import TreeSnapshot
 from s3rsync.s3util import list_versions
 from s3rsync.util.timeout import Timeout
 from s3rsync.util.row import Row
-from s3rsync.util.file import iter_folder
+from s3rsync.util.file import hash_path
 
 
 class SyncWorkerEvent(str, enum.Enum):
@@ -32,7 +39,21 @@ class SyncWorker:
         )
 
         self.sync_action_producer = SyncActionProducer(session)
-        self.sync_action_executor = SyncActionExecutor(session)
+        self.sync_pipeline = SyncPipeline(
+            session,
+            workers={
+                Stage.FETCH: settings.PIPELINE_FETCH_WORKERS,
+                Stage.COMPUTE: session.cpu_pool.workers,
+                Stage.TRANSFER: settings.PIPELINE_TRANSFER_WORKERS,
+            },
+            queue_size=settings.PIPELINE_QUEUE_SIZE,
+            scheduler=SyncScheduler(
+                aging_rate=settings.SCHEDULER_AGING_RATE,
+                priority_hook=recently_modified_first(settings.SCHEDULER_RECENT_WINDOW),
+            ),
+            writer=local_db.writer,
+            commit_batch_size=settings.PIPELINE_COMMIT_BATCH_SIZE,
+        )
 
         self.event_queue: Any = Queue()
         self.sync_actions: List[Callable] = []
@@ -55,9 +76,12 @@ class SyncWorker:
         logging.info("[SYNC] Running sync")
         self.sync_actions = self.sync_action_producer.produce()
         logging.info("[SYNC] Sync produced actions: %r", self.sync_actions)
-        for action in self.sync_actions:
-            logging.info("[SYNC] Executing sync action: %r", action)
-            self.sync_action_executor.do_action(action)
+        self.sync_pipeline.run(self.sync_actions)
+        self.session.deleter.flush()
+        self.sync_actions = []
+        logging.info("[SYNC] S3 limiter: %r", s3util.limiter.stats)
+        logging.info("[SYNC] History cache: %r", history_cache.stats)
+        logging.info("[SYNC] DB writer: %r", local_db.writer.stats)
 
     def do_sync(self):
         self.sync_timeout.stop()
@@ -68,17 +92,14 @@ class SyncWorker:
 
     def do_sync_action(self):
         if self.sync_actions:
-            action = self.sync_actions.pop(0)
-            logging.info("[SYNC] Executing sync action: %r", action)
-            self.sync_action_executor.do_action(action)
-            self.schedule_event(SyncWorkerEvent.SYNC_ACTION)
-        else:
-            logging.info("[SYNC] Starting timer")
-            self.sync_timeout.start()
-
-
-class NodeRow(Row):
-    value_types = [RemoteNodeHistory, LocalNode, StoredNodeHistory]
+            actions, self.sync_actions = self.sync_actions, []
+            self.sync_pipeline.run(actions)
+            self.session.deleter.flush()
+            logging.info("[SYNC] S3 limiter: %r", s3util.limiter.stats)
+            logging.info("[SYNC] History cache: %r", history_cache.stats)
+            logging.info("[SYNC] DB writer: %r", local_db.writer.stats)
+        logging.info("[SYNC] Starting timer")
+        self.sync_timeout.start()
 
 
 class HistoryRow(Row):
@@ -88,22 +109,38 @@ class HistoryRow(Row):
 class SyncActionProducer:
     def __init__(self, session: Session):
         self.session = session
+        self.snapshot_path = snapshot_path(session)
+        # The tree as it was last scanned, also before a restart.
+        self.snapshot = TreeSnapshot.load(self.snapshot_path)
+        self.uploads_cleaned: Optional[float] = None
 
     def produce(self) -> List[SyncAction]:
         remote_history, stored_history = fetch_history(self.session)
-        local_nodes = scan_local_files(self.session)
-
-        all_nodes = list(chain(remote_history, local_nodes, stored_history))
-        all_nodes.sort(key=lambda n: n.key)  # type: ignore
-        rows = [
-            NodeRow.create(key, nodes)
-            for key, nodes in groupby(all_nodes, key=lambda n: n.key)  # type: ignore
-        ]
-        actions = []
-        for _, remote, local, stored in rows:
-            actions.append(handle_node(remote, local, stored))
-
-        return actions
+        local_db.writer.write(ContentIndex.refresh, RootFolder.for_session(self.session), remote_history)
+        self.session.signature_store.collect_garbage(s.key for s in stored_history)
+        if (
+            self.uploads_cleaned is None
+            or time.monotonic() - self.uploads_cleaned >= settings.MULTIPART_UPLOAD_CLEANUP_INTERVAL
+        ):
+            file_transfer.cleanup_uploads(self.session, settings.MULTIPART_UPLOAD_MAX_AGE)
+            self.uploads_cleaned = time.monotonic()
+        snapshot = self.scan()
+        return plan_actions(self.session.root_folder.path, snapshot, remote_history, stored_history)
+
+    def scan(self) -> TreeSnapshot:
+        snapshot = TreeSnapshot.scan(self.session.root_folder.path)
+        if self.snapshot is not None:
+            added, changed, removed = snapshot.diff(self.snapshot)
+            logging.info(
+                "[SYNC] Local changes since the last scan: %d added, %d changed, %d removed",
+                len(added), len(changed), len(removed),
+            )
+            self.snapshot.close()
+        snapshot.save(self.snapshot_path)
+        # Mapped, the columns are paged in from the file instead of held
+        # in memory.
+        self.snapshot = TreeSnapshot.load(self.snapshot_path) or snapshot
+        return self.snapshot
 
 
 def fetch_history(session: Session) -> Tuple[List[RemoteNodeHistory], List[StoredNodeHistory]]:
@@ -115,7 +152,9 @@ def fetch_history(session: Session) -> Tuple[List[RemoteNodeHistory], List[Store
     remote_history = (
         RemoteNodeHistory.from_s3_object(v) for v in remote_history_versions
     )
-    stored_history = StoredNodeHistory.select().where(
+    # Histories are loaded below, only for the nodes whose remote history
+    # is unchanged.
+    stored_history = StoredNodeHistory.select_summary().where(
         StoredNodeHistory.root_folder == RootFolder.for_session(session)
     )
     all_history = list(chain(remote_history, stored_history))
@@ -124,12 +163,19 @@ def fetch_history(session: Session) -> Tuple[List[RemoteNodeHistory], List[Store
         HistoryRow.create(key, history)
         for key, history in groupby(all_history, key=lambda h: h.key)
     ]
+    StoredNodeHistory.load_histories([
+        stored for _, remote, stored in rows
+        if remote and stored and remote.etag == stored.remote_history_etag
+    ])
     for _, remote, stored in rows:
         if remote:
             if not stored or remote.etag != stored.remote_history_etag:
                 remote.load(session)
             else:
-                remote.history = copy(stored.history)
+                # The stored history is shared through the history cache,
+                # changes go to a copy of its entries.
+                history = stored.history
+                remote.history = history.copy(update={"entries": list(history.entries)})
 
     return (
         [r for _, r, s in rows if r is not None],
@@ -137,7 +183,8 @@ def fetch_history(session: Session) -> Tuple[List[RemoteNodeHistory], List[Store
     )
 
 
-def scan_local_files(session: Session) -> Iterable[LocalNode]:
-    return (
-        LocalNode.create(p, session) for p in iter_folder(session.root_folder.path)
-    )
+def snapshot_path(session: Session) -> Path:
+    """
+    Next to the local DB, one snapshot per root folder.
+    """
+    return Path(settings.LOCAL_DB).with_name(f"tree-{hash_path(session.root_folder.fspath)}.snapshot")
@@ -1,14 +1,22 @@
+import enum
+import inspect
+import logging
 import os
+import shutil
 from dataclasses import dataclass
 from functools import partial, wraps
 from pathlib import Path
-from typing import Callable, Optional, cast
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, cast
 
-from s3rsync import file_transfer, s3util
+from botocore.exceptions import ClientError  # type: ignore
+from dynaconf import settings  # type: ignore
+
+from s3rsync import file_transfer
+from s3rsync.exceptions import RsyncError
 from s3rsync.history import NodeHistory, RemoteNodeHistory, NodeHistoryEntry
-from s3rsync.models import RootFolder, StoredNodeHistory
+from s3rsync.models import ContentIndex, RootFolder, StoredNodeHistory
 from s3rsync.node import LocalNode
-from s3rsync.rsync import calc_delta, calc_signature, patch_file
+from s3rsync.rsync import calc_delta, calc_signature, fetch_signature, patch_file
 from s3rsync.session import Session
 from s3rsync.util.file import create_temp_file
 
@@ -18,25 +26,61 @@ class SyncActionResult:
     pass
 
 
+class Stage(str, enum.Enum):
+    """
+    Stages of a sync action, in the order they run. Actions written as
+    generators yield the stage the code following the yield belongs to, see
+    `SyncPipeline`.
+    """
+
+    FETCH = "fetch"
+    COMPUTE = "compute"
+    TRANSFER = "transfer"
+    COMMIT = "commit"
+
+
+StagedSyncActionResult = Generator[Stage, None, SyncActionResult]
+
+
 class SyncAction:
     def __init__(self, action: Callable):
         self.action = action
+        # Seconds the action is moved ahead of its cost based place in the
+        # schedule, see `SyncScheduler`.
+        self.priority = 0.0
+
+    @property
+    def name(self) -> str:
+        return self.action.func.__name__  # type: ignore
+
+    @property
+    def arguments(self) -> Dict[str, Any]:
+        """
+        The arguments the action was created with, by name.
+        """
+        func = self.action.func  # type: ignore
+        bound = inspect.signature(func).bind_partial(*self.action.args, **self.action.keywords)  # type: ignore
+        return bound.arguments
 
     def __call__(self, *args, **kwargs):
+        steps = self.steps(*args, **kwargs)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as e:
+                return e.value
+
+    def steps(self, *args, **kwargs) -> StagedSyncActionResult:
+        if inspect.isgeneratorfunction(self.action.func):  # type: ignore
+            return (yield from self.action(*args, **kwargs))
+        # Actions which are not split in stages only touch the local DB and disk.
+        yield Stage.COMMIT
         return self.action(*args, **kwargs)
 
     def __repr__(self) -> str:
         return f"{self.action.func.__name__}({self.action.args, self.action.keywords})"  # type: ignore
 
 
-class SyncActionExecutor:
-    def __init__(self, session: Session):
-        self.session = session
-
-    def do_action(self, action: SyncAction) -> SyncActionResult:
-        return action(self.session)
-
-
 def action(func):
     @wraps(func)
     def wrapper(*args, **kwargs) -> Callable[[Session], SyncActionResult]:
@@ -48,13 +92,16 @@ def action(func):
 @action
 def upload(
     remote_history: Optional[RemoteNodeHistory], node: LocalNode, session: Session
-) -> SyncActionResult:
+) -> StagedSyncActionResult:
     """
     1. Without remote history:
-      - Calc signature
-      - Generate id
+      - With `DELTA_BASIS_SEARCH`: fetch signatures of similar nodes
+      - Calc etag
+      - Content in `ContentIndex`: copy its base within S3, share its entry
+      - Otherwise: calc signature, generate id
+      - Small delta against a similar node's base: upload delta
+      - Otherwise: upload base
       - Create new history
-      - Upload base
       - Upload history
       - Store history in local DB
 
@@ -62,7 +109,8 @@ def upload(
       - Generate key
       - Calc delta
       - Calc signature
-      - Upload delta
+      - Upload delta, or upload base if the deltas since the latest base
+        would outgrow it, see `NodeHistory.needs_rebase`
       - Upload signature
       - Add history record
       - Upload history
@@ -72,62 +120,157 @@ def upload(
     new_key = NodeHistoryEntry.generate_key()
     if remote_history is not None:
         history = cast(NodeHistory, remote_history.history)
-        with create_temp_file() as delta_path:
-            calc_delta(session, node.local_fspath, history.last.key, delta_path)
-            file_transfer.upload_metadata(session, delta_path, new_key, "delta")
+        yield Stage.FETCH
+        fetch_signature(session, node.key, history.last.key)
+        yield Stage.COMPUTE
+        with create_temp_file() as delta_path, create_temp_file() as signature_path:
+            calc_delta(session, node.local_fspath, node.key, history.last.key, delta_path)
             delta_size = Path(delta_path).stat().st_size
-        with create_temp_file() as signature_path:
-            calc_signature(session, node.local_fspath, new_key, signature_path)
+            rebase = history.needs_rebase(delta_size, settings.HISTORY_REBASE_RATIO)
+            calc_signature(session, node.local_fspath, node.key, new_key, signature_path)
+            node.calc_etag()
+            yield Stage.TRANSFER
+            if not rebase:
+                file_transfer.upload_metadata(session, delta_path, new_key, "delta")
             file_transfer.upload_metadata(session, signature_path, new_key, "signature")
 
-        history.add_entry(NodeHistoryEntry.create_delta_only(
-            new_key, node.calc_etag(), delta_size
-        ))
+        if rebase:
+            version = file_transfer.upload_to_root(session, node)
+            history.add_entry(NodeHistoryEntry.create_base_only(new_key, node.calc_etag(), version, node.size))
+        else:
+            history.add_entry(NodeHistoryEntry.create_delta_only(
+                new_key, node.calc_etag(), delta_size
+            ))
     else:
-        with create_temp_file() as signature_path:
-            calc_signature(session, node.local_fspath, new_key, signature_path)
-            file_transfer.upload_metadata(session, signature_path, new_key, "signature")
-
-        version = file_transfer.upload_to_root(session, node)
+        candidates: List[ContentIndex] = []
+        if settings.DELTA_BASIS_SEARCH:
+            yield Stage.FETCH
+            candidates = ContentIndex.basis_candidates(
+                RootFolder.for_session(session),
+                node.key,
+                node.path,
+                node.size,
+                settings.DELTA_BASIS_CANDIDATES,
+                settings.DELTA_BASIS_SIZE_RANGE,
+            )
+            candidates = [c for c in candidates if try_fetch_signature(session, c)]
+        yield Stage.COMPUTE
+        duplicate = ContentIndex.find(RootFolder.for_session(session), node.calc_etag(), node.size)
+        if duplicate is not None and duplicate.key != node.key:
+            # Stored whole under another path: copied within S3, and the
+            # entry, with its signature, is shared.
+            new_key = duplicate.entry_key
+            signature_path = session.signature_store.get(duplicate.key, new_key)
+            if signature_path is not None:
+                session.signature_store.put(node.key, new_key, signature_path)
+            yield Stage.TRANSFER
+            version = file_transfer.copy_in_root(
+                session, duplicate.path, duplicate.base_version, node.path, node.size
+            )
+            entry = NodeHistoryEntry.create_base_only(new_key, node.calc_etag(), version, node.size)
+        else:
+            with create_temp_file() as signature_path, create_temp_file() as delta_path:
+                calc_signature(session, node.local_fspath, node.key, new_key, signature_path)
+                basis = choose_basis(session, node, candidates, delta_path)
+                yield Stage.TRANSFER
+                file_transfer.upload_metadata(session, signature_path, new_key, "signature")
+                if basis is not None:
+                    file_transfer.upload_metadata(session, delta_path, new_key, "delta")
+
+            if basis is not None:
+                basis_node, delta_size = basis
+                entry = NodeHistoryEntry.create_basis_delta(
+                    new_key, node.calc_etag(), delta_size, basis_node.path, basis_node.base_version, basis_node.size
+                )
+            else:
+                version = file_transfer.upload_to_root(session, node)
+                entry = NodeHistoryEntry.create_base_only(new_key, node.calc_etag(), version, node.size)
 
         history = NodeHistory(key=node.key, path=node.path, entries=[])
-        history.add_entry(NodeHistoryEntry.create_base_only(
-            new_key, node.calc_etag(), version, node.size
-        ))
+        history.add_entry(entry)
         remote_history = RemoteNodeHistory(history=history, key=node.key, etag=None)
 
     remote_history.save(session)
 
-    stored_history = StoredNodeHistory.get_or_none(StoredNodeHistory.key == history.key)
-    if stored_history is not None:
-        stored_history.data = history.dict()
-        stored_history.remote_history_etag = remote_history.etag
-        stored_history.local_modified_time = node.created_time
-        stored_history.local_created_time = node.modified_time
-        stored_history.save()
-    else:
-        StoredNodeHistory.create(
-            key=remote_history.key,
-            root_folder=RootFolder.for_session(session),
-            data=cast(NodeHistory, remote_history.history).dict(),
-            local_modified_time=node.created_time,
-            local_created_time=node.modified_time,
-            remote_history_etag=remote_history.etag
-        )
-
+    yield Stage.COMMIT
+    StoredNodeHistory.upsert(
+        RootFolder.for_session(session),
+        history,
+        remote_history.etag,
+        local_modified_time=node.created_time,
+        local_created_time=node.modified_time,
+        local_inode=node.inode,
+        local_size=node.size,
+    )
     return SyncActionResult()
 
 
+def try_fetch_signature(session: Session, candidate: ContentIndex) -> bool:
+    try:
+        fetch_signature(session, candidate.key, candidate.entry_key)
+    except (ClientError, RsyncError):
+        # Collected since it was indexed, for one.
+        logging.warning("[BASIS] No signature of %s, skipping it", candidate.path, exc_info=True)
+        return False
+    return True
+
+
+def choose_basis(
+    session: Session, node: LocalNode, candidates: List[ContentIndex], delta_path: str
+) -> Optional[Tuple[ContentIndex, int]]:
+    """
+    The candidate `node` has the smallest delta against, and the size of
+    the delta, which is left in `delta_path`. None when no delta is under
+    `DELTA_BASIS_MAX_DELTA` of the size of `node`.
+    """
+    best = None
+    max_size = node.size * settings.DELTA_BASIS_MAX_DELTA
+    with create_temp_file() as tmp_path:
+        for candidate in candidates:
+            try:
+                calc_delta(session, node.local_fspath, candidate.key, candidate.entry_key, tmp_path)
+            except (ClientError, RsyncError):
+                logging.warning("[BASIS] Delta against %s failed, skipping it", candidate.path, exc_info=True)
+                continue
+            delta_size = Path(tmp_path).stat().st_size
+            if delta_size < max_size and (best is None or delta_size < best[1]):
+                shutil.copyfile(tmp_path, delta_path)
+                best = candidate, delta_size
+    return best
+
+
+def download_start(
+    session: Session, history: NodeHistory, entries: List[NodeHistoryEntry]
+) -> Tuple[Path, List[NodeHistoryEntry]]:
+    """
+    Download the base `entries` start from, returns where it is and the
+    entries whose deltas are still to be applied on it.
+    """
+    first = entries[0]
+    if first.basis_version:
+        # A delta against the base of another node, or that base itself for
+        # entries archived before the node was moved.
+        local_path = file_transfer.download_to_root(
+            session, history.path, first.basis_version, first.base_size, source_path=first.basis_path
+        )
+        return local_path, entries if first.has_delta else entries[1:]
+    local_path = file_transfer.download_to_root(
+        session, history.path, first.base_version, first.base_size, first.etag
+    )
+    return local_path, entries[1:]
+
+
 @action
 def download(
     remote_history: RemoteNodeHistory,
     stored_history: Optional[StoredNodeHistory],
     session: Session,
-) -> SyncActionResult:
+) -> StagedSyncActionResult:
     """
     1. Without local history
       - Find latest base
-      - Download latest base
+      - Download latest base, or the base of another node the first entry
+        is a delta against, and patch
       - Store history in local DB
     2. With local history
       - Diff remote and local history and find shortest path
@@ -135,46 +278,31 @@ def download(
       - Store history in local DB
     """
     history = cast(NodeHistory, remote_history.history)
-    if stored_history is not None:
-        entries, is_absolute = history.diff(stored_history.history)
-        if is_absolute:
-            local_path = file_transfer.download_to_root(
-                session, history.path, entries[0].base_version
-            )
-            entries = entries[1:]
-        else:
-            local_path = session.root_folder.path / history.path
-        if entries:
-            patch_file(session, os.fspath(local_path), [e.key for e in entries])
-        local_node = LocalNode.create(local_path, session)
-        stored_history.data = history.dict()  # type: ignore
-        stored_history.local_modified_time = local_node.created_time
-        stored_history.local_created_time = local_node.modified_time
-        stored_history.remote_history_etag = remote_history.etag
-    else:
-        entries, is_absolute = history.diff(None)
-        local_path = file_transfer.download_to_root(
-            session, history.path, entries[0].base_version
-        )
-        if entries[1:]:
-            patch_file(session, os.fspath(local_path), [e.key for e in entries[1:]])
-        local_node = LocalNode.create(local_path, session)
-        stored_history = StoredNodeHistory(
-            key=remote_history.key,
-            root_folder=RootFolder.for_session(session),
-            data=history.dict(),
-            local_modified_time=local_node.created_time,
-            local_created_time=local_node.modified_time,
-            remote_history_etag=remote_history.etag
-        )
-
+    yield Stage.TRANSFER
+    entries, is_absolute = history.diff(stored_history.history if stored_history is not None else None)
     last_entry = entries[-1]
-    file_transfer.download_metadata(
-        session, last_entry.key, "signature",
-        os.fspath(session.signature_folder / last_entry.key)
+    if is_absolute:
+        local_path, deltas = download_start(session, history, entries)
+    else:
+        local_path, deltas = session.root_folder.path / history.path, entries
+    if deltas:
+        patch_file(session, os.fspath(local_path), [e.key for e in deltas])
+    local_node = LocalNode.create(local_path, session)
+
+    with create_temp_file() as signature_path:
+        file_transfer.download_metadata(session, last_entry.key, "signature", signature_path)
+        session.signature_store.put(history.key, last_entry.key, signature_path)
+
+    yield Stage.COMMIT
+    StoredNodeHistory.upsert(
+        RootFolder.for_session(session),
+        history,
+        remote_history.etag,
+        local_modified_time=local_node.created_time,
+        local_created_time=local_node.modified_time,
+        local_inode=local_node.inode,
+        local_size=local_node.size,
     )
-
-    stored_history.save()
     return SyncActionResult()
 
 
@@ -182,9 +310,9 @@ def download(
 def delete_local(
     node: LocalNode, stored_history: StoredNodeHistory, session: Session
 ) -> SyncActionResult:
-    (session.signature_folder / stored_history.history.last.key).unlink()
+    session.signature_store.remove(stored_history.key)
     (node.root_folder / node.path).unlink()
-    stored_history.delete().execute()
+    stored_history.delete_instance()
     return SyncActionResult()
 
 
@@ -193,16 +321,73 @@ def delete_remote(
     remote_history: RemoteNodeHistory,
     stored_history: StoredNodeHistory,
     session: Session,
-) -> SyncActionResult:
+) -> StagedSyncActionResult:
     history = cast(NodeHistory, remote_history.history)
-    (session.signature_folder / history.last.key).unlink()
-    s3util.delete_file(
-        session.s3_client, session.storage_bucket,
-        f"{session.s3_prefix}/{history.path}"
-    )
+    yield Stage.TRANSFER
+    session.signature_store.remove(history.key)
+    # Sent in batches, see `SyncWorker`. A failed delete leaves the object
+    # in place, the delete marker in the history still hides it.
+    session.deleter.delete(session.storage_bucket, f"{session.s3_prefix}/{history.path}")
     history.add_delete_marker()
     remote_history.save(session)
-    stored_history.delete().execute()
+    yield Stage.COMMIT
+    stored_history.delete_instance()
+    return SyncActionResult()
+
+
+@action
+def move(
+    remote_history: RemoteNodeHistory,
+    stored_history: StoredNodeHistory,
+    node: LocalNode,
+    session: Session,
+) -> StagedSyncActionResult:
+    """
+    `node` is the file last synced as `remote_history`, moved to another path.
+    1. Copy the latest base to the new path within S3
+    2. Give the new node the entries since that base, their deltas and
+       signatures are shared, and the local signature
+    3. Archive the older entries of the old node for the new one, their
+       bases stay with the old path and are referred to as bases of another
+       node
+    4. Delete the old node, as `delete_remote`
+    5. Store history in local DB
+    """
+    old_history = cast(NodeHistory, remote_history.history)
+    history = NodeHistory(key=node.key, path=node.path, entries=[e.copy() for e in old_history.entries])
+    archived = history.compact()
+    base = history.entries[0]
+    yield Stage.TRANSFER
+    if base.base_version:
+        base.base_version = file_transfer.copy_in_root(
+            session, old_history.path, base.base_version, node.path, base.base_size
+        )
+    new_remote_history = RemoteNodeHistory(history=history, key=node.key, etag=None)
+    archived = remote_history.load_archive(session) + archived
+    if archived:
+        for entry in archived:
+            if entry.base_version:
+                entry.basis_path, entry.basis_version = old_history.path, entry.base_version
+                entry.base_version = None
+        new_remote_history.save_segment(session, archived)
+    new_remote_history.save(session)
+    session.signature_store.move(old_history.key, node.key)
+
+    session.deleter.delete(session.storage_bucket, f"{session.s3_prefix}/{old_history.path}")
+    old_history.add_delete_marker()
+    remote_history.save(session)
+
+    yield Stage.COMMIT
+    stored_history.delete_instance()
+    StoredNodeHistory.upsert(
+        RootFolder.for_session(session),
+        history,
+        new_remote_history.etag,
+        local_modified_time=node.created_time,
+        local_created_time=node.modified_time,
+        local_inode=node.inode,
+        local_size=node.size,
+    )
     return SyncActionResult()
 
 
@@ -212,20 +397,21 @@ def save_history(
     node: LocalNode,
     session: Session
 ) -> SyncActionResult:
-    StoredNodeHistory.create(
-        key=remote_history.key,
-        root_folder=RootFolder.for_session(session),
-        data=cast(NodeHistory, remote_history.history).dict(),
+    StoredNodeHistory.upsert(
+        RootFolder.for_session(session),
+        cast(NodeHistory, remote_history.history),
+        remote_history.etag,
         local_modified_time=node.created_time,
         local_created_time=node.modified_time,
-        remote_history_etag=remote_history.etag
+        local_inode=node.inode,
+        local_size=node.size,
     )
     return SyncActionResult()
 
 
 @action
 def delete_history(stored_history: StoredNodeHistory, session: Session) -> SyncActionResult:
-    stored_history.delete().execute()
+    stored_history.delete_instance()
     return SyncActionResult()
 
 
@@ -0,0 +1,221 @@
+"""
+Array backed snapshot of a local tree, one entry per file ordered by node
+key, kept as columns instead of a `LocalNode` per file:
+
+    magic, version, count, size of the paths
+    keys          count x 16 bytes, md5 digests of the paths
+    sizes         count x int64
+    modified      count x int64
+    created       count x int64
+    inodes        count x int64
+    path offsets  (count + 1) x uint64, into the paths
+    paths         utf-8, one after another
+
+Columns are in native byte order, the file is a local cache and is rebuilt
+on any mismatch. A loaded snapshot is memory-mapped, the columns are views
+of the file.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from array import array
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+
+from s3rsync.node import LocalNode
+
+
+MAGIC = b"\x89TS\n"
+VERSION = 2
+HEADER = struct.Struct("=4sIQQ")
+KEY_SIZE = 16
+
+Column = Union[array, memoryview]
+
+
+class TreeSnapshot:
+    def __init__(
+        self,
+        keys: Union[bytes, memoryview],
+        sizes: Column,
+        modified_times: Column,
+        created_times: Column,
+        inodes: Column,
+        path_offsets: Column,
+        paths: Union[bytes, memoryview],
+        buffer: Optional[mmap.mmap] = None,
+    ):
+        self.keys = keys
+        self.sizes = sizes
+        self.modified_times = modified_times
+        self.created_times = created_times
+        self.inodes = inodes
+        self.path_offsets = path_offsets
+        self.paths = paths
+        self.buffer = buffer
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def key(self, i: int) -> str:
+        return self.keys[i * KEY_SIZE:(i + 1) * KEY_SIZE].hex()
+
+    def digest(self, i: int) -> bytes:
+        return bytes(self.keys[i * KEY_SIZE:(i + 1) * KEY_SIZE])
+
+    def path(self, i: int) -> str:
+        return bytes(self.paths[self.path_offsets[i]:self.path_offsets[i + 1]]).decode("utf-8")
+
+    def find(self, key: str) -> Optional[int]:
+        digest = bytes.fromhex(key)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.digest(lo) == digest:
+            return lo
+        return None
+
+    def node(self, i: int, root_folder: Path) -> LocalNode:
+        return LocalNode(
+            root_folder=root_folder,
+            path=self.path(i),
+            modified_time=self.modified_times[i],
+            created_time=self.created_times[i],
+            size=self.sizes[i],
+            etag=None,
+            inode=self.inodes[i],
+        )
+
+    def same_file(self, i: int, other: TreeSnapshot, j: int) -> bool:
+        return (
+            self.sizes[i] == other.sizes[j]
+            and self.modified_times[i] == other.modified_times[j]
+            and self.created_times[i] == other.created_times[j]
+        )
+
+    def diff(self, previous: TreeSnapshot) -> Tuple[List[int], List[int], List[int]]:
+        """
+        Indices of the files added here and changed since `previous`, and of
+        the files removed, in `previous`.
+        """
+        added, changed, removed = [], [], []
+        i, j = 0, 0
+        while i < len(self) or j < len(previous):
+            key = self.digest(i) if i < len(self) else None
+            previous_key = previous.digest(j) if j < len(previous) else None
+            if previous_key is None or (key is not None and key < previous_key):
+                added.append(i)
+                i += 1
+            elif key is None or previous_key < key:
+                removed.append(j)
+                j += 1
+            else:
+                if not self.same_file(i, previous, j):
+                    changed.append(i)
+                i += 1
+                j += 1
+        return added, changed, removed
+
+    @classmethod
+    def scan(cls, root_folder: Path) -> TreeSnapshot:
+        paths: List[bytes] = []
+        stats: List[os.stat_result] = []
+        for path, stat in _scan_folder(os.fspath(root_folder), ""):
+            paths.append(path.encode("utf-8"))
+            stats.append(stat)
+        digests = [hashlib.md5(p).digest() for p in paths]
+        order = sorted(range(len(paths)), key=digests.__getitem__)
+
+        keys = bytearray()
+        sizes, modified_times, created_times, inodes = array("q"), array("q"), array("q"), array("q")
+        path_offsets = array("Q", [0])
+        blob = bytearray()
+        for i in order:
+            keys += digests[i]
+            stat = stats[i]
+            sizes.append(stat.st_size)
+            modified_times.append(int(stat.st_mtime))
+            created_times.append(int(stat.st_ctime))
+            inodes.append(stat.st_ino)
+            blob += paths[i]
+            path_offsets.append(len(blob))
+        return cls(bytes(keys), sizes, modified_times, created_times, inodes, path_offsets, bytes(blob))
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self), len(self.paths)))
+            f.write(self.keys)
+            for column in (self.sizes, self.modified_times, self.created_times, self.inodes, self.path_offsets):
+                f.write(column)
+            f.write(self.paths)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> Optional[TreeSnapshot]:
+        """
+        Memory-map a saved snapshot, None if there is none or it is not
+        readable.
+        """
+        try:
+            with open(path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, version, count, paths_size = HEADER.unpack_from(buffer)
+        except struct.error:
+            magic = None
+        if magic != MAGIC or version != VERSION or len(buffer) != _file_size(count, paths_size):
+            logging.info("[SNAPSHOT] Ignoring unreadable snapshot %s", path)
+            buffer.close()
+            return None
+        view = memoryview(buffer)
+        offset = HEADER.size
+
+        def take(size: int) -> memoryview:
+            nonlocal offset
+            column = view[offset:offset + size]
+            offset += size
+            return column
+
+        keys = take(count * KEY_SIZE)
+        sizes = take(count * 8).cast("q")
+        modified_times = take(count * 8).cast("q")
+        created_times = take(count * 8).cast("q")
+        inodes = take(count * 8).cast("q")
+        path_offsets = take((count + 1) * 8).cast("Q")
+        paths = take(paths_size)
+        return cls(keys, sizes, modified_times, created_times, inodes, path_offsets, paths, buffer)
+
+    def close(self) -> None:
+        if self.buffer is None:
+            return
+        columns = (
+            self.keys, self.sizes, self.modified_times, self.created_times, self.inodes, self.path_offsets, self.paths
+        )
+        for column in columns:
+            column.release()  # type: ignore
+        self.buffer.close()
+        self.buffer = None
+
+
+def _file_size(count: int, paths_size: int) -> int:
+    return HEADER.size + count * KEY_SIZE + count * 8 * 4 + (count + 1) * 8 + paths_size
+
+
+def _scan_folder(folder: str, prefix: str) -> Iterator[Tuple[str, os.stat_result]]:
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield prefix + entry.name, entry.stat()
+            elif entry.is_dir():
+                yield from _scan_folder(entry.path, prefix + entry.name + "/")
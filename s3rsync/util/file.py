@@ -1,5 +1,6 @@
 from contextlib import contextmanager
 import hashlib
+import io
 import logging
 import os
 import os.path
@@ -31,6 +32,51 @@ def create_temp_file():
         pass
 
 
+class FileSlice(io.RawIOBase):
+    """
+    `size` bytes of the file at `path` from `offset`, read as a file of
+    their own through a handle of their own, so a part of a large file is
+    sent without holding it in memory.
+    """
+
+    def __init__(self, path: str, offset: int, size: int):
+        self.file = open(path, "rb")
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, position: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        self.position = max(0, min(position, self.size))
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer)[:self.size - self.position]
+        self.file.seek(self.offset + self.position)
+        count = self.file.readinto(view) or 0
+        self.position += count
+        return count
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
+
+
 def file_checksum(file_name: str, hash_func: str = "md5") -> Optional[str]:
     try:
         hash = hashlib.new(hash_func)
@@ -0,0 +1,241 @@
+import logging
+import random
+import time
+from functools import wraps
+from threading import Condition, local
+from typing import Callable, Dict, Optional
+
+from botocore.exceptions import (  # type: ignore
+    ClientError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+
+THROTTLE_ERROR_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "InternalError",
+    "503",
+    "500",
+}
+
+TIMEOUT_ERRORS = (
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+
+def is_throttled(error: Exception) -> bool:
+    if isinstance(error, TIMEOUT_ERRORS):
+        return True
+    if isinstance(error, ClientError):
+        response = error.response
+        code = response.get("Error", {}).get("Code", "")
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return code in THROTTLE_ERROR_CODES or status in (500, 503)
+    return False
+
+
+def is_throttled_response(http_response, parsed: Dict) -> bool:
+    code = parsed.get("Error", {}).get("Code", "")
+    return code in THROTTLE_ERROR_CODES or http_response.status_code in (500, 503)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of requests in flight.
+
+    While the latency of measured requests stays close to the lowest latency
+    seen, and the limit is actually reached, the limit grows by one per limit's
+    worth of successful requests. A throttling response or a timeout halves
+    it, at most once per `cooldown` seconds, and the request is retried with
+    jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        initial_limit: int = 8,
+        max_attempts: int = 5,
+        latency_tolerance: float = 2.0,
+        cooldown: float = 1.0,
+        backoff: float = 0.1,
+        max_backoff: float = 20.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_attempts = max_attempts
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.base_latency: Optional[float] = None
+        self.last_decrease = 0.0
+        self.throttled = 0
+        self.condition = Condition()
+        self._limit = float(initial_limit)
+        # Per thread: how deep in `call`, and whether each request in flight
+        # outside of it took a slot.
+        self._local = local()
+
+    def configure(self, **kwargs) -> None:
+        with self.condition:
+            for name, value in kwargs.items():
+                if not hasattr(self, name):
+                    raise AttributeError(name)
+                setattr(self, name, value)
+            self._limit = min(max(self._limit, self.min_limit), self.max_limit)
+            self.condition.notify_all()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "base_latency": self.base_latency or 0.0,
+            "throttled": self.throttled,
+        }
+
+    def call(self, fn: Callable, *args, measure: bool = True, **kwargs):
+        """
+        Call `fn` within the limit, retrying throttled requests. Only calls
+        with a `measure`-d latency, whose duration does not depend on the
+        amount of data, adjust the limit on latency.
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.monotonic()
+            self._local.calls = getattr(self._local, "calls", 0) + 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttled(e)
+                self._release(None, throttled)
+                attempt += 1
+                if not throttled or attempt >= self.max_attempts:
+                    raise
+                delay = self._backoff_delay(attempt)
+                logging.info("[S3] Throttled (%s), retrying in %.2fs, limit %d", e, delay, self.limit)
+                time.sleep(delay)
+                continue
+            finally:
+                self._local.calls -= 1
+            self._release(time.monotonic() - start if measure else None, False)
+            return result
+
+    def instrument(self, client) -> None:
+        """
+        Limit every request of the botocore `client` made outside of `call`,
+        like the part requests of boto3's managed transfers, which run on
+        their own threads with their own concurrency. Such a request holds a
+        slot for its duration only, botocore retries it, and every throttled
+        attempt lowers the limit.
+        """
+        events = client.meta.events
+        # First, as handlers may answer the call without a request.
+        events.register_first("before-call.*.*", self._before_request)
+        events.register("needs-retry", self._on_attempt)
+        events.register("after-call", self._after_request)
+        events.register("after-call-error", self._after_request)
+
+    def _before_request(self, **kwargs) -> None:
+        acquired = not getattr(self._local, "calls", 0)
+        if acquired:
+            self._acquire()
+        self._local.__dict__.setdefault("requests", []).append(acquired)
+
+    def _on_attempt(self, response=None, caught_exception=None, **kwargs) -> None:
+        if getattr(self._local, "calls", 0):
+            # Throttles within `call` are counted there.
+            return
+        if response is not None:
+            throttled = is_throttled_response(*response)
+        else:
+            throttled = caught_exception is not None and is_throttled(caught_exception)
+        if throttled:
+            with self.condition:
+                self.throttled += 1
+                self._decrease()
+
+    def back_off(self, attempt: int) -> None:
+        """
+        For a request which succeeded but reported throttled parts, like the
+        keys of a batch delete, which the caller retries itself: lower the
+        limit as for a throttled request and sleep the backoff of `attempt`.
+        """
+        with self.condition:
+            self.throttled += 1
+            self._decrease()
+        delay = self._backoff_delay(attempt)
+        logging.info("[S3] Partly throttled, retrying in %.2fs, limit %d", delay, self.limit)
+        time.sleep(delay)
+
+    def _after_request(self, **kwargs) -> None:
+        if self._local.requests.pop():
+            self._release(None, False)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def _release(self, latency: Optional[float], throttled: bool) -> None:
+        with self.condition:
+            saturated = self.in_flight >= self.limit
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self._decrease()
+            elif latency is not None:
+                if self.base_latency is None or latency < self.base_latency:
+                    self.base_latency = latency
+                else:
+                    # Drift up slowly, so one lucky request does not hold the
+                    # limit down forever.
+                    self.base_latency += (latency - self.base_latency) * 0.01
+                if latency > self.base_latency * self.latency_tolerance:
+                    self._limit = max(self.min_limit, self._limit - 1 / self._limit)
+                elif saturated:
+                    self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            elif saturated:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self.condition.notify_all()
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self._limit = max(self.min_limit, self._limit / 2)
+        logging.info("[S3] Concurrency limit lowered to %d", self.limit)
+
+
+def limited(limiter: AdaptiveLimiter, measure: bool = True):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return limiter.call(fn, *args, measure=measure, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -4,3 +4,14 @@ import pytz
 
 def now_as_iso():
     return datetime.now(tz=pytz.utc).isoformat()[:-6] + "000Z"
+
+
+def iso_to_timestamp(value: str) -> float:
+    """
+    Inverse of `now_as_iso`, which pads the microseconds with zeros and
+    leaves them out when they are zero.
+    """
+    result = datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=pytz.utc).timestamp()
+    if value[19:20] == ".":
+        result += int(value[20:26]) / 1e6
+    return result
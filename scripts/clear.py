@@ -1,36 +1,42 @@
 #!/usr/bin/env python
 
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from functools import partial
 
-import boto3  # type: ignore
 import click
 from dynaconf import settings  # type: ignore
 
+from s3rsync import s3util
 
-s3_client = boto3.client("s3")
 
+s3_client = s3util.create_client(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS)
 
-def list_versions(bucket, prefix, count):
-    return s3_client.list_object_versions(
-        Bucket=bucket, Prefix=prefix.rstrip("/") + "/", MaxKeys=count
-    ).get("Versions", [])
 
+def list_all_versions(bucket, prefix):
+    paginator = s3_client.get_paginator("list_object_versions")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix.rstrip("/") + "/"):
+        for v in page.get("Versions", []) + page.get("DeleteMarkers", []):
+            yield {"Key": v["Key"], "VersionId": v["VersionId"]}
 
-def clear_s3_prefix(bucket, prefix):
-    versions = list_versions(bucket, prefix, 1000)
-    while versions:
-        s3_client.delete_objects(
-            Bucket=bucket,
-            Delete={
-                "Objects": [
-                    {"Key": v["Key"], "VersionId": v["VersionId"]} for v in versions
-                ],
-                "Quiet": False,
-            },
-        )
-        versions = list_versions(bucket, prefix, 1000)
+
+def iter_batches(items, size):
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+
+def clear_s3_prefix(bucket, prefix, workers=16):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batches = iter_batches(list_all_versions(bucket, prefix), s3util.DELETE_BATCH_SIZE)
+        delete = partial(s3util.delete_files, s3_client, bucket)
+        for errors in executor.map(delete, batches):
+            for error in errors:
+                click.echo(f"Failed to delete {error['Key']}: {error.get('Message')}", err=True)
 
 
 def clear_remote(s3_prefix):
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from s3rsync.history import RemoteNodeHistory
+from s3rsync.s3util import list_versions
+from s3rsync.session import Session
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+def compact_history(session: Session, remote_history: RemoteNodeHistory) -> int:
+    """
+    Move the entries before the latest base into an archive segment, returns
+    the number of entries moved.
+    """
+    remote_history.load(session)
+    history = remote_history.history
+    if not any(e.has_base for e in history.entries[1:]):
+        return 0
+    count = len(history.entries)
+    remote_history.save(session)
+    return count - len(history.entries)
+
+
+@click.command()
+@click.argument("s3_prefix")
+@click.argument("root_folder")
+@click.option("--workers", type=int, default=16)
+def main(s3_prefix, root_folder, workers):
+    session = Session.create(s3_prefix, root_folder)
+    versions = list_versions(
+        session.s3_client,
+        session.internal_bucket,
+        f"{session.s3_prefix}/{session.sync_metadata_prefix}/history/",
+    )
+    histories = [RemoteNodeHistory.from_s3_object(v) for v in versions]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        archived = list(executor.map(lambda h: compact_history(session, h), histories))
+    session.cpu_pool.shutdown()
+    click.echo(f"Archived {sum(archived)} entries of {sum(1 for a in archived if a)} histories")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ import peewee
 from s3rsync.session import Session
 from s3rsync.local_db import open_database
 from s3rsync.util.misc import all_subclasses
-from s3rsync import models  # NOQA
+from s3rsync.models import migrate_schema
 from s3rsync.node import LocalNode
 from s3rsync.history import RemoteNodeHistory
 from s3rsync.rsync import patch_file
@@ -53,10 +53,9 @@ def create_full_version(session: Session, local_path: str):
 @click.argument("root_folder")
 @click.argument("path")
 def main(s3_prefix: str, root_folder: str, path: str):
-    db_exists = Path(settings.LOCAL_DB).exists()
     with open_database(settings.LOCAL_DB) as db:
-        if not db_exists:
-            db.create_tables(all_subclasses(peewee.Model))
+        migrate_schema(db)
+        db.create_tables(all_subclasses(peewee.Model))
         session = Session.create(s3_prefix, root_folder)
         create_full_version(session, path)
 
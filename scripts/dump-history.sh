@@ -3,7 +3,7 @@
 dump_history() {
     f=$(mktemp) && \
     aws s3 cp "$rs_history/$1" $f > /dev/null && \
-    (cat $f | jq '.') && \
+    python -m s3rsync.history_codec $f && \
     rm -rf $f
 }
 
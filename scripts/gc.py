@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import logging
+
+import click
+from dynaconf import settings  # type: ignore
+
+from s3rsync.gc import RetentionPolicy, collect_garbage
+from s3rsync.session import Session
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+@click.command()
+@click.argument("s3_prefix")
+@click.argument("root_folder")
+@click.option("--max-age", type=float, default=settings.GC_MAX_AGE, help="Seconds entries are kept for")
+@click.option("--min-entries", type=int, default=settings.GC_MIN_ENTRIES, help="Entries kept per node")
+@click.option("--workers", type=int, default=16)
+@click.option("--dry-run/--no-dry-run", default=False)
+def main(s3_prefix, root_folder, max_age, min_entries, workers, dry_run):
+    session = Session.create(s3_prefix, root_folder)
+    try:
+        report = collect_garbage(
+            session,
+            RetentionPolicy(max_age=max_age, min_entries=min_entries),
+            grace=settings.GC_GRACE_PERIOD,
+            dry_run=dry_run,
+            workers=workers,
+        )
+    finally:
+        session.cpu_pool.shutdown()
+    verb = "Would reclaim" if dry_run else "Reclaimed"
+    click.echo(f"{verb} {report.objects} objects, {report.bytes / 1024 ** 2:.3f}MB {report.by_kind}")
+    if report.failed:
+        click.echo(f"Failed to delete {report.failed} objects", err=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from s3rsync.cpu_pool import CPUPool
+
+
+@pytest.fixture
+def pool():
+    pool = CPUPool(workers=2)
+    yield pool
+    pool.shutdown()
+
+
+def test_signature_delta_patch(tmp_path, pool):
+    base = os.urandom(200000)
+    new = base[:50000] + os.urandom(1000) + base[50000:]
+    (tmp_path / "base").write_bytes(base)
+    (tmp_path / "new").write_bytes(new)
+    paths = {name: str(tmp_path / name) for name in ("base", "new", "sig", "delta", "result")}
+
+    assert pool.signature(paths["base"], paths["sig"])
+    futures = [
+        pool.submit_delta(paths["sig"], "key", paths["new"], f"{paths['delta']}{i}")
+        for i in range(4)
+    ]
+    assert all(f.result() for f in futures)
+    assert pool.patch(paths["base"], f"{paths['delta']}0", paths["result"])
+    assert (tmp_path / "result").read_bytes() == new
+
+
+def test_deltas_against_a_basis_reuse_its_loaded_signature(tmp_path, pool):
+    (tmp_path / "base").write_bytes(os.urandom(100000))
+    (tmp_path / "new").write_bytes(os.urandom(100000))
+    paths = {name: str(tmp_path / name) for name in ("base", "new", "sig", "delta")}
+    assert pool.signature(paths["base"], paths["sig"])
+
+    for key in ("key1", "key2"):
+        for _ in range(4):
+            assert pool.delta(paths["sig"], key, paths["new"], paths["delta"])
+    stats = pool.cache_stats
+    assert (stats["misses"], stats["hits"], stats["count"]) == (2, 6, 2)
@@ -0,0 +1,231 @@
+import hashlib
+import io
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from pathlib import Path
+
+import peewee
+import pytest
+
+from s3rsync import file_transfer, s3util
+from s3rsync.exceptions import ChecksumMismatchError, SourceChangedError
+from s3rsync.local_db import open_database
+from s3rsync.models import MultipartUpload
+from s3rsync.util.misc import all_subclasses
+
+
+class Bunch:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeS3:
+    class exceptions:
+        class NoSuchUpload(Exception):
+            pass
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.uploads = {}
+        self.uploaded_parts = []
+        self.part_bodies = {}
+        self.aborted = []
+        self.completed = None
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {"Key": Key, "UploadId": upload_id, "Initiated": datetime.now(timezone.utc)}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise RuntimeError("connection lost")
+        self.uploaded_parts.append(PartNumber)
+        self.part_bodies[PartNumber] = Body.read()
+        return {"ETag": f"etag-{PartNumber}-{len(self.part_bodies[PartNumber])}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = MultipartUpload["Parts"]
+        del self.uploads[UploadId]
+        return {"VersionId": "version"}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+        self.uploads.pop(UploadId, None)
+
+    def list_multipart_uploads(self, Bucket, Prefix, MaxUploads):
+        uploads = [u for u in self.uploads.values() if u["Key"].startswith(Prefix)]
+        return {"IsTruncated": False, "Uploads": uploads}
+
+
+
+@pytest.fixture
+def db(tmp_path):
+    with open_database(str(tmp_path / "db.sqlite")) as db:
+        db.create_tables(all_subclasses(peewee.Model))
+        yield db
+
+
+@pytest.fixture
+def small_parts():
+    default = s3util.transfer_profiles
+    s3util.configure_transfers([{"multipart_threshold": 100, "multipart_chunksize": 100, "max_concurrency": 1}])
+    yield
+    s3util.transfer_profiles = default
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source"
+    path.write_bytes(os.urandom(950))
+    return str(path)
+
+
+def create_session(tmp_path, client):
+    return Bunch(
+        s3_client=client,
+        s3_prefix="prefix",
+        storage_bucket="bucket",
+        root_folder=Bunch(fspath=str(tmp_path)),
+    )
+
+
+def upload(session, source):
+    return file_transfer.upload_resumable(session, source, "bucket", "prefix/source")
+
+
+def test_resumes_with_missing_parts(db, small_parts, tmp_path, source):
+    client = FakeS3(fail_part=4)
+    session = create_session(tmp_path, client)
+    with pytest.raises(RuntimeError):
+        upload(session, source)
+    stored = MultipartUpload.get()
+    assert sorted(int(n) for n in stored.parts) == [1, 2, 3, 5, 6, 7, 8, 9, 10]
+
+    client.fail_part = None
+    client.uploaded_parts = []
+    assert upload(session, source) == "version"
+    assert client.uploaded_parts == [4]
+    assert [p["PartNumber"] for p in client.completed] == list(range(1, 11))
+    assert client.completed[-1]["ETag"] == "etag-10-50"
+    assert MultipartUpload.select().count() == 0
+
+
+def test_restarts_when_source_changed(db, small_parts, tmp_path, source):
+    client = FakeS3(fail_part=4)
+    session = create_session(tmp_path, client)
+    with pytest.raises(RuntimeError):
+        upload(session, source)
+    with open(source, "ab") as f:
+        f.write(b"more")
+    os.utime(source, ns=(0, 0))
+
+    client.fail_part = None
+    client.uploaded_parts = []
+    upload(session, source)
+    assert client.aborted == ["upload-0"]
+    assert sorted(client.uploaded_parts) == list(range(1, 11))
+
+
+def test_fails_when_source_changes_during_upload(db, small_parts, tmp_path, source):
+    client = FakeS3()
+    session = create_session(tmp_path, client)
+    upload_part = client.upload_part
+
+    def changing_upload_part(**kwargs):
+        os.utime(source, ns=(0, 0))
+        return upload_part(**kwargs)
+
+    client.upload_part = changing_upload_part
+    with pytest.raises(SourceChangedError):
+        upload(session, source)
+    assert client.completed is None
+    assert client.aborted == ["upload-0"]
+
+
+def test_parts_are_read_from_the_file(db, small_parts, tmp_path, source):
+    client = FakeS3()
+    upload(create_session(tmp_path, client), source)
+    content = Path(source).read_bytes()
+    assert b"".join(client.part_bodies[n] for n in range(1, 11)) == content
+
+
+def test_cleanup_aborts_stalled_uploads(db, small_parts, tmp_path, source):
+    client = FakeS3(fail_part=4)
+    session = create_session(tmp_path, client)
+    with pytest.raises(RuntimeError):
+        upload(session, source)
+    client.create_multipart_upload("bucket", "prefix/other")
+    client.uploads["upload-1"]["Initiated"] -= timedelta(days=2)
+    stored = MultipartUpload.get()
+    stored.initiated -= 2 * 86400
+    stored.save()
+
+    # Parts uploaded recently, and an upload of someone else.
+    file_transfer.cleanup_uploads(session, max_age=86400)
+    assert client.aborted == []
+    assert MultipartUpload.select().count() == 1
+
+    stored.progressed -= 2 * 86400
+    stored.save()
+    file_transfer.cleanup_uploads(session, max_age=86400)
+    assert client.aborted == ["upload-0"]
+    assert MultipartUpload.select().count() == 0
+
+
+def test_cleanup_aborts_unrecorded_upload(db, small_parts, tmp_path, source):
+    client = FakeS3()
+    session = create_session(tmp_path, client)
+    create = client.create_multipart_upload
+
+    def crashing_create(**kwargs):
+        create(**kwargs)
+        raise SystemExit
+
+    # An upload of another path, not ours to abort.
+    create("bucket", "prefix/other")
+    client.create_multipart_upload = crashing_create
+    with pytest.raises(SystemExit):
+        upload(session, source)
+    assert MultipartUpload.get().upload_id == ""
+
+    file_transfer.cleanup_uploads(session, max_age=-1)
+    assert client.aborted == ["upload-1"]
+    assert MultipartUpload.select().count() == 0
+
+
+class RangeS3:
+    def __init__(self, content):
+        self.content = content
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range, VersionId):
+        start, _, end = Range[len("bytes="):].partition("-")
+        self.ranges.append((int(start), int(end)))
+        # Later ranges finish first.
+        time.sleep(0.001 * (len(self.content) - int(start)) / 1000)
+        return {"Body": io.BytesIO(self.content[int(start):int(end) + 1])}
+
+
+@pytest.mark.parametrize("size", [0, 1, 99, 100, 101, 950, 2000])
+def test_download_ranges(tmp_path, small_parts, size):
+    s3util.configure_transfers([{"multipart_threshold": 100, "multipart_chunksize": 100, "max_concurrency": 4}])
+    content = os.urandom(size)
+    client = RangeS3(content)
+    session = create_session(tmp_path, client)
+    local_path = str(tmp_path / "download")
+    file_transfer.download_ranges(
+        session, "bucket", "prefix/file", "version", size, local_path, etag=hashlib.md5(content).hexdigest()
+    )
+    assert Path(local_path).read_bytes() == content
+    assert sorted(client.ranges) == [(start, min(start + 100, size) - 1) for start in range(0, size, 100)]
+
+
+def test_download_ranges_checksum_mismatch(tmp_path, small_parts):
+    session = create_session(tmp_path, RangeS3(os.urandom(950)))
+    with pytest.raises(ChecksumMismatchError):
+        file_transfer.download_ranges(
+            session, "bucket", "prefix/file", "version", 950, str(tmp_path / "download"), etag="0" * 32
+        )
@@ -0,0 +1,209 @@
+import json
+import time
+from datetime import datetime, timezone
+
+import pytest
+from botocore.exceptions import ClientError
+
+from s3rsync import history_codec
+from s3rsync.gc import RetentionPolicy, collect_garbage, retained_entries
+from s3rsync.history import NodeHistory, NodeHistoryEntry
+
+
+DAY = 86400
+NOW = time.time()
+
+
+class Bunch:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def iso(age):
+    return datetime.fromtimestamp(NOW - age, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
+
+
+def base(key, age, version=None):
+    return NodeHistoryEntry(
+        key=key, deleted=False, etag="etag", base_version=version or f"v-{key}", base_size=100,
+        has_delta=False, delta_size=0, timestamp=iso(age),
+    )
+
+
+def delta(key, age):
+    return NodeHistoryEntry(
+        key=key, deleted=False, etag="etag", base_version=None, base_size=0,
+        has_delta=True, delta_size=10, timestamp=iso(age),
+    )
+
+
+def deleted(key, age):
+    return NodeHistoryEntry(
+        key=key, deleted=True, etag=None, base_version=None, base_size=0,
+        has_delta=False, delta_size=0, timestamp=iso(age),
+    )
+
+
+POLICY = RetentionPolicy(max_age=7 * DAY, min_entries=1)
+
+
+@pytest.mark.parametrize(
+    "entries, expected",
+    [
+        ([], []),
+        ([base("a", 30 * DAY)], ["a"]),
+        ([base("a", 30 * DAY), delta("b", 20 * DAY)], ["a", "b"]),
+        ([base("a", 30 * DAY), base("b", 20 * DAY), delta("c", 10 * DAY)], ["b", "c"]),
+        ([base("a", 30 * DAY), delta("b", 20 * DAY), base("c", 10 * DAY)], ["c"]),
+        ([base("a", 30 * DAY), delta("b", 5 * DAY), base("c", 1 * DAY)], ["b", "c"]),
+        ([base("a", 30 * DAY), deleted("b", 5 * DAY)], ["a", "b"]),
+        ([base("a", 30 * DAY), deleted("b", 10 * DAY)], []),
+        ([base("a", 3 * DAY), deleted("b", 2 * DAY)], ["a", "b"]),
+    ],
+)
+def test_retained_entries(entries, expected):
+    history = NodeHistory.create("path", entries)
+    assert [e.key for e in retained_entries(history, POLICY, NOW)] == expected
+
+
+def version(key, version_id, age, is_latest=True, size=1):
+    last_modified = datetime.fromtimestamp(NOW - age, tz=timezone.utc)
+    return {"Key": key, "VersionId": version_id, "IsLatest": is_latest, "LastModified": last_modified, "Size": size}
+
+
+class GarbageS3:
+    def __init__(self, histories, versions, etag="etag"):
+        self.histories = histories
+        self.versions = versions
+        self.etag = etag
+        self.deleted = []
+        self.uploaded = {}
+
+    def list_object_versions(self, Bucket, Prefix, MaxKeys):
+        versions = [v for b, v in self.versions if b == Bucket and v["Key"].startswith(Prefix)]
+        return {"IsTruncated": False, "KeyMarker": None, "VersionIdMarker": None, "Versions": versions}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs, Config):
+        data = self.histories[Key]
+        data = [e.dict() for e in data] if isinstance(data, list) else data.dict()
+        Fileobj.write(json.dumps(data).encode("utf-8"))
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": '"etag"'}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config):
+        self.uploaded[Key] = NodeHistory.parse_obj(history_codec.decode(Fileobj.read()))
+
+    def put_object(self, Body, Bucket, Key, IfMatch):
+        if IfMatch != f'"{self.etag}"':
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        self.uploaded[Key] = NodeHistory.parse_obj(history_codec.decode(Body))
+        return {"ETag": '"new-etag"'}
+
+    def delete_objects(self, Bucket, Delete):
+        self.deleted.extend((Bucket, o["Key"], o["VersionId"]) for o in Delete["Objects"])
+        return {"Deleted": Delete["Objects"]}
+
+
+def create_session(client):
+    return Bunch(
+        s3_client=client,
+        s3_prefix="prefix",
+        sync_metadata_prefix="rsync",
+        storage_bucket="storage",
+        internal_bucket="internal",
+    )
+
+
+def test_collect_garbage():
+    history = NodeHistory.create(
+        "dir/file", [base("a", 30 * DAY), delta("b", 20 * DAY), base("c", 10 * DAY), delta("d", 0)]
+    )
+    histories = {f"prefix/rsync/history/{history.key}": history}
+    versions = [
+        ("internal", version(f"prefix/rsync/history/{history.key}", "h2", 0)),
+        ("internal", version(f"prefix/rsync/history/{history.key}", "h1", 2 * DAY, is_latest=False)),
+    ]
+    for key, age in [("a", 30), ("b", 20), ("c", 10), ("d", 0), ("orphan", 2), ("new-orphan", 0)]:
+        for name in ["delta", "signature"]:
+            versions.append(("internal", version(f"prefix/rsync/entries/{key}/{name}", key, age * DAY)))
+    client = GarbageS3(histories, versions)
+    session = create_session(client)
+
+    report = collect_garbage(session, POLICY, grace=DAY, dry_run=True)
+    assert report.objects == 8
+    assert client.deleted == []
+    assert client.uploaded == {}
+
+    report = collect_garbage(session, POLICY, grace=DAY)
+    assert report.by_kind == {"history": 1, "base": 1, "entry": 6}
+    assert report.bytes == 1 + 100 + 6
+    assert sorted(client.deleted) == sorted(
+        [("internal", f"prefix/rsync/history/{history.key}", "h1"), ("storage", "prefix/dir/file", "v-a")]
+        + [
+            ("internal", f"prefix/rsync/entries/{key}/{name}", key)
+            for key in ["a", "b", "orphan"]
+            for name in ["delta", "signature"]
+        ]
+    )
+    # The history no longer lists the deleted entries.
+    pruned = client.uploaded[f"prefix/rsync/history/{history.key}"]
+    assert [e.key for e in pruned.entries] == ["c", "d"]
+    assert pruned.segments == []
+
+
+def test_collect_garbage_skips_changed_history():
+    history = NodeHistory.create("dir/file", [base("a", 30 * DAY), base("c", 10 * DAY)])
+    histories = {f"prefix/rsync/history/{history.key}": history}
+    versions = [("internal", version(f"prefix/rsync/history/{history.key}", "h", 0))]
+    for key in "ac":
+        versions.append(("internal", version(f"prefix/rsync/entries/{key}/delta", key, 30 * DAY)))
+    client = GarbageS3(histories, versions, etag="changed")
+
+    report = collect_garbage(create_session(client), POLICY, grace=DAY)
+    assert report.objects == 0
+    assert client.deleted == []
+
+
+def test_collect_garbage_keeps_basis():
+    basis = NodeHistory.create("basis", [base("a", 30 * DAY), base("b", 20 * DAY)])
+    copy = NodeHistory.create("copy", [NodeHistoryEntry(
+        key="c", deleted=False, etag="etag", base_version=None, base_size=100, has_delta=True, delta_size=10,
+        timestamp=iso(10 * DAY), basis_path="basis", basis_version="v-a",
+    )])
+    histories = {f"prefix/rsync/history/{h.key}": h for h in (basis, copy)}
+    versions = [("internal", version(key, "h", 0)) for key in histories]
+    client = GarbageS3(histories, versions)
+
+    report = collect_garbage(create_session(client), POLICY, grace=DAY)
+    assert report.objects == 0
+
+
+def test_collect_garbage_with_archive():
+    history = NodeHistory.create("file", [base("c", 10 * DAY), delta("d", 0)])
+    history.segments = ["s1"]
+    histories = {
+        f"prefix/rsync/history/{history.key}": history,
+        f"prefix/rsync/archive/{history.key}/s1": [base("a", 30 * DAY), delta("b", 3 * DAY)],
+    }
+    versions = [
+        ("internal", version(f"prefix/rsync/history/{history.key}", "h", 0)),
+        ("internal", version(f"prefix/rsync/archive/{history.key}/s0", "s0", 2 * DAY)),
+        ("internal", version(f"prefix/rsync/archive/{history.key}/s1", "s1", 2 * DAY)),
+    ]
+    for key in "abcd":
+        versions.append(("internal", version(f"prefix/rsync/entries/{key}/delta", key, 0)))
+    client = GarbageS3(histories, versions)
+
+    report = collect_garbage(create_session(client), POLICY, grace=DAY)
+    assert report.by_kind == {"base": 1, "archive": 2}
+    assert sorted(client.deleted) == [
+        ("internal", f"prefix/rsync/archive/{history.key}/s0", "s0"),
+        ("internal", f"prefix/rsync/archive/{history.key}/s1", "s1"),
+        ("storage", "prefix/file", "v-a"),
+    ]
+    # The retained archived entry moved to a new segment.
+    pruned = client.uploaded[f"prefix/rsync/history/{history.key}"]
+    [segment] = pruned.segments
+    assert [e.key for e in client.uploaded[f"prefix/rsync/archive/{history.key}/{segment}"].entries] == ["b"]
+    assert [e.key for e in pruned.entries] == ["c", "d"]
@@ -160,3 +160,43 @@ scenario.counter = 0
 def test_history_diff(number, stored, remote, expected_diff):
     diff, is_absolute = remote.diff(stored)
     assert (diff, is_absolute) == expected_diff
+
+
+@pytest.mark.parametrize("base", ["base_only", "whole"])
+def test_compacted_history_diff(base):
+    stored = history.new().base_only().delta_only().build()
+    remote = getattr(history.delta_only(), base)().mark("begin").delta_only().mark("end").build()
+    remote.compact()
+    begin = history.marks["begin"]
+
+    assert remote.entries == history.entries[begin:]
+    assert remote.diff(stored) == (remote.entries, True)
+    assert remote.diff(remote.copy(update={"entries": remote.entries[:1]})) == (remote.entries[1:], False)
+
+
+def test_basis_delta_diff():
+    first = NodeHistoryEntry.create_basis_delta(generate.key, generate.etag, 10, "other", generate.version, 100)
+    remote = NodeHistory.create("file", [first])
+    history.new().delta_only(delta_size=10).delta_only(delta_size=10)
+    remote.entries.extend(history.entries)
+    stored = remote.copy(update={"entries": remote.entries[:2]})
+
+    assert first.has_base
+    assert remote.diff(None) == (remote.entries, True)
+    assert remote.diff(stored) == (remote.entries[2:], False)
+    assert remote.compact() == []
+
+
+@pytest.mark.parametrize("with_segments", [True, False])
+def test_parse_trusted(with_segments):
+    remote = history.new().base_only().delta_only().whole().deleted().build()
+    remote.segments = ["segment"] if with_segments else []
+    data = remote.dict()
+    if not with_segments:
+        del data["segments"]
+
+    trusted = NodeHistory.parse_trusted(data)
+    assert trusted == remote
+    assert trusted.dict() == remote.dict()
+    assert all(isinstance(e, NodeHistoryEntry) for e in trusted.entries)
+    assert trusted.entries[-1].deleted
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from s3rsync import history_codec
+from s3rsync.history import NodeHistory, NodeHistoryEntry
+from s3rsync.util.timeutil import now_as_iso
+
+
+def entry(**kwargs):
+    values = dict(
+        key=NodeHistoryEntry.generate_key(),
+        deleted=False,
+        etag="0cc175b9c0f1b6a831c399e269772661",
+        base_version="3HL4kqtJlcpXroDTDmJ+rmSpXd3dIbrHY+MTRCxf3vjVBH40Nr8X8gdRQBpUMLUo",
+        base_size=123456789,
+        has_delta=True,
+        delta_size=1234,
+        timestamp=now_as_iso(),
+    )
+    values.update(kwargs)
+    return NodeHistoryEntry(**values)
+
+
+@pytest.mark.parametrize(
+    "entries, segments",
+    [
+        ([], []),
+        ([entry()], []),
+        ([entry(), NodeHistoryEntry.create_deleted()], ["5d41402abc4b2a76b9719d911017c592"]),
+        ([entry(key="short", etag="", base_version=None, base_size=0)], ["segment"]),
+        ([entry(etag=None, timestamp="2020-01-01T00:00:00000Z")], []),
+        ([entry(timestamp="2020-01-01T00:00:00.000001000Z")], []),
+        ([entry(timestamp="2020-01-01T00:00:00.123Z")], []),
+        ([entry(timestamp="1969-12-31T23:59:59.000000000Z")], []),
+        ([entry(etag="0CC175B9C0F1B6A831C399E269772661", delta_size=2 ** 40)], []),
+        ([entry(base_version=None, basis_path="dir/other file", basis_version="version"), entry()], []),
+    ],
+)
+def test_round_trip(entries, segments):
+    history = NodeHistory(path="dir/ünïcode file", key="k" * 32, entries=entries, segments=segments)
+    data = history_codec.encode(history.dict())
+    assert history_codec.decode(data) == history.dict()
+    assert NodeHistory.parse_obj(history_codec.decode(data)) == history
+
+
+def test_smaller_than_json():
+    history = NodeHistory.create("file", [entry() for _ in range(100)])
+    size = len(history_codec.encode(history.dict()))
+    assert size < len(json.dumps(history.dict())) / 2
+
+
+def test_reads_json():
+    history = NodeHistory.create("file", [entry()])
+    data = json.dumps(history.dict())
+    assert history_codec.decode(data.encode("utf-8")) == history.dict()
+    assert history_codec.decode(data) == history.dict()
+
+
+def test_reads_version_1():
+    history = NodeHistory.create("file", [entry()])
+    data = bytearray(history_codec.encode(history.dict()))
+    data[len(history_codec.MAGIC)] = 1
+    assert NodeHistory.parse_trusted(history_codec.decode(bytes(data))) == history
+
+
+def test_rejects_unknown_version():
+    data = history_codec.MAGIC + bytes([history_codec.VERSION + 1])
+    with pytest.raises(history_codec.HistoryCodecError):
+        history_codec.decode(data)
+
+
+def test_rejects_magic_only():
+    with pytest.raises(history_codec.HistoryCodecError):
+        history_codec.decode(history_codec.MAGIC)
+
+
+def test_rejects_truncated():
+    data = history_codec.encode(NodeHistory.create("file", [entry()]).dict())
+    with pytest.raises(history_codec.HistoryCodecError):
+        history_codec.decode(data[:-3])
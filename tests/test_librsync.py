@@ -0,0 +1,89 @@
+import os
+import struct
+from io import BytesIO
+
+import pytest
+
+import librsync
+
+
+@pytest.fixture
+def files(tmp_path):
+    base = os.urandom(300000)
+    new = base[:100000] + os.urandom(5000) + base[120000:] + base[:1000]
+    (tmp_path / "base").write_bytes(base)
+    (tmp_path / "new").write_bytes(new)
+    librsync.signature_from_paths(str(tmp_path / "base"), str(tmp_path / "sig"))
+    librsync.delta_from_paths(str(tmp_path / "sig"), str(tmp_path / "new"), str(tmp_path / "delta"))
+    return tmp_path
+
+
+@pytest.mark.parametrize("mapped", [True, False])
+def test_patch(files, mapped):
+    with open(files / "base", "rb") as f, open(files / "delta", "rb") as d:
+        base = f if mapped else BytesIO(f.read())
+        result = librsync.patch(base, d, BytesIO())
+    assert result.read() == (files / "new").read_bytes()
+
+
+def test_patch_empty_basis(files):
+    (files / "empty").write_bytes(b"")
+    librsync.signature_from_paths(str(files / "empty"), str(files / "sig"))
+    librsync.delta_from_paths(str(files / "sig"), str(files / "new"), str(files / "delta"))
+    with open(files / "empty", "rb") as f, open(files / "delta", "rb") as d:
+        result = librsync.patch(f, d, BytesIO())
+    assert result.read() == (files / "new").read_bytes()
+
+
+@pytest.mark.parametrize(
+    "file_size,block_len",
+    [
+        (0, librsync.RS_DEFAULT_BLOCK_LEN),
+        (1024 ** 2, librsync.RS_DEFAULT_BLOCK_LEN),
+        (1024 ** 3, 32768),
+        (50 * 1024 ** 3, 231808),
+        (1024 ** 5, librsync.RS_MAX_BLOCK_LEN),
+    ]
+)
+def test_signature_args(file_size, block_len):
+    args = librsync.signature_args(file_size)
+    assert args.block_len == block_len
+    assert librsync.RS_DEFAULT_STRONG_LEN <= args.strong_len <= librsync.RS_BLAKE2_SUM_LENGTH
+
+
+@pytest.mark.parametrize(
+    "magic", [librsync.RS_MD4_SIG_MAGIC, librsync.RS_BLAKE2_SIG_MAGIC, librsync.RS_RK_BLAKE2_SIG_MAGIC]
+)
+def test_signature_formats(files, magic):
+    sig_path = str(files / "sig")
+    assert librsync.signature_from_paths(str(files / "base"), sig_path, magic=magic)
+    assert librsync.read_signature_args(sig_path) == librsync.signature_args(300000, magic)
+    assert librsync.delta_from_paths(sig_path, str(files / "new"), str(files / "delta"))
+    assert librsync.patch_from_paths(str(files / "base"), str(files / "delta"), str(files / "result"))
+    assert (files / "result").read_bytes() == (files / "new").read_bytes()
+
+
+def test_signature_stream(files):
+    with open(files / "base", "rb") as f:
+        signature = librsync.signature(f)
+    with open(files / "new", "rb") as f:
+        delta = librsync.delta(f, signature)
+    with open(files / "base", "rb") as f:
+        result = librsync.patch(f, delta)
+    assert result.read() == (files / "new").read_bytes()
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        b"",
+        b"\x72\x73\x01",
+        struct.pack(">III", 0x12345678, 2048, 8),
+        struct.pack(">III", librsync.RS_RK_MD4_SIG_MAGIC, 0, 8),
+        struct.pack(">III", librsync.RS_RK_MD4_SIG_MAGIC, 2048, 32),
+    ],
+)
+def test_load_signature_rejects_unknown_format(tmp_path, header):
+    (tmp_path / "sig").write_bytes(header)
+    assert librsync.read_signature_args(str(tmp_path / "sig")) is None
+    assert librsync.load_signature(str(tmp_path / "sig")) is None
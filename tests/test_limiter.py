@@ -0,0 +1,126 @@
+from threading import Thread
+from types import SimpleNamespace
+import time
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter
+from botocore.stub import Stubber
+
+from s3rsync.util.limiter import AdaptiveLimiter
+
+
+def slow_down():
+    return ClientError({"Error": {"Code": "SlowDown"}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "PutObject")
+
+
+def create_limiter(**kwargs):
+    return AdaptiveLimiter(**{"initial_limit": 4, "backoff": 0, "cooldown": 0, **kwargs})
+
+
+def run_concurrently(limiter, count, fn):
+    threads = [Thread(target=limiter.call, args=(fn,)) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_increases_while_saturated():
+    limiter = create_limiter()
+    run_concurrently(limiter, 40, lambda: time.sleep(0.01))
+    assert limiter.limit > 4
+
+
+def test_does_not_increase_when_not_saturated():
+    limiter = create_limiter()
+    for _ in range(20):
+        limiter.call(lambda: None, measure=False)
+    assert limiter.limit == 4
+
+
+def test_throttling_halves_limit_and_retries():
+    limiter = create_limiter()
+    calls = []
+
+    def throttled_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise slow_down()
+        return "ok"
+
+    assert limiter.call(throttled_once) == "ok"
+    assert len(calls) == 2
+    assert limiter.limit == 2
+    assert limiter.stats["throttled"] == 1
+
+
+def test_gives_up_after_max_attempts():
+    limiter = create_limiter(max_attempts=3, min_limit=1)
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        raise slow_down()
+
+    with pytest.raises(ClientError):
+        limiter.call(throttled)
+    assert len(calls) == 3
+    assert limiter.limit == 1
+
+
+def test_other_errors_are_not_retried():
+    limiter = create_limiter()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        limiter.call(failing)
+    assert len(calls) == 1
+    assert limiter.limit == 4
+
+
+def test_back_off_halves_limit():
+    limiter = create_limiter(initial_limit=8)
+    limiter.back_off(1)
+    assert limiter.limit == 4
+    assert limiter.stats["throttled"] == 1
+
+
+@pytest.fixture
+def client():
+    return boto3.client("s3", region_name="us-east-1", aws_access_key_id="key", aws_secret_access_key="secret")
+
+
+def test_instrumented_requests_hold_a_slot(client):
+    limiter = create_limiter(initial_limit=1)
+    limiter.instrument(client)
+    in_flight = []
+    client.meta.events.register("before-call.*.*", lambda **kwargs: in_flight.append(limiter.in_flight))
+    with Stubber(client) as stubber:
+        for _ in range(2):
+            stubber.add_response("head_object", {"ETag": '"etag"'}, {"Bucket": "bucket", "Key": "key"})
+        client.head_object(Bucket="bucket", Key="key")
+        # Within `call` the request already has its slot.
+        limiter.call(client.head_object, Bucket="bucket", Key="key")
+        stubber.add_client_error("head_object", "NoSuchKey", http_status_code=404)
+        with pytest.raises(ClientError):
+            client.head_object(Bucket="bucket", Key="key")
+    assert in_flight == [1, 1, 1]
+    assert limiter.in_flight == 0
+
+
+def test_throttled_attempts_lower_the_limit():
+    limiter = create_limiter(initial_limit=8)
+    events = HierarchicalEmitter()
+    limiter.instrument(SimpleNamespace(meta=SimpleNamespace(events=events)))
+    response = (SimpleNamespace(status_code=503), {"Error": {"Code": "SlowDown"}})
+    events.emit("needs-retry.s3.UploadPart", response=response, caught_exception=None)
+    assert limiter.limit == 4
+    events.emit("needs-retry.s3.UploadPart", response=(SimpleNamespace(status_code=200), {}), caught_exception=None)
+    assert limiter.limit == 4
+    assert limiter.stats["throttled"] == 1
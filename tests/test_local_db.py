@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from s3rsync.local_db import DatabaseWriter, open_database
+from s3rsync.models import RootFolder
+
+
+@pytest.fixture
+def db(tmp_path):
+    with open_database(str(tmp_path / "db.sqlite")) as db:
+        db.create_tables([RootFolder])
+        yield db
+
+
+def test_pragmas(db):
+    assert db.execute_sql("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert db.execute_sql("PRAGMA synchronous").fetchone() == (1,)
+    assert db.execute_sql("PRAGMA foreign_keys").fetchone() == (1,)
+
+
+def test_writes_are_group_committed(db):
+    writer = DatabaseWriter(db, max_batch=8)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        folders = list(executor.map(lambda i: writer.write(RootFolder.create, path=f"folder{i}"), range(100)))
+    writer.stop()
+
+    assert sorted(f.path for f in folders) == sorted(f"folder{i}" for i in range(100))
+    assert RootFolder.select().count() == 100
+    assert writer.stats["writes"] == 100
+    assert 13 <= writer.stats["commits"] <= 100
+
+
+def test_failed_write_is_rolled_back_alone(db):
+    writer = DatabaseWriter(db)
+
+    def create_and_fail():
+        writer.write(RootFolder.create, path="other")
+        raise RuntimeError
+
+    first = writer.submit(RootFolder.create, path="folder")
+    second = writer.submit(create_and_fail)
+    assert first.result().path == "folder"
+    with pytest.raises(RuntimeError):
+        second.result()
+    writer.stop()
+    assert [f.path for f in RootFolder.select()] == ["folder"]
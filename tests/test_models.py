@@ -0,0 +1,208 @@
+import peewee
+import pytest
+
+from s3rsync.history import NodeHistory, NodeHistoryEntry, RemoteNodeHistory
+from s3rsync.local_db import open_database
+from s3rsync.models import (
+    ContentIndex, HistoryCache, RootFolder, StoredNodeHistory, history_cache, migrate_schema
+)
+from s3rsync.util.misc import all_subclasses
+
+
+def create_history(path, count=1):
+    entries = [
+        NodeHistoryEntry.create_delta_only(NodeHistoryEntry.generate_key(), "etag", 1) for _ in range(count)
+    ]
+    return NodeHistory.create(path, entries)
+
+
+@pytest.fixture
+def db(tmp_path):
+    history_cache.clear()
+    with open_database(str(tmp_path / "db.sqlite")) as db:
+        db.create_tables(all_subclasses(peewee.Model))
+        yield db
+
+
+def test_cache_evicts_by_count():
+    cache = HistoryCache(max_count=2, max_size=1024 ** 2)
+    for key in "abc":
+        cache.put(key, create_history(key))
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.put("d", create_history("d"))
+    assert cache.get("c") is None
+    assert cache.get("b") is not None
+    assert cache.stats == {"hits": 2, "misses": 2, "count": 2, "size": 4 * HistoryCache.ENTRY_SIZE}
+
+
+def test_cache_evicts_by_size():
+    cache = HistoryCache(max_count=10, max_size=10 * HistoryCache.ENTRY_SIZE)
+    cache.put("a", create_history("a", count=4))
+    cache.put("b", create_history("b", count=4))
+    assert cache.get("a") is not None
+    cache.put("c", create_history("c", count=2))
+    assert cache.get("b") is None
+    assert cache.size == 8 * HistoryCache.ENTRY_SIZE
+
+
+def test_rows_share_parsed_history(db):
+    root_folder = RootFolder.create(path="root")
+    history = create_history("file")
+    StoredNodeHistory.create(
+        key=history.key, root_folder=root_folder, data=history.dict(),
+        local_modified_time=0, local_created_time=0, remote_history_etag="etag1",
+    )
+    first = StoredNodeHistory.get().history
+    assert first == history
+    assert StoredNodeHistory.get().history is first
+    assert history_cache.stats["hits"] == 1
+
+    row = StoredNodeHistory.get()
+    changed = create_history("file", count=2)
+    row.data = changed.dict()
+    assert row.history == changed
+    row.remote_history_etag = "etag2"
+    row.save()
+    assert StoredNodeHistory.get().history == changed
+
+
+def test_upsert_replaces_row(db):
+    root_folder = RootFolder.create(path="root")
+    other_folder = RootFolder.create(path="other")
+    history = create_history("file")
+    StoredNodeHistory.upsert(root_folder, history, "etag1", 1, 2)
+    StoredNodeHistory.upsert(other_folder, history, "etag1", 1, 2)
+    changed = create_history("file", count=2)
+    changed.key = history.key
+    StoredNodeHistory.upsert(root_folder, changed, "etag2", 3, 4)
+
+    assert StoredNodeHistory.select().count() == 2
+    row = StoredNodeHistory.get(StoredNodeHistory.root_folder == root_folder)
+    assert (row.path, row.last_entry_key, row.last_etag, row.deleted) == (
+        "file", changed.entries[-1].key, "etag", False
+    )
+    assert (row.local_modified_time, row.local_created_time, row.remote_history_etag) == (3, 4, "etag2")
+    assert row.history == changed
+
+
+def test_summary_loads_history_when_needed(db):
+    root_folder = RootFolder.create(path="root")
+    histories = [create_history(f"file{i}") for i in range(5)]
+    for history in histories:
+        StoredNodeHistory.upsert(root_folder, history, "etag", 0, 0)
+
+    rows = list(StoredNodeHistory.select_summary().order_by(StoredNodeHistory.id))
+    assert all("data" not in row.__data__ for row in rows)
+    StoredNodeHistory.load_histories(rows[:3])
+    assert ["data" in row.__data__ for row in rows] == [True] * 3 + [False] * 2
+    assert [row.history for row in rows] == histories
+
+
+def test_migrate_schema(db):
+    db.drop_tables([StoredNodeHistory])
+    db.execute_sql(
+        "CREATE TABLE storednodehistory (id INTEGER NOT NULL PRIMARY KEY, key VARCHAR(255) NOT NULL, "
+        "root_folder_id INTEGER NOT NULL, data BLOB NOT NULL, local_modified_time INTEGER NOT NULL, "
+        "local_created_time INTEGER NOT NULL, remote_history_etag DATETIME NOT NULL)"
+    )
+    db.execute_sql("CREATE INDEX storednodehistory_key ON storednodehistory (key)")
+    root_folder = RootFolder.create(path="root")
+    old, new = create_history("file"), create_history("file", count=2)
+    new.key = old.key
+    for i, history in enumerate([old, new]):
+        db.execute_sql(
+            "INSERT INTO storednodehistory (key, root_folder_id, data, local_modified_time, "
+            "local_created_time, remote_history_etag) VALUES (?, ?, ?, 0, 0, ?)",
+            (history.key, root_folder.id, history.json(), f"etag{i}"),
+        )
+
+    migrate_schema(db)
+    db.create_tables([StoredNodeHistory])
+    migrate_schema(db)
+
+    row = StoredNodeHistory.get()
+    assert StoredNodeHistory.select().count() == 1
+    assert (row.path, row.last_entry_key, row.remote_history_etag) == ("file", new.entries[-1].key, "etag1")
+    assert row.history == new
+    indexes = {i.name: i.unique for i in db.get_indexes("storednodehistory")}
+    assert indexes == {"storednodehistory_root_folder_id": False, "storednodehistory_root_folder_id_key": True}
+
+
+def test_migrate_schema_adds_columns(db):
+    db.execute_sql("ALTER TABLE storednodehistory DROP COLUMN local_inode")
+    db.execute_sql("ALTER TABLE storednodehistory DROP COLUMN local_size")
+    root_folder = RootFolder.create(path="root")
+    history = create_history("file")
+    db.execute_sql(
+        "INSERT INTO storednodehistory (key, root_folder_id, path, last_entry_key, last_etag, deleted, data, "
+        "local_modified_time, local_created_time, remote_history_etag) VALUES (?, ?, ?, ?, ?, 0, ?, 0, 0, ?)",
+        (history.key, root_folder.id, "file", history.entries[-1].key, "etag", history.json(), "etag"),
+    )
+
+    migrate_schema(db)
+
+    row = StoredNodeHistory.get()
+    assert (row.last_entry_key, row.local_inode, row.local_size) == (history.entries[-1].key, None, None)
+    StoredNodeHistory.upsert(root_folder, history, "etag", 0, 0, local_inode=5, local_size=10)
+    assert (StoredNodeHistory.get().local_inode, StoredNodeHistory.get().local_size) == (5, 10)
+
+
+def test_content_index(db):
+    root_folder = RootFolder.create(path="root")
+
+    def remote(path, etag, *entries):
+        return RemoteNodeHistory(history=NodeHistory.create(path, list(entries)), key=NodeHistory.create(path).key,
+                                 etag=etag)
+
+    base = NodeHistoryEntry.create_base_only("entry1", "content1", "version1", 100)
+    delta = NodeHistoryEntry.create_delta_only("entry2", "content2", 10)
+    histories = [
+        remote("a", "h1", base),
+        remote("b", "h1", base, delta),
+        remote("c", "h1", NodeHistoryEntry.create_base_only("entry3", "content3", "version3", 300)),
+    ]
+    ContentIndex.refresh(root_folder, histories)
+    assert ContentIndex.find(root_folder, "content1", 100).path == "a"
+    assert ContentIndex.find(root_folder, "content1", 99) is None
+    assert ContentIndex.find(root_folder, "content2", 10) is None
+    assert ContentIndex.select().count() == 2
+
+    histories[0].history.add_delete_marker()
+    histories[0].etag = "h2"
+    histories[1] = remote("b", "h2", NodeHistoryEntry.create_base_only("entry4", "content4", "version4", 400))
+    ContentIndex.refresh(root_folder, histories[:2])
+    row = ContentIndex.find(root_folder, "content4", 400)
+    assert (row.path, row.entry_key, row.base_version) == ("b", "entry4", "version4")
+    assert ContentIndex.select().count() == 1
+
+
+def test_basis_candidates(db):
+    root_folder = RootFolder.create(path="root")
+    paths = {
+        "dir/a.vwx": 1000,
+        "dir/b.vwx": 1200,
+        "dir/c.txt": 1000,
+        "dir/sub/d.vwx": 1000,
+        "other/e.vwx": 1100,
+        "other/f.txt": 1000,
+        "dir/g.vwx": 5000,
+        "dir/new.vwx": 1000,
+    }
+    histories = [
+        RemoteNodeHistory(
+            history=NodeHistory.create(path, [NodeHistoryEntry.create_base_only(path, path, path, size)]),
+            key=NodeHistory.create(path).key,
+            etag="h1",
+        )
+        for path, size in paths.items()
+    ]
+    ContentIndex.refresh(root_folder, histories)
+
+    def candidates(path, count=10):
+        key = NodeHistory.create(path).key
+        return [c.path for c in ContentIndex.basis_candidates(root_folder, key, path, 1000, count, 0.5)]
+
+    assert candidates("dir/new.vwx") == ["dir/a.vwx", "dir/b.vwx", "dir/sub/d.vwx", "other/e.vwx", "dir/c.txt"]
+    assert candidates("dir/new.vwx", count=2) == ["dir/a.vwx", "dir/b.vwx"]
+    assert candidates("new") == []
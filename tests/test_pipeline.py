@@ -0,0 +1,106 @@
+from contextlib import nullcontext
+from threading import current_thread
+from types import SimpleNamespace
+
+from s3rsync.local_db import DatabaseWriter, open_database
+from s3rsync.models import RootFolder
+from s3rsync.pipeline import SyncPipeline
+from s3rsync.sync_action import Stage, SyncActionResult, action
+
+
+@action
+def staged(log, name, session):
+    yield Stage.FETCH
+    log.append((name, "fetch", current_thread().name))
+    yield Stage.COMPUTE
+    log.append((name, "compute", current_thread().name))
+    yield Stage.TRANSFER
+    log.append((name, "transfer", current_thread().name))
+    yield Stage.COMMIT
+    log.append((name, "commit", current_thread().name))
+    return SyncActionResult()
+
+
+@action
+def plain(log, name, session):
+    log.append((name, "plain", current_thread().name))
+    return SyncActionResult()
+
+
+@action
+def failing(log, name, session):
+    yield Stage.COMPUTE
+    raise RuntimeError
+
+
+@action
+def backwards(log, name, session):
+    yield Stage.TRANSFER
+    yield Stage.COMPUTE
+    log.append((name, "compute", current_thread().name))
+
+
+def create_pipeline():
+    workers = {Stage.FETCH: 2, Stage.COMPUTE: 2, Stage.TRANSFER: 2}
+    return SyncPipeline(None, workers=workers, queue_size=1)
+
+
+def test_actions_run_in_stage_threads():
+    log = []
+    pipeline = create_pipeline()
+    pipeline.run(
+        [staged(log, i) for i in range(10)]
+        + [plain(log, "plain"), failing(log, "failing"), backwards(log, "backwards")]
+    )
+
+    assert len(log) == 41
+    for name, step, thread in log:
+        stage = "commit" if step == "plain" else step
+        assert thread.startswith(stage)
+    for i in range(10):
+        assert [step for name, step, _ in log if name == i] == ["fetch", "compute", "transfer", "commit"]
+
+
+def test_action_without_pipeline():
+    log = []
+    assert staged(log, "x")(None) == SyncActionResult()
+    assert [step for _, step, _ in log] == ["fetch", "compute", "transfer", "commit"]
+
+
+def test_commits_are_batched():
+    log = []
+    batches = []
+
+    class Writer:
+        db = SimpleNamespace(atomic=nullcontext)
+
+        def write(self, fn):
+            batches.append(len(log))
+            fn()
+
+    workers = {Stage.FETCH: 2, Stage.COMPUTE: 2, Stage.TRANSFER: 2}
+    pipeline = SyncPipeline(None, workers=workers, queue_size=16, writer=Writer(), commit_batch_size=4)
+    pipeline.run([plain(log, i) for i in range(10)])
+
+    assert sorted(name for name, _, _ in log) == list(range(10))
+    assert 3 <= len(batches) <= 10
+
+
+@action
+def committing(path, fail, session):
+    yield Stage.COMMIT
+    RootFolder.create(path=path)
+    if fail:
+        raise RuntimeError
+
+
+def test_failed_commit_is_rolled_back_alone(tmp_path):
+    with open_database(str(tmp_path / "db.sqlite")) as db:
+        db.create_tables([RootFolder])
+        writer = DatabaseWriter(db)
+        workers = {Stage.FETCH: 1, Stage.COMPUTE: 1, Stage.TRANSFER: 1}
+        pipeline = SyncPipeline(None, workers=workers, queue_size=16, writer=writer, commit_batch_size=16)
+        pipeline.run([committing(f"folder{i}", i % 2) for i in range(6)])
+        writer.stop()
+
+        assert sorted(f.path for f in RootFolder.select()) == ["folder0", "folder2", "folder4"]
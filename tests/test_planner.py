@@ -0,0 +1,80 @@
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from s3rsync.history import RemoteNodeHistory
+from s3rsync.models import RootFolder, StoredNodeHistory
+from s3rsync.node import LocalNode
+from s3rsync.planner import ACTIONS, NOP, classify, plan_actions
+from s3rsync.sync_logic import handle_node
+from s3rsync.tree_snapshot import TreeSnapshot
+from s3rsync.util.file import file_checksum, hash_path
+
+
+class Bunch:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+CASES = list(product([False, True], repeat=7))
+
+
+@pytest.mark.parametrize("has_remote, has_local, has_stored, deleted, local_updated, remote_updated, same_etag", CASES)
+def test_classify_matches_handle_node(
+    has_remote, has_local, has_stored, deleted, local_updated, remote_updated, same_etag
+):
+    remote = RemoteNodeHistory(
+        key="key", etag="new" if remote_updated else "old", history=Bunch(etag="etag", deleted=deleted)
+    )
+    local = LocalNode(
+        root_folder=Path("/local"), path="file", modified_time=2 if local_updated else 1, created_time=1,
+        size=1, etag="etag" if same_etag else "other",
+    )
+    stored = Bunch(key="key", local_modified_time=1, local_created_time=1, remote_history_etag="old")
+    remote, local, stored = (remote if has_remote else None, local if has_local else None,
+                             stored if has_stored else None)
+
+    code = classify(
+        np.array([has_remote]),
+        np.array([has_local]),
+        np.array([has_stored]),
+        np.array([has_remote and deleted]),
+        np.array([has_local and has_stored and local_updated]),
+        np.array([has_remote and has_stored and remote_updated]),
+    )[0]
+    expected = handle_node(remote, local, stored).name
+    if code == NOP:
+        assert expected == "nop"
+    else:
+        assert ACTIONS[code](remote, local, stored).name == expected
+
+
+@pytest.mark.parametrize(
+    "same_content, remote_etag, head_etag, expected",
+    [
+        (True, "etag", None, ["move"]),
+        (False, "etag", None, ["delete_remote", "upload"]),
+        (True, "NEWER", None, ["delete_remote", "upload"]),
+        (True, "etag", "1" * 32, ["delete_remote", "upload"]),
+    ],
+)
+def test_moved_file(tmp_path, same_content, remote_etag, head_etag, expected):
+    (tmp_path / "new.vwx").write_bytes(b"content")
+    stat = (tmp_path / "new.vwx").stat()
+    etag = file_checksum(str(tmp_path / "new.vwx")) if same_content else "0" * 32
+    remote = RemoteNodeHistory(
+        key=hash_path("old.vwx"), etag=remote_etag, history=Bunch(etag=head_etag or etag, deleted=False)
+    )
+    stored = StoredNodeHistory(
+        key=hash_path("old.vwx"), root_folder=RootFolder(path=str(tmp_path)), remote_history_etag="etag",
+        local_modified_time=0, local_created_time=0, local_inode=stat.st_ino, local_size=stat.st_size,
+        last_etag=etag,
+    )
+
+    actions = plan_actions(tmp_path, TreeSnapshot.scan(tmp_path), [remote], [stored])
+    assert sorted(a.name for a in actions) == expected
+    if expected == ["move"]:
+        remote_history, stored_history, node = actions[0].action.args
+        assert (remote_history, stored_history, node.path) == (remote, stored, "new.vwx")
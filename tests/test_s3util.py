@@ -0,0 +1,134 @@
+import pytest
+
+from s3rsync import s3util
+
+
+PROFILES = [
+    {"multipart_threshold": 64, "multipart_chunksize": 64, "max_concurrency": 16},
+    {"max_size": 1000, "multipart_threshold": 8, "multipart_chunksize": 16, "max_concurrency": 8},
+    {"max_size": 100, "multipart_threshold": 64, "multipart_chunksize": 8, "max_concurrency": 4},
+]
+
+
+@pytest.fixture
+def profiles():
+    default = s3util.transfer_profiles
+    s3util.configure_transfers(PROFILES)
+    yield
+    s3util.transfer_profiles = default
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [
+        (0, 4),
+        (100, 4),
+        (101, 8),
+        (1000, 8),
+        (1001, 16),
+        (None, 16),
+    ],
+)
+def test_transfer_config(profiles, size, expected):
+    assert s3util.transfer_config(size).max_request_concurrency == expected
+
+
+def test_create_client_shared():
+    client = s3util.create_client(max_pool_connections=32)
+    assert s3util.create_client(max_pool_connections=32) is client
+    assert s3util.create_client(max_pool_connections=16) is not client
+    assert client.meta.config.max_pool_connections == 32
+
+
+class DeleteS3:
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.requests = []
+
+    def delete_objects(self, Bucket, Delete):
+        objects = Delete["Objects"]
+        self.requests.append((Bucket, [o["Key"] for o in objects]))
+        errors, deleted = [], []
+        for o in objects:
+            name = f"{o['Key']}@{o['VersionId']}" if "VersionId" in o else o["Key"]
+            if self.errors.get(name):
+                errors.append({**o, "Code": self.errors[name].pop(0)})
+            else:
+                deleted.append(o)
+        return {"Deleted": deleted, "Errors": errors}
+
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    attempts = []
+    monkeypatch.setattr(s3util.limiter, "back_off", attempts.append)
+    return attempts
+
+
+def test_batch_deleter_sends_full_batches():
+    client = DeleteS3()
+    deleter = s3util.BatchDeleter(client)
+    for i in range(s3util.DELETE_BATCH_SIZE + 10):
+        deleter.delete("bucket", f"key{i}")
+    deleter.delete("other", "key")
+    assert [(b, len(keys)) for b, keys in client.requests] == [("bucket", s3util.DELETE_BATCH_SIZE)]
+
+    deleter.flush()
+    assert [(b, len(keys)) for b, keys in client.requests[1:]] == [("bucket", 10), ("other", 1)]
+    deleter.flush()
+    assert len(client.requests) == 3
+
+
+def test_batch_deleter_retries_throttled_keys(backoffs):
+    client = DeleteS3(errors={"slow": ["SlowDown", "SlowDown"], "denied": ["AccessDenied"], "gone": ["SlowDown"] * 3})
+    deleter = s3util.BatchDeleter(client, max_attempts=3)
+    for key in ["ok", "slow", "denied", "gone"]:
+        deleter.delete("bucket", key)
+    deleter.flush()
+    assert [keys for _, keys in client.requests] == [
+        ["ok", "slow", "denied", "gone"],
+        ["slow", "gone"],
+        ["slow", "gone"],
+    ]
+    assert deleter.failed == 2
+    assert backoffs == [1, 2]
+
+
+def test_batch_deleter_retries_throttled_versions(backoffs):
+    client = DeleteS3(errors={"key@v2": ["SlowDown"]})
+    deleter = s3util.BatchDeleter(client)
+    deleter.delete("bucket", "key", "v1")
+    deleter.delete("bucket", "key", "v2")
+    deleter.flush()
+    assert [keys for _, keys in client.requests] == [["key", "key"], ["key"]]
+    assert deleter.failed == 0
+    assert backoffs == [1]
+
+
+class CopyClient:
+    def __init__(self):
+        self.calls = []
+
+    def copy_object(self, CopySource, Bucket, Key):
+        self.calls.append(("copy_object", CopySource, Key))
+        return {"VersionId": "v2"}
+
+    def copy(self, CopySource, Bucket, Key, Config):
+        self.calls.append(("copy", CopySource, Key))
+
+    def head_object(self, Bucket, Key):
+        return {"VersionId": "v3"}
+
+
+@pytest.mark.parametrize(
+    "size, method, version",
+    [
+        (100, "copy_object", "v2"),
+        (s3util.MAX_COPY_SIZE, "copy_object", "v2"),
+        (s3util.MAX_COPY_SIZE + 1, "copy", "v3"),
+    ],
+)
+def test_copy_file(size, method, version):
+    client = CopyClient()
+    assert s3util.copy_file(client, "bucket", "old", "v1", "new", size) == version
+    assert client.calls == [(method, {"Bucket": "bucket", "Key": "old", "VersionId": "v1"}, "new")]
@@ -0,0 +1,58 @@
+from pathlib import Path
+import time
+
+from s3rsync.history import NodeHistory, NodeHistoryEntry, RemoteNodeHistory
+from s3rsync.node import LocalNode
+from s3rsync.scheduler import SyncScheduler, recently_modified_first
+from s3rsync.sync_action import delete_history, download, upload
+
+MB = 1024 ** 2
+
+
+def local_node(path, size, modified_time=0):
+    return LocalNode(
+        root_folder=Path("/local"), path=path, modified_time=modified_time,
+        created_time=0, size=size, etag=None
+    )
+
+
+def remote_history(base_size, delta_sizes):
+    history = NodeHistory.create("path", [
+        NodeHistoryEntry.create_base_only(NodeHistoryEntry.generate_key(), "etag", "version", base_size)
+    ] + [
+        NodeHistoryEntry.create_delta_only(NodeHistoryEntry.generate_key(), "etag", size)
+        for size in delta_sizes
+    ])
+    return RemoteNodeHistory(history=history, key=history.key, etag="etag")
+
+
+def test_cost():
+    scheduler = SyncScheduler(aging_rate=MB)
+    assert scheduler.cost(upload(None, local_node("a", 100))) == 100
+    assert scheduler.cost(download(remote_history(1000, [10, 20]), None)) == 1030
+    assert scheduler.cost(delete_history(None)) == 0
+
+
+def test_shortest_job_first():
+    scheduler = SyncScheduler(aging_rate=MB)
+    large = upload(None, local_node("large", 20000 * MB))
+    small = [upload(None, local_node(f"small{i}", i * MB)) for i in range(3)]
+    scheduled = scheduler.order([large, *reversed(small)])
+    assert [a for _, a in scheduled] == [*small, large]
+
+
+def test_large_actions_are_not_starved():
+    scheduler = SyncScheduler(aging_rate=MB)
+    large = upload(None, local_node("large", 100 * MB))
+    small = upload(None, local_node("small", 1 * MB))
+    now = time.monotonic()
+    assert scheduler.deadline(large, now) < scheduler.deadline(small, now + 100)
+
+
+def test_priority_hooks():
+    scheduler = SyncScheduler(aging_rate=MB, priority_hook=recently_modified_first(600))
+    old = upload(None, local_node("old", MB, modified_time=time.time() - 3600))
+    recent = upload(None, local_node("recent", 10 * MB, modified_time=time.time()))
+    explicit = delete_history(None)
+    explicit.priority = 1000
+    assert [a for _, a in scheduler.order([old, recent, explicit])] == [explicit, recent, old]
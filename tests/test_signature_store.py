@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+import librsync
+from s3rsync.session import RootFolder, signature_folder
+from s3rsync.signature_store import LoadedSignatureCache, SignatureStore
+
+
+@pytest.fixture
+def signature_path(tmp_path):
+    (tmp_path / "base").write_bytes(os.urandom(100000))
+    librsync.signature_from_paths(str(tmp_path / "base"), str(tmp_path / "sig"))
+    return str(tmp_path / "sig")
+
+
+def create_store(tmp_path, max_size=1024 ** 2):
+    return SignatureStore(tmp_path / "store", max_size=max_size)
+
+
+def test_keeps_latest_signature_per_node(tmp_path, signature_path):
+    store = create_store(tmp_path)
+    store.put("node", "entry1", signature_path)
+    store.put("node", "entry2", signature_path)
+    assert store.get("node", "entry1") is None
+    assert store.get("node", "entry2") is not None
+    assert sorted(p.name for p in store.folder.iterdir()) == ["node.entry2"]
+
+
+def test_evicts_least_recently_used(tmp_path, signature_path):
+    size = os.path.getsize(signature_path)
+    store = create_store(tmp_path, max_size=size * 2)
+    store.put("node1", "entry", signature_path)
+    store.put("node2", "entry", signature_path)
+    store.get("node1", "entry")
+    store.put("node3", "entry", signature_path)
+    assert store.get("node1", "entry") is not None
+    assert store.get("node2", "entry") is None
+    assert store.get("node3", "entry") is not None
+    assert store.size == size * 2
+
+
+def test_collect_garbage(tmp_path, signature_path):
+    store = create_store(tmp_path)
+    store.put("node1", "entry", signature_path)
+    store.put("node2", "entry", signature_path)
+    (store.folder / "legacy").write_bytes(b"")
+    store.collect_garbage(["node2"])
+    assert store.get("node1", "entry") is None
+    assert store.get("node2", "entry") is not None
+
+    store = create_store(tmp_path)
+    assert sorted(p.name for p in store.folder.iterdir()) == ["node2.entry"]
+    assert store.get("node2", "entry") is not None
+
+
+def test_loaded_signature_cache(tmp_path, signature_path):
+    cache = LoadedSignatureCache(max_count=1, max_size=1024 ** 2)
+    for _ in range(3):
+        with cache.use("entry1", signature_path) as sig:
+            assert sig is not None
+            assert librsync.delta_from_signature(sig, str(tmp_path / "base"), str(tmp_path / "delta"))
+    assert cache.stats["hits"] == 2
+    assert cache.stats["misses"] == 1
+
+    with cache.use("entry1", signature_path) as sig1:
+        with cache.use("entry2", signature_path) as sig2:
+            # entry1 is evicted, but stays loaded while in use
+            assert cache.stats["count"] == 1
+            assert librsync.delta_from_signature(sig1, str(tmp_path / "base"), str(tmp_path / "delta"))
+            assert librsync.delta_from_signature(sig2, str(tmp_path / "base"), str(tmp_path / "delta"))
+
+
+def test_move(tmp_path, signature_path):
+    store = create_store(tmp_path)
+    store.put("node", "entry1", signature_path)
+    store.put("other", "entry2", signature_path)
+    store.move("node", "other")
+    store.move("missing", "node")
+    assert store.get("node", "entry1") is None
+    assert store.get("other", "entry1") is not None
+    assert sorted(p.name for p in store.folder.iterdir()) == ["other.entry1"]
+    assert store.size == os.path.getsize(signature_path)
+
+
+def test_pin(tmp_path, signature_path):
+    size = os.path.getsize(signature_path)
+    store = create_store(tmp_path, max_size=size)
+    with store.pin("node1", "entry1"):
+        store.put("node1", "entry1", signature_path)
+        store.put("node2", "entry", signature_path)
+        # Over the cap, but the pinned one stays.
+        assert store.get("node1", "entry1") is not None
+        store.put("node2", "entry", signature_path)
+        store.put("node1", "entry2", signature_path)
+        assert store.get("node1", "entry1") is None
+        assert (store.folder / "node1.entry1").exists()
+    assert not (store.folder / "node1.entry1").exists()
+    assert store.get("node1", "entry2") is not None
+
+
+def test_signature_folder_per_root_folder(tmp_path):
+    folders = {signature_folder(RootFolder.create(str(tmp_path / name))) for name in ("a", "b", "a")}
+    assert len(folders) == 2
@@ -0,0 +1,67 @@
+from io import BytesIO
+import random
+
+import librsync
+from s3rsync.stream.http import StreamingBodySource
+
+
+class FakeStreamingBody:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.closed = False
+
+    def iter_chunks(self, chunk_size=1024):
+        offset = 0
+        while offset < len(self.data):
+            size = random.randint(1, chunk_size)
+            yield self.data[offset:offset + size]
+            offset += size
+
+    def close(self):
+        self.closed = True
+
+
+def random_bytes(size):
+    return bytes(random.getrandbits(8) for _ in range(size))
+
+
+def test_read_until_eof():
+    data = random_bytes(100000)
+    source = StreamingBodySource(FakeStreamingBody(data))
+    assert source.read() == data
+    assert source.read(10) == b""
+
+
+def test_readinto():
+    data = random_bytes(1000)
+    source = StreamingBodySource(FakeStreamingBody(data))
+    buffer = bytearray(len(data))
+    offset = 0
+    while True:
+        n = source.readinto(memoryview(buffer)[offset:])
+        if not n:
+            break
+        offset += n
+    assert bytes(buffer) == data
+
+
+def test_close_closes_body():
+    body = FakeStreamingBody(b"data")
+    with StreamingBodySource(body):
+        pass
+    assert body.closed
+
+
+def test_patch_from_stream(tmp_path):
+    base = random_bytes(200000)
+    new = base[:50000] + random_bytes(1000) + base[60000:]
+    (tmp_path / "base").write_bytes(base)
+    (tmp_path / "new").write_bytes(new)
+    librsync.signature_from_paths(str(tmp_path / "base"), str(tmp_path / "sig"))
+    librsync.delta_from_paths(str(tmp_path / "sig"), str(tmp_path / "new"), str(tmp_path / "delta"))
+    delta = (tmp_path / "delta").read_bytes()
+
+    delta_source = StreamingBodySource(FakeStreamingBody(delta))
+    assert not delta_source.seekable()
+    result = librsync.patch(BytesIO(base), delta_source, BytesIO())
+    assert result.read() == new
@@ -0,0 +1,156 @@
+import os
+from types import SimpleNamespace
+
+import librsync
+import pytest
+from botocore.exceptions import ClientError
+
+from s3rsync import history_codec
+from s3rsync.history import NodeHistory, NodeHistoryEntry, RemoteNodeHistory
+from s3rsync.models import ContentIndex
+from s3rsync.node import LocalNode
+from s3rsync.signature_store import SignatureStore
+from s3rsync.sync_action import Stage, choose_basis, move, try_fetch_signature, upload
+
+
+class FailingPool:
+    def __init__(self, failing):
+        self.failing = failing
+
+    def delta(self, sig_path, sig_key, new_path, delta_path):
+        if sig_key in self.failing:
+            return False
+        return librsync.delta_from_paths(sig_path, new_path, delta_path)
+
+
+@pytest.fixture
+def files(tmp_path):
+    base = os.urandom(100000)
+    (tmp_path / "base").write_bytes(base)
+    (tmp_path / "new").write_bytes(base[:50000] + os.urandom(100) + base[50000:])
+    librsync.signature_from_paths(str(tmp_path / "base"), str(tmp_path / "sig"))
+    return tmp_path
+
+
+def create_session(tmp_path, failing):
+    store = SignatureStore(tmp_path / "store", max_size=1024 ** 2)
+    for key in ("entry1", "entry2"):
+        store.put(f"node-{key}", key, str(tmp_path / "sig"))
+    return SimpleNamespace(signature_store=store, cpu_pool=FailingPool(failing))
+
+
+def candidate(entry_key):
+    return ContentIndex(key=f"node-{entry_key}", entry_key=entry_key, path=entry_key, size=100000)
+
+
+@pytest.mark.parametrize("failing, expected", [((), "entry1"), (("entry1",), "entry2"), (("entry1", "entry2"), None)])
+def test_choose_basis_skips_failed_delta(files, failing, expected):
+    session = create_session(files, failing)
+    node = LocalNode(
+        root_folder=files, path="new", modified_time=0, created_time=0, size=100100, etag=None
+    )
+    basis = choose_basis(session, node, [candidate("entry1"), candidate("entry2")], str(files / "delta"))
+    if expected is None:
+        assert basis is None
+    else:
+        assert basis[0].entry_key == expected
+        assert 0 < basis[1] == (files / "delta").stat().st_size
+
+
+def test_try_fetch_signature(tmp_path, monkeypatch):
+    def download_metadata(session, key, name, local_path):
+        raise ClientError({"Error": {"Code": "404"}}, "GetObject")
+
+    monkeypatch.setattr("s3rsync.rsync.download_metadata", download_metadata)
+    session = SimpleNamespace(signature_store=SignatureStore(tmp_path / "store", max_size=1024))
+    assert not try_fetch_signature(session, candidate("gone"))
+
+
+class MoveS3:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config):
+        self.objects[Bucket, Key] = Fileobj.read()
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs, Config):
+        Fileobj.write(self.objects[Bucket, Key])
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": '"etag"'}
+
+    def copy_object(self, CopySource, Bucket, Key):
+        return {"VersionId": f"copy-of-{CopySource['VersionId']}"}
+
+
+def entry(key, base_version=None):
+    return NodeHistoryEntry(
+        key=key, deleted=False, etag="etag", base_version=base_version, base_size=100,
+        has_delta=base_version is None, delta_size=0 if base_version else 10, timestamp="2020-01-01T00:00:00Z",
+    )
+
+
+def test_move_carries_over_archive(tmp_path):
+    old = NodeHistory.create("dir/file", [entry("b"), entry("c", "v-c"), entry("d")])
+    old.segments = ["s1"]
+    segment = NodeHistory(path=old.path, key=old.key, entries=[entry("a", "v-a")])
+    client = MoveS3({("internal", f"prefix/rsync/archive/{old.key}/s1"): history_codec.encode(segment.dict())})
+    moved = []
+    session = SimpleNamespace(
+        s3_client=client,
+        s3_prefix="prefix",
+        sync_metadata_prefix="rsync",
+        storage_bucket="storage",
+        internal_bucket="internal",
+        signature_store=SimpleNamespace(move=lambda old_key, new_key: moved.append((old_key, new_key))),
+        deleter=SimpleNamespace(delete=lambda bucket, s3_path: None),
+    )
+    node = LocalNode(root_folder=tmp_path, path="moved", modified_time=0, created_time=0, size=100, etag=None)
+    remote_history = RemoteNodeHistory(history=old, key=old.key, etag="etag")
+
+    steps = move(remote_history, None, node, session).steps()
+    assert next(steps) == Stage.TRANSFER
+    assert next(steps) == Stage.COMMIT
+
+    head = NodeHistory.parse_obj(history_codec.decode(client.objects["internal", f"prefix/rsync/history/{node.key}"]))
+    assert [(e.key, e.base_version) for e in head.entries] == [("c", "copy-of-v-c"), ("d", None)]
+    assert len(head.segments) == 1
+    archive = RemoteNodeHistory(history=head, key=node.key, etag=None).load_archive(session)
+    assert [(e.key, e.base_version, e.basis_path, e.basis_version) for e in archive] == [
+        ("a", None, "dir/file", "v-a"), ("b", None, None, None)
+    ]
+    assert moved == [(old.key, node.key)]
+
+
+def test_uploads_rebase_and_archive(tmp_path, monkeypatch):
+    delta_sizes = iter([40, 40, 40, 40])
+    uploaded = []
+
+    def calc_delta(session, local_path, node_key, sig_key, delta_path):
+        with open(delta_path, "wb") as f:
+            f.write(bytes(next(delta_sizes)))
+
+    monkeypatch.setattr("s3rsync.sync_action.fetch_signature", lambda *args: None)
+    monkeypatch.setattr("s3rsync.sync_action.calc_delta", calc_delta)
+    monkeypatch.setattr("s3rsync.sync_action.calc_signature", lambda *args: None)
+    monkeypatch.setattr("s3rsync.file_transfer.upload_metadata", lambda session, path, key, name: uploaded.append(name))
+    monkeypatch.setattr("s3rsync.file_transfer.upload_to_root", lambda session, node: "v2")
+    client = MoveS3({})
+    session = SimpleNamespace(
+        s3_client=client, s3_prefix="prefix", sync_metadata_prefix="rsync", internal_bucket="internal",
+    )
+    (tmp_path / "file").write_bytes(bytes(100))
+    node = LocalNode(root_folder=tmp_path, path="file", modified_time=0, created_time=0, size=100, etag=None)
+    history = NodeHistory.create("file", [entry("a", "v1")])
+    remote_history = RemoteNodeHistory(history=history, key=node.key, etag="etag")
+
+    for _ in range(4):
+        steps = upload(remote_history, node, session).steps()
+        while next(steps) != Stage.COMMIT:
+            pass
+
+    # The third delta would have brought the deltas past the size of the base.
+    assert uploaded == ["delta", "signature", "delta", "signature", "signature", "delta", "signature"]
+    assert [e.base_version for e in history.entries] == ["v2", None]
+    archive = remote_history.load_archive(session)
+    assert [e.base_version for e in archive] == ["v1", None, None]
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from s3rsync.history import RemoteNodeHistory
+from s3rsync.models import RootFolder, StoredNodeHistory
+from s3rsync.planner import plan_actions
+from s3rsync.sync_logic import handle_node
+from s3rsync.tree_snapshot import TreeSnapshot
+from s3rsync.util.file import hash_path
+
+
+class Bunch:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def create_tree(root, paths):
+    for path in paths:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(path)
+        os.utime(root / path, (1000, 2000))
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "root"
+    create_tree(root, ["a.txt", "folder/b.txt", "folder/sub/c.vwx", "ü.txt"])
+    return root
+
+
+def test_scan_save_load(tree, tmp_path):
+    snapshot = TreeSnapshot.scan(tree)
+    snapshot.save(tmp_path / "tree.snapshot")
+    loaded = TreeSnapshot.load(tmp_path / "tree.snapshot")
+
+    for s in (snapshot, loaded):
+        keys = [s.key(i) for i in range(len(s))]
+        assert keys == sorted(hash_path(p) for p in ["a.txt", "folder/b.txt", "folder/sub/c.vwx", "ü.txt"])
+        i = s.find(hash_path("folder/sub/c.vwx"))
+        node = s.node(i, tree)
+        assert (node.path, node.key, node.modified_time, node.size) == (
+            "folder/sub/c.vwx", hash_path("folder/sub/c.vwx"), 2000, len("folder/sub/c.vwx")
+        )
+        assert s.find(hash_path("missing")) is None
+    loaded.close()
+
+
+def test_load_rejects_damaged_file(tree, tmp_path):
+    path = tmp_path / "tree.snapshot"
+    assert TreeSnapshot.load(path) is None
+    TreeSnapshot.scan(tree).save(path)
+    path.write_bytes(path.read_bytes()[:-1])
+    assert TreeSnapshot.load(path) is None
+
+
+def test_diff(tree):
+    previous = TreeSnapshot.scan(tree)
+    (tree / "a.txt").unlink()
+    create_tree(tree, ["d.txt"])
+    os.utime(tree / "folder/b.txt", (1000, 3000))
+
+    snapshot = TreeSnapshot.scan(tree)
+    added, changed, removed = snapshot.diff(previous)
+    assert [snapshot.path(i) for i in added] == ["d.txt"]
+    assert [snapshot.path(i) for i in changed] == ["folder/b.txt"]
+    assert [previous.path(i) for i in removed] == ["a.txt"]
+
+
+def test_plan_actions_matches_handle_node(tree):
+    snapshot = TreeSnapshot.scan(tree)
+    root_folder = RootFolder(path=str(tree))
+
+    def remote(path, etag="etag", deleted=False):
+        return RemoteNodeHistory(key=hash_path(path), etag=etag, history=Bunch(etag=None, deleted=deleted))
+
+    def stored(path, created_time=None):
+        i = snapshot.find(hash_path(path))
+        if created_time is None:
+            created_time = snapshot.created_times[i] if i is not None else 0
+        return StoredNodeHistory(
+            key=hash_path(path), root_folder=root_folder, remote_history_etag="etag",
+            local_modified_time=2000, local_created_time=created_time,
+        )
+
+    remote_history = [remote("a.txt"), remote("folder/b.txt", etag="new"), remote("ü.txt", deleted=True),
+                      remote("gone.txt")]
+    stored_history = [stored("a.txt"), stored("folder/b.txt"), stored("folder/sub/c.vwx", created_time=1),
+                      stored("ü.txt"), stored("gone.txt")]
+    actions = plan_actions(tree, snapshot, remote_history, stored_history)
+
+    remote_by_key = {h.key: h for h in remote_history}
+    stored_by_key = {h.key: h for h in stored_history}
+    expected = {}
+    for path in ["a.txt", "folder/b.txt", "folder/sub/c.vwx", "ü.txt", "gone.txt"]:
+        key = hash_path(path)
+        i = snapshot.find(key)
+        local = snapshot.node(i, tree) if i is not None else None
+        expected[path] = handle_node(remote_by_key.get(key), local, stored_by_key.get(key)).name
+    assert expected == {
+        "a.txt": "nop", "folder/b.txt": "download", "folder/sub/c.vwx": "delete_local",
+        "ü.txt": "delete_local", "gone.txt": "delete_remote",
+    }
+    del expected["a.txt"]
+    assert sorted(a.name for a in actions) == sorted(expected.values())
+    assert len(actions) == 4